@@ -5,11 +5,13 @@ from tkinter import *
 from tkinter import ttk, filedialog
 from tkinter import messagebox
 import customtkinter as ctk
-from collections import defaultdict
 from PIL import Image, ImageTk
-import csv
 import os
-import pandas as pd
+import sys
+from gui_video_utils import FrameSource, PlaybackWorker, MaskOverlay
+from gui_annotation_utils import AnnotationStore, AnnotationTable, AnnotationJournal, autosave_journal_path, read_annotations_csv
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "SAM2_Tracking"))
+from frame_utils import FrameMapping  # Same raw frame <-> SAM2 frame mapping as the SAM2 pipeline
 
 # Initialize variables
 current_frame_index = [0]
@@ -18,14 +20,18 @@ yLocation = [0]
 ClickType = [1]  # Default to positive click (1)
 ObjID = [0]
 paused = [False]
-annotations = []
+show_masks = [False]
+annotations = AnnotationStore()  # Notifies the annotation table and autosave journal of each change
+annotation_journal = None  # Crash-safe autosave of the loaded video's annotations, switched by load_video
 video_speed = 1.0  # Playback speed multiplier
-frames = []
+frame_source = None  # Decodes video frames on demand
+mask_overlay = None  # Draws SAM2 masks on SAM2 frames once a masks file is loaded
 vid_height, vid_width = 0, 0
 fps = 30  # Default FPS, will update dynamically based on video
 out_fps = 3 # Default temporal resolution for SAM2. 
+sam2_fps = None  # FPS used to select SAM2 frames, must match `fps` in template_configs.yaml. None uses the video's FPS rounded to an integer
 special_frame_start = 0  # Default starting frame for SAM2
-special_frame_interval = 10  # Default, will calculate dynamically
+frame_mapping = None  # Precomputed raw frame <-> SAM2 frame table, rebuilt on video load and SAM2 start changes
 ObjType = ["Parrotfish"]  # Default fish family
 
 
@@ -44,34 +50,32 @@ def pause():
     button_play_pause.configure(text="Pause ||" if not paused[0] else "Play ▶")
     if not paused[0]:
         play_video()
+    else:
+        stop_playback()
 
 # Load Video Function
 def load_video():
-    global frames, vid_height, vid_width, fps, special_frame_interval, video_size_x, video_size_y
+    global frame_source, vid_height, vid_width, fps, video_size_x, video_size_y
 
     file_path = filedialog.askopenfilename(filetypes=[("Video Files", "*.mp4 *.avi")])
     if not file_path:
         return
 
-    cap = cv2.VideoCapture(file_path)
-    frames.clear()
-
-    fps = cap.get(cv2.CAP_PROP_FPS) or 30  # Update FPS dynamically
-    special_frame_interval = max(1, round(fps)/out_fps)  # Calculate interval for SAM2 extracted frames.
+    # Frames are decoded on demand, so only the video header is read here
+    stop_playback()
+    if frame_source is not None:
+        frame_source.close()
+    frame_source = FrameSource(file_path, (video_size_x, video_size_y))
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret:
-            frame = cv2.resize(frame, (video_size_x, video_size_y))
-            frames.append(frame)
-        else:
-            break
+    fps = frame_source.fps  # Update FPS dynamically
+    update_frame_mapping()
 
-    vid_height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-    vid_width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-    cap.release()
+    vid_height = frame_source.height
+    vid_width = frame_source.width
 
-    slider_frame.configure(to=len(frames) - 1)
+    current_frame_index[0] = 0
+    slider_frame.configure(to=frame_source.frame_count - 1)
+    start_autosave(file_path)
     play_video()
 
 # Canvas Click Event
@@ -91,8 +95,7 @@ def add_annotation():
         "ObjType": ObjType[0],
         "Location": np.array([round(xLocation[0], 3), round(yLocation[0], 3)])
     }
-    annotations.append(annotation)
-    update_annotation_table()
+    annotations.add(annotation)
 
     print(f"Annotation added for {current_frame_index[0]}.")
 
@@ -110,9 +113,8 @@ def add_entry(event=None):
         "ObjType": ObjType[0],
         "Location": np.array([0.0, 0.0])
     }
-    annotations.append(annotation)
+    annotations.add(annotation)
     print(f"Annotation added: {annotation}")
-    update_annotation_table()
 
 #Add Exit Hotkey
 def add_exit(event=None):
@@ -128,34 +130,12 @@ def add_exit(event=None):
         "ObjType": ObjType[0],
         "Location": np.array([0.0, 0.0])
     }
-    annotations.append(annotation)
+    annotations.add(annotation)
     print(f"Annotation added: {annotation}")
-    update_annotation_table()
-
-# Update Annotations Table
-def update_annotation_table():
-    for row in treeview.get_children():
-        treeview.delete(row)
-    for i, annotation in enumerate(annotations):
-        treeview.insert(
-            "",
-            "end",
-            iid=i,
-            values=(
-                i,
-                annotation["Frame"],
-                annotation["ClickType"],
-                annotation["ObjID"],
-                annotation["ObjType"],
-                annotation["Location"][:2],
-            ),
-        )
+
 # Delete Selected Annotations
 def delete_selected():
-    selected_items = treeview.selection()
-    for item in sorted(selected_items, reverse=True):
-        annotations.pop(int(item))
-    update_annotation_table()
+    annotations.delete(annotation_table.selected_ids())
 
 # Delete All Annotations
 def delete_all():
@@ -166,7 +146,6 @@ def delete_all():
     )
     if response == "yes":
         annotations.clear()
-        update_annotation_table()
 
 # Toggle Click Type
 def toggle_click_type():
@@ -219,41 +198,24 @@ def import_annotations():
             if not isinstance(imported_annotations, np.ndarray):
                 raise ValueError("The selected file does not contain compatible annotation data")
         
-        #Append annotations to existing list
+        #Validate every annotation before adding any of them
             for annotation in imported_annotations:
-                if isinstance(annotation, dict) and all(key in annotation for key in ["Frame", "ClickType", "ObjID", "ObjType", "Location"]):
-                    annotations.append(annotation)
-                else:
+                if not (isinstance(annotation, dict) and all(key in annotation for key in ["Frame", "ClickType", "ObjID", "ObjType", "Location"])):
                     raise ValueError("One or more annotations in the file have an invalid format.")
+
+            #Add all annotations at once, the annotation table updates itself
+            imported_ids = annotations.extend(imported_annotations)
         
         #Case 2: Load .csv file
         elif file_extension == ".csv":
-            imported_annotations = pd.read_csv(file_path)
-
-            #check if the necessary columns are in the .csv
-            required_columns = ["Frame", "ClickType", "ObjID", "ObjType", "Location"]
-            if not all(col in imported_annotations.columns for col in required_columns):
-                raise ValueError(f"The CSV file must contain the following columns: {', '.join(required_columns)}.")
-            for _, row in imported_annotations.iterrows():
-                location_str = row["Location"]
-                location = eval(location_str) if isinstance(location_str, str) else location_str
-                annotation = {
-                    "Frame": int(row["Frame"]),
-                    "ClickType": row["ClickType"],
-                    "ObjID": row["ObjID"],
-                    "ObjType": row["ObjType"],
-                    "Location": np.array(location)
-                }
-                annotations.append(annotation)
-                        #Update the annotation table with new data
+            #Parse and validate all columns at once, then bulk insert them
+            imported_ids = annotations.extend_columns(**read_annotations_csv(file_path))
 
         else:
             raise ValueError("The selected file is neither a valid .npy nor .csv file.")
 
-        #Update the annotation table with new data
-        update_annotation_table()
         # Optionally, show a message to the user that the import was successful
-        messagebox.showinfo("Import Successful", f"Successfully imported {len(imported_annotations)} annotations.")
+        messagebox.showinfo("Import Successful", f"Successfully imported {len(imported_ids)} annotations.")
 
     except Exception as e:
         # Handle any errors (e.g., file not found, invalid format, etc.)
@@ -265,20 +227,15 @@ def check_annotations():
     If a mismatch is found, a warning is shown and the user can choose to continue or go back.
     Returns True if the user decides to continue, False if the user chooses to go back.
     """
-    # Dictionary to count ClickTypes 3 (entry) and 4 (exit) for each ObjID
-    counts = defaultdict(lambda:{3: 0, 4: 0})
-    for annotation in annotations:
-        click = annotation.get("ClickType")
-        if click in [3,4]:
-            ObjID=annotation.get("ObjID")
-            counts[ObjID][click] += 1
+    # Count ClickTypes 3 (entry) and 4 (exit) for each ObjID
+    counts = annotations.entry_exit_counts()
 
     # Collect any mismatches
     mismatches = []
-    for ObjID, count in counts.items():
-        if count[3] != count[4]:
+    for ObjID, (entries, exits) in counts.items():
+        if entries != exits:
             mismatches.append(
-                f"ObjID '{ObjID}': Entries (ClickType 3) = {count[3]}, Exits (ClickType 4) = {count[4]}"
+                f"ObjID '{ObjID}': Entries (ClickType 3) = {entries}, Exits (ClickType 4) = {exits}"
             )
     # If there are mismatches, prompt the user
     if mismatches:
@@ -305,65 +262,118 @@ def save_annotations():
     print("No mismatches; proceeding to save annotations.")
 
     file_name = file_name_var.get().strip() or "annotations"  # Default name if none provided
-    general_annotations = [
-        a for a in annotations if a["ClickType"] in [0, 1, 3, 4]
-    ]
-    bite_annotations = [
-        a for a in annotations if a["ClickType"] == 2
-    ]
-    
+    num_general = num_bites = 0
+
+    # Positive/negative clicks, entries and exits go to the npy file read by SAM2
     if save_locations_var.get():
-        np.save(f"{file_name}_annotations.npy", general_annotations)
-    
+        num_general = annotations.save_npy(f"{file_name}_annotations.npy", click_types=[0, 1, 3, 4])
+
+    # Bites go to the CSV file
     if save_bites_var.get():
-        with open(f"{file_name}_bites.csv", "w", newline="") as csvfile:
-            fieldnames = ["Frame", "ClickType", "ObjID", "ObjType", "Location"]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for annotation in bite_annotations:
-                writer.writerow({
-                    "Frame": annotation["Frame"],
-                    "ClickType": annotation["ClickType"],
-                    "ObjID": annotation["ObjID"],
-                    "ObjType": annotation["ObjType"],
-                    "Location": annotation["Location"].tolist()
-                })
+        num_bites = annotations.save_csv(f"{file_name}_bites.csv", click_types=[2])
     
-    messagebox.showinfo("Save Successful", f"{len(general_annotations)} location annotations saved as '{file_name}_annotations.npy' and {len(bite_annotations)} bites saved as '{file_name}_bites.csv'.")
+    messagebox.showinfo("Save Successful", f"{num_general} location annotations saved as '{file_name}_annotations.npy' and {num_bites} bites saved as '{file_name}_bites.csv'.")
 
 # Play Video
 playing_task = None
+playback = None  # Decodes frames ahead of the display while playing
 
 def play_video():
+    global playback
+
+    if paused[0] or frame_source is None or current_frame_index[0] >= frame_source.frame_count:
+        return
+
+    stop_playback()
+    playback = PlaybackWorker(frame_source, current_frame_index[0], fps * video_speed, frame_filter=draw_masks_on_frame)
+    playback_tick()
+
+def playback_tick():
     global playing_task
 
-    if paused[0] or current_frame_index[0] >= len(frames):
+    if paused[0] or playback is None:
         return
 
-    frame_rgb = cv2.cvtColor(frames[current_frame_index[0]], cv2.COLOR_BGR2RGB)
-    image = Image.fromarray(frame_rgb)
-    photo = ImageTk.PhotoImage(image)
+    # Only swap in frames the worker thread has already prepared
+    next_frame = playback.next_frame()
+    if next_frame is not None:
+        current_frame_index[0], image = next_frame
+        photo = ImageTk.PhotoImage(image)
+        label_video.configure(image=photo)
+        label_video.image = photo
 
-    label_video.configure(image=photo)
-    label_video.image = photo
+        slider_frame.set(current_frame_index[0])
+        update_time_display()
 
-    slider_frame.set(current_frame_index[0])
-    update_time_display()
+    if playback.finished:
+        stop_playback()
+        return
 
-    current_frame_index[0] += 1
-    playing_task = root.after(int(1000 / (fps * video_speed)), play_video)
+    # Schedule against the next frame's deadline, so the time spent here is not added on
+    playing_task = root.after(playback.delay_ms(), playback_tick)
 
-# Update Frame from Slider
-def update_frame_from_slider(event):
-    global playing_task
+# Stop Playback
+def stop_playback():
+    global playing_task, playback
     if playing_task is not None:
         root.after_cancel(playing_task)
-    current_frame_index[0] = int(slider_frame.get())
-    frame_rgb = cv2.cvtColor(frames[current_frame_index[0]], cv2.COLOR_BGR2RGB)
+        playing_task = None
+    if playback is not None:
+        playback.stop()
+        playback = None
+
+# Display Current Frame
+def display_frame():
+    frame = frame_source.get_frame(current_frame_index[0])
+    if frame is None:
+        return
+    frame = draw_masks_on_frame(current_frame_index[0], frame)
+    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     image = Image.fromarray(frame_rgb)
     photo = ImageTk.PhotoImage(image)
     label_video.configure(image=photo)
     label_video.image = photo
+
+# Load SAM2 Masks
+def load_masks():
+    global mask_overlay
+
+    file_path = filedialog.askopenfilename(
+        title = "Load SAM2 Masks",
+        filetypes=(("Mask Files", "*.masks *.pkl"), ("All Files", "*.*"))
+    )
+    if not file_path:
+        return
+
+    try:
+        mask_overlay = MaskOverlay(file_path, (video_size_x, video_size_y))
+    except Exception as e:
+        messagebox.showerror("Error", f"An error occurred while loading masks: {str(e)}")
+        return
+
+    show_masks_var.set(True)
+    toggle_masks()
+
+# Show or Hide SAM2 Masks
+def toggle_masks():
+    show_masks[0] = show_masks_var.get()
+    if frame_source is not None and playback is None:
+        display_frame()
+
+# Draw SAM2 Masks on a Frame
+def draw_masks_on_frame(frame_num, frame):
+    """Returns frame with the SAM2 masks drawn on it, if masks are shown and frame_num is a SAM2 frame."""
+    if mask_overlay is None or not show_masks[0] or not is_special_frame(frame_num):
+        return frame
+    return mask_overlay.draw(frame, int(frame_mapping.sam2_index[frame_num]))
+
+# Update Frame from Slider
+def update_frame_from_slider(event):
+    if frame_source is None:
+        return
+    stop_playback()
+    current_frame_index[0] = int(slider_frame.get())
+    display_frame()
     update_time_display()
 
 # Update Time Display
@@ -374,7 +384,7 @@ def update_time_display():
     seconds = int(time_in_seconds % 60)
     time_display_var.set(f"Time: {minutes:02}:{seconds:02} | Frame: {frame_num} | Speed: {video_speed:.1f}x")
 
-    if frame_num >= special_frame_start and (frame_num - special_frame_start) % special_frame_interval == 0:
+    if is_special_frame(frame_num):
         special_frame_var.set("SAM2 Frame: Annotate Fish Position")
         label_special_frame.configure(font=("Arial", 14, "bold"), fg="red")
     else:
@@ -383,58 +393,57 @@ def update_time_display():
 
 # Advance Frame
 def advance_frame(delta):
-    global playing_task
-    if playing_task is not None:
-        root.after_cancel(playing_task)
-    current_frame_index[0] = max(0, min(len(frames) - 1, current_frame_index[0] + delta))
-    frame_rgb = cv2.cvtColor(frames[current_frame_index[0]], cv2.COLOR_BGR2RGB)
-    image = Image.fromarray(frame_rgb)
-    photo = ImageTk.PhotoImage(image)
-    label_video.configure(image=photo)
-    label_video.image = photo
+    if frame_source is None:
+        return
+    stop_playback()
+    current_frame_index[0] = max(0, min(frame_source.frame_count - 1, current_frame_index[0] + delta))
+    display_frame()
     update_time_display()
 
+# Rebuild the SAM2 Frame Table
+def update_frame_mapping():
+    global frame_mapping
+    if frame_source is not None:
+        frame_mapping = FrameMapping(sam2_fps or round(fps), out_fps, special_frame_start, frame_source.frame_count)
+
+# Check for a Special Frame
+def is_special_frame(frame_num):
+    """Returns whether frame_num is one of the frames extracted for SAM2."""
+    return frame_mapping is not None and 0 <= frame_num < len(frame_mapping.sam2_index) and frame_mapping.sam2_index[frame_num] >= 0
+
 # Navigate to Next Special Frame
 def next_special_frame():
-    global playing_task
-    if playing_task is not None:
-        root.after_cancel(playing_task)
-    while current_frame_index[0] < len(frames):
-        current_frame_index[0] += 1
-        if (current_frame_index[0] - special_frame_start) % special_frame_interval == 0:
-            break
-    frame_rgb = cv2.cvtColor(frames[current_frame_index[0]], cv2.COLOR_BGR2RGB)
-    image = Image.fromarray(frame_rgb)
-    photo = ImageTk.PhotoImage(image)
-    label_video.configure(image=photo)
-    label_video.image = photo
+    if frame_source is None:
+        return
+    stop_playback()
+    next_frame = frame_mapping.next_sam2_frame(current_frame_index[0], 1)
+    current_frame_index[0] = frame_source.frame_count - 1 if next_frame is None else next_frame
+    display_frame()
     update_time_display()
 
 #Navigate to Previous Special Frame
 def prev_special_frame():
-    global playing_task
-    if playing_task is not None:
-        root.after_cancel(playing_task)
-    while current_frame_index[0] > 0:
-        current_frame_index[0] -= 1
-        if (current_frame_index[0] - special_frame_start) % special_frame_interval == 0:
-            break
-    frame_rgb = cv2.cvtColor(frames[current_frame_index[0]], cv2.COLOR_BGR2RGB)
-    image = Image.fromarray(frame_rgb)
-    photo = ImageTk.PhotoImage(image)
-    label_video.configure(image=photo)
-    label_video.image = photo
+    if frame_source is None:
+        return
+    stop_playback()
+    prev_frame = frame_mapping.next_sam2_frame(current_frame_index[0], -1)
+    current_frame_index[0] = 0 if prev_frame is None else prev_frame
+    display_frame()
     update_time_display()
     
 # Adjust Playback Speed
 def adjust_speed(delta):
     global video_speed
     video_speed = max(0.1, video_speed + delta)
+    if playback is not None:
+        playback.set_rate(fps * video_speed)
     update_time_display()
 
 def reset_speed():
     global video_speed
     video_speed = 1.0
+    if playback is not None:
+        playback.set_rate(fps * video_speed)
     update_time_display()
 
 # UI Layout
@@ -461,6 +470,9 @@ special_frame_entry.pack(pady=5)
 def update_special_frame_start():
     global special_frame_start
     special_frame_start = special_frame_start_var.get()
+    update_frame_mapping()
+    if frame_source is not None:
+        update_time_display()
 
 button_set_special_frame = ctk.CTkButton(frame_controls, text="Set SAM2 Frame", command=update_special_frame_start, height = 20)
 button_set_special_frame.pack(pady=10)
@@ -499,6 +511,13 @@ button_delete_all.pack(pady=5)
 button_import = ctk.CTkButton(frame_controls, text="Import Previous Annotations", command=import_annotations, height = 20)
 button_import.pack(pady=5)
 
+button_load_masks = ctk.CTkButton(frame_controls, text="Load SAM2 Masks", command=load_masks, height = 20)
+button_load_masks.pack(pady=5)
+
+show_masks_var = BooleanVar(value=False)
+checkbox_show_masks = ctk.CTkCheckBox(frame_controls, text="Show Masks", variable=show_masks_var, command=toggle_masks)
+checkbox_show_masks.pack(pady=5)
+
 Label(frame_controls, text="Saving File Name:").pack(pady=5)
 file_name_var = StringVar()
 entry_file_name = ttk.Entry(frame_controls, textvariable=file_name_var)
@@ -579,10 +598,35 @@ frame_annotations = ctk.CTkFrame(root)
 frame_annotations.pack(side=RIGHT, fill=Y, padx=10, pady=10)
 
 columns = ("ID", "Frame", "Click Type", "Fish Label", "ObjType", "Coordinates")
-treeview = ttk.Treeview(frame_annotations, columns=columns, show="headings")
-for col in columns:
-    treeview.heading(col, text=col)
-    treeview.column(col, width=150)  # Adjust column width for readability
-treeview.pack(fill=BOTH, expand=True)
+# Only the rows in view are drawn, so the table stays fast with many annotations
+annotation_table = AnnotationTable(frame_annotations, annotations, columns, column_width=150)  # Adjust column width for readability
+annotation_table.pack(fill=BOTH, expand=True)
+
+# Switch the Autosave to the Loaded Video, Restoring its Autosaved Annotations
+def start_autosave(video_path):
+    global annotation_journal
+    if annotation_journal is not None:
+        annotation_journal.close()
+
+    annotation_journal = AnnotationJournal(annotations, autosave_journal_path(video_path))
+    if annotation_journal.pending_records():
+        if messagebox.askyesno("Restore Annotations", f"Annotations of {os.path.basename(video_path)} autosaved in a previous session were found. Do you want to restore them?"):
+            restored = annotation_journal.replay()
+            print(f"Restored {restored} annotations from '{annotation_journal.journal_path}'.")
+        else:
+            # Keep the old journal around in case it was needed after all
+            print(f"Autosaved annotations moved to '{annotation_journal.backup()}'.")
+    annotation_journal.start()
+
+# Close the GUI
+def on_close():
+    stop_playback()
+    if frame_source is not None:
+        frame_source.close()
+    if annotation_journal is not None:
+        annotation_journal.close()
+    root.destroy()
+
+root.protocol("WM_DELETE_WINDOW", on_close)
 
 root.mainloop()
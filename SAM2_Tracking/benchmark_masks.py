@@ -0,0 +1,7 @@
+import mask_utils
+
+# Specify a pickle file of masks written by older versions of main.py
+pickle_file = "./trial_1_generated_frame_masks.pkl"
+
+# Convert it to the compact mask format and compare size and speed
+mask_utils.benchmark_mask_formats(pickle_file)
@@ -4,8 +4,11 @@ import torch
 # Specify the path to the configuration YAML file
 configs = "./template_configs.yaml"
 
-# Set device for PyTorch 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# Guarded so the rendering worker processes of run_video_processing can import this script
+if __name__ == "__main__":
+    # Set device for PyTorch 
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # Run batch processing
+    utils.run_video_processing(configs, device)
 
-# Run batch processing
-utils.run_video_processing(configs, device)
@@ -0,0 +1,7 @@
+import utils
+
+# Specify the path to the configuration YAML file
+config_file = "./template_configs.yaml"
+
+# Extract the SAM2 frames of each trial's video
+utils.run_frame_extraction(config_file)
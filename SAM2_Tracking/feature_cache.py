@@ -0,0 +1,215 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import torch
+
+
+class FeatureCache:
+    """
+    A class used to cache the SAM2 image encoder (backbone) features of
+    video frames, so propagating over the same frames again, e.g. in
+    another pass, another trial or a rerun after an annotation fix,
+    skips the image encoder. Features are keyed by a hash of the frame's
+    JPG contents and of the model, so they are reused for identical
+    frames whichever object is tracked. The cache has an in-memory LRU
+    tier and an optional on-disk tier of `torch.save` files that are
+    memory-mapped when loaded, evicting the least recently used files
+    once the tier exceeds its size limit.
+
+    The positional encodings of the backbone only depend on the model
+    and the image size, so they are stored once per cache instead of
+    once per frame.
+
+    Methods
+    -------
+    __init__(self, model_key, memory_frames=32, cache_dir=None, disk_gb=20)
+        Sets the cache sizes and indexes the on-disk tier
+    frame_key(self, frame_path=None, frame_id=None)
+        Returns the cache key of a frame
+    get(self, key, device)
+        Returns the cached features of a frame
+    put(self, key, backbone_out)
+        Caches the features of a frame
+    """
+
+    def __init__(self, model_key, memory_frames=32, cache_dir=None, disk_gb=20):
+        """
+        Sets the cache sizes and indexes the on-disk tier.
+
+        Parameters
+        ----------
+        model_key : str
+            Identifies the model the features were computed with, e.g.
+            the model configuration, checkpoint and data type
+        memory_frames : int
+            The maximum number of frames held in memory, 0 disables the
+            in-memory tier
+        cache_dir : str or None
+            The directory of the on-disk tier, None disables it
+        disk_gb : float
+            The maximum size of the on-disk tier in gigabytes
+
+        Examples
+        --------
+        >>> cache = FeatureCache("sam2.1_hiera_l.yaml:sam2.1_hiera_large.pt", memory_frames=32,
+                                 cache_dir="./sam2_feature_cache", disk_gb=50)
+        """
+
+        self.model_key = model_key
+        self.memory_frames = memory_frames
+        self.cache_dir = cache_dir
+        self.disk_bytes = int(disk_gb * 1e9)
+
+        # Features of the most recently used frames, on the CPU
+        self._memory = OrderedDict()
+
+        # Positional encodings shared by every frame, set by the first cached frame
+        self._pos_enc = None
+
+        # Size of each on-disk file, ordered from least to most recently used
+        self._disk = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".pt")]
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                self._disk[entry.path] = entry.stat().st_size
+
+    def frame_key(self, frame_path=None, frame_id=None):
+        """
+        Returns the cache key of the frame `frame_path`, a hash of its
+        contents and of `self.model_key`, or of a frame decoded straight
+        from a video, a hash of `frame_id` and of `self.model_key`.
+
+        Parameters
+        ----------
+        frame_path : str or None
+            The path of the frame's JPG
+        frame_id : str or None
+            A string identifying a video frame, see
+            `video_utils.VideoFrameSource.frame_id`
+
+        Returns
+        -------
+        str
+            The hexadecimal SHA-1 hash
+        """
+
+        digest = hashlib.sha1(self.model_key.encode())
+        if frame_id is not None:
+            digest.update(frame_id.encode())
+        else:
+            with open(frame_path, "rb") as file:
+                digest.update(file.read())
+        return digest.hexdigest()
+
+    def get(self, key, device):
+        """
+        Returns the cached features of the frame with `key`, moved to
+        `device`, promoting features found on disk to the memory tier.
+
+        Parameters
+        ----------
+        key : str
+            The cache key of the frame
+        device : torch.device
+            The device the features are used on
+
+        Returns
+        -------
+        dict or None
+            The SAM2 `backbone_out` of the frame, or None if it is not
+            cached
+        """
+
+        # The positional encodings are only known once a frame was encoded in this process
+        if self._pos_enc is None:
+            return None
+
+        features = self._memory.get(key)
+        if features is not None:
+            self._memory.move_to_end(key)
+        elif self.cache_dir is not None and self._disk_path(key) in self._disk:
+            path = self._disk_path(key)
+            try:
+                features = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+                os.utime(path)
+            except OSError:
+                # Another process sharing the cache directory evicted the file
+                del self._disk[path]
+                return None
+            self._disk.move_to_end(path)
+            self._remember(key, features)
+        else:
+            return None
+
+        return {
+            "vision_features": features["vision_features"].to(device, non_blocking=True),
+            "backbone_fpn": [level.to(device, non_blocking=True) for level in features["backbone_fpn"]],
+            "vision_pos_enc": self._pos_enc,
+        }
+
+    def put(self, key, backbone_out):
+        """
+        Caches the features of the frame with `key`.
+
+        Parameters
+        ----------
+        key : str
+            The cache key of the frame
+        backbone_out : dict
+            The SAM2 `backbone_out` of the frame, as returned by
+            `forward_image`
+        """
+
+        if self._pos_enc is None:
+            self._pos_enc = backbone_out["vision_pos_enc"]
+
+        features = {
+            "vision_features": backbone_out["vision_features"].cpu(),
+            "backbone_fpn": [level.cpu() for level in backbone_out["backbone_fpn"]],
+        }
+        self._remember(key, features)
+
+        if self.cache_dir is not None:
+            # Write to a temporary file first, so readers never load a partly written file
+            path = self._disk_path(key)
+            torch.save(features, path + ".tmp")
+            os.replace(path + ".tmp", path)
+            self._disk[path] = os.path.getsize(path)
+            self._evict()
+
+    def _remember(self, key, features):
+        """
+        Adds features to the memory tier, evicting the least recently
+        used frames.
+        """
+
+        if self.memory_frames <= 0:
+            return
+
+        self._memory[key] = features
+        while len(self._memory) > self.memory_frames:
+            self._memory.popitem(last=False)
+
+    def _disk_path(self, key):
+        """
+        Returns the path of the on-disk file of `key`.
+        """
+
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def _evict(self):
+        """
+        Deletes the least recently used on-disk files until the tier is
+        within its size limit.
+        """
+
+        total = sum(self._disk.values())
+        while total > self.disk_bytes and len(self._disk) > 1:
+            path, size = self._disk.popitem(last=False)
+            total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,197 @@
+from fractions import Fraction
+
+import numpy as np
+
+# Frame rates of NTSC video, which are reported or written rounded, e.g. 29.97
+NTSC_FPS = [Fraction(24000, 1001), Fraction(30000, 1001), Fraction(60000, 1001), Fraction(120000, 1001)]
+
+
+def exact_fps(fps):
+    """
+    Converts a frame rate to an exact fraction, so frame arithmetic does
+    not accumulate floating point error over long videos. Rounded NTSC
+    frame rates, e.g. 29.97 or 29.97002997, are snapped to their exact
+    value, e.g. 30000/1001.
+
+    Parameters
+    ----------
+    fps : int, float, str or Fraction
+        The frame rate
+
+    Returns
+    -------
+    Fraction
+        The exact frame rate
+
+    Examples
+    --------
+    >>> exact_fps(29.97)
+    Fraction(30000, 1001)
+    >>> exact_fps(24)
+    Fraction(24, 1)
+    """
+
+    for ntsc_fps in NTSC_FPS:
+        if abs(float(fps) - float(ntsc_fps)) < 0.01:
+            return ntsc_fps
+    return Fraction(str(fps)).limit_denominator(1001)
+
+
+class FrameMapping:
+    """
+    A class used to map between frame indices of the unreduced video
+    (raw frames) and the reduced frames ingested by SAM2. SAM2 frame `k`
+    is raw frame `SAM2_start + round(k * max(1, fps / out_fps))`,
+    computed with exact fractions so non-integer frame rates such as
+    29.97 do not drift. An `out_fps` above `fps` takes every raw
+    frame. All conversions are vectorized over whole arrays, and when
+    the number of raw frames is known a lookup table is precomputed so
+    navigation is an array lookup. The annotation GUI, the annotation
+    adjustment and the video creation all use this class.
+
+    Methods
+    -------
+    __init__(self, fps, out_fps, SAM2_start=0, frame_count=None)
+        Sets the frame rates and builds the lookup table
+    to_raw(self, sam2_frames)
+        Converts SAM2 frames to raw frames
+    to_sam2(self, raw_frames)
+        Converts raw frames to the nearest SAM2 frames
+    is_sam2_frame(self, raw_frames)
+        Checks whether raw frames are SAM2 frames
+    next_sam2_frame(self, raw_frame, direction=1)
+        Returns the closest SAM2 frame after or before a raw frame
+    """
+
+    def __init__(self, fps, out_fps, SAM2_start=0, frame_count=None):
+        """
+        Sets the frame rates and, if `frame_count` is given, builds the
+        raw frame <-> SAM2 frame lookup table.
+
+        Parameters
+        ----------
+        fps : int, float or Fraction
+            The FPS of the unreduced video
+        out_fps : int, float or Fraction
+            The FPS of the reduced frames ingested by SAM2
+        SAM2_start : int
+            The raw frame that is the first SAM2 frame
+        frame_count : int or None
+            The number of raw frames in the video
+
+        Examples
+        --------
+        >>> mapping = FrameMapping(fps=24, out_fps=3, SAM2_start=2)
+        >>> mapping.to_raw([0, 1, 2])
+        array([ 2, 10, 18])
+        """
+
+        self.fps = exact_fps(fps)
+        self.out_fps = Fraction(str(out_fps))
+        self.SAM2_start = int(SAM2_start)
+
+        # Number of raw frames between SAM2 frames, as numerator / denominator, 
+        # at least 1 so no raw frame is used twice
+        interval = max(self.fps / self.out_fps, Fraction(1))
+        self._num = interval.numerator
+        self._den = interval.denominator
+
+        self.frame_count = frame_count
+        if frame_count is not None:
+            # Raw frame of each SAM2 frame inside the video
+            num_sam2 = max(0, (frame_count - self.SAM2_start) * self._den // self._num + 1)
+            self.sam2_frames = self.to_raw(np.arange(num_sam2))
+            self.sam2_frames = self.sam2_frames[self.sam2_frames < frame_count]
+
+            # SAM2 frame of each raw frame, -1 for raw frames that are not SAM2 frames
+            self.sam2_index = np.full(frame_count, -1, dtype=np.int64)
+            self.sam2_index[self.sam2_frames] = np.arange(len(self.sam2_frames))
+
+    def to_raw(self, sam2_frames):
+        """
+        Converts SAM2 frame indices to raw frame indices.
+
+        Parameters
+        ----------
+        sam2_frames : int or array-like of ints
+            The SAM2 frame indices
+
+        Returns
+        -------
+        numpy.ndarray of ints
+            The raw frame index of each SAM2 frame
+        """
+
+        sam2_frames = np.asarray(sam2_frames, dtype=np.int64)
+        # Integer form of round(k * num / den), rounding halves up
+        return self.SAM2_start + (2 * sam2_frames * self._num + self._den) // (2 * self._den)
+
+    def to_sam2(self, raw_frames):
+        """
+        Converts raw frame indices to the nearest SAM2 frame indices.
+
+        Parameters
+        ----------
+        raw_frames : int or array-like of ints
+            The raw frame indices
+
+        Returns
+        -------
+        sam2_frames : numpy.ndarray of ints
+            The nearest SAM2 frame index of each raw frame
+        exact : numpy.ndarray of bools
+            Whether each raw frame is exactly a SAM2 frame, i.e. did
+            not have to be rounded
+        """
+
+        offsets = np.asarray(raw_frames, dtype=np.int64) - self.SAM2_start
+        sam2_frames = (2 * offsets * self._den + self._num) // (2 * self._num)
+        exact = (offsets >= 0) & (self.to_raw(sam2_frames) == offsets + self.SAM2_start)
+        return sam2_frames, exact
+
+    def is_sam2_frame(self, raw_frames):
+        """
+        Checks whether raw frames are SAM2 frames.
+
+        Parameters
+        ----------
+        raw_frames : int or array-like of ints
+            The raw frame indices
+
+        Returns
+        -------
+        bool or numpy.ndarray of bools
+            True for each raw frame that is a SAM2 frame
+        """
+
+        if self.frame_count is not None and np.all((np.asarray(raw_frames) >= 0) & (np.asarray(raw_frames) < self.frame_count)):
+            return self.sam2_index[raw_frames] >= 0
+        return self.to_sam2(raw_frames)[1]
+
+    def next_sam2_frame(self, raw_frame, direction=1):
+        """
+        Returns the closest SAM2 frame after (`direction=1`) or before
+        (`direction=-1`) `raw_frame`. Requires `frame_count`.
+
+        Parameters
+        ----------
+        raw_frame : int
+            The raw frame to start from
+        direction : int
+            1 to search forwards, -1 to search backwards
+
+        Returns
+        -------
+        int or None
+            The raw frame index of the SAM2 frame, or None if there is
+            no SAM2 frame in that direction
+        """
+
+        if direction > 0:
+            position = np.searchsorted(self.sam2_frames, raw_frame, side="right")
+        else:
+            position = np.searchsorted(self.sam2_frames, raw_frame, side="left") - 1
+
+        if 0 <= position < len(self.sam2_frames):
+            return int(self.sam2_frames[position])
+        return None
@@ -3,8 +3,10 @@ import utils
 
 config_file = "./template_configs.yaml"
         
-# Set device for PyTorch
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Guarded so the worker processes of run_segmentation can import this script
+if __name__ == "__main__":
+    # Set device for PyTorch
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Process batch of videos
-utils.run_segmentation(config_file, device)
\ No newline at end of file
+    # Process batch of videos
+    utils.run_segmentation(config_file, device)
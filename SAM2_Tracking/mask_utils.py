@@ -0,0 +1,786 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import pickle
+import struct
+import time
+import zlib
+
+import numpy as np
+
+# Header identifying mask files written by MaskWriter, followed by a format version byte
+MASK_FILE_MAGIC = b"SAM2MASK"
+MASK_FILE_VERSION = 1
+
+# Ends the trailer that points to the mask index written when a mask file is closed
+MASK_INDEX_MAGIC = b"SAM2MIDX"
+
+# Header of each mask record: magic, frame, obj_id, height, width, top, left, bottom, right, nbytes
+RECORD_MAGIC = b"MREC"
+RECORD_HEADER = struct.Struct("<4sqqiiiiiiI")
+
+# Columns of the mask index, one row per record
+INDEX_COLUMNS = ["frame", "obj_id", "height", "width", "top", "left", "bottom", "right", "offset", "nbytes"]
+
+# zlib level for the packed bits, higher levels barely shrink packed masks further
+MASK_COMPRESSION_LEVEL = 1
+
+
+def split_legacy_masks(mask_dict):
+    """
+    Converts the masks of one frame written before masks were stored
+    per object. Older files stored, for every object, the stacked masks
+    of all objects tracked in the same SAM2 pass, with shape
+    (objects, height, width). The objects of a pass were added
+    consecutively in the order of the stack, so each object keeps the
+    mask at its position within its run of stacked masks. Masks that
+    are already per object, with shape (height, width), are unchanged.
+
+    Parameters
+    ----------
+    mask_dict : dict
+        Dictionary with keys corresponding to object IDs and values
+        representing the masks stored for the object ID
+
+    Returns
+    -------
+    dict
+        `mask_dict`, modified so each value is the mask of its
+        object ID only
+
+    Examples
+    --------
+    >>> stacked = torch.zeros((2, 4, 4), dtype=torch.bool).to_sparse()
+    >>> split_legacy_masks({3: stacked, 5: stacked})[5].shape
+    torch.Size([4, 4])
+    """
+
+    run_length, run_position = None, 0
+    for obj_id, mask in mask_dict.items():
+        if mask.ndim != 3:
+            continue
+
+        # A new pass starts when the stack size changes or the run is complete
+        if mask.shape[0] != run_length or run_position == run_length:
+            run_length, run_position = mask.shape[0], 0
+
+        mask_dict[obj_id] = mask[run_position]
+        run_position += 1
+
+    return mask_dict
+
+
+def load_frame_masks(frame_masks_file):
+    """
+    Loads a pickle file of masks written by
+    `SAM2FishSegmenter.run_propagation`, converting files written
+    before masks were stored per object with `split_legacy_masks`.
+
+    Parameters
+    ----------
+    frame_masks_file : str
+        A pickle file composed of sparse tensors representing the
+        generated masks for each video frame
+
+    Returns
+    -------
+    dict of dict
+        A dict where keys correspond to the frame number and values
+        are a dict with keys corresponding to object IDs and values
+        are sparse tensors of shape (height, width) representing masks
+
+    Examples
+    --------
+    >>> frame_masks = load_frame_masks("./generated_frame_masks.pkl")
+    """
+
+    # The masks are PyTorch sparse tensors, so unpickling them needs PyTorch
+    with open(frame_masks_file, "rb") as file:
+        frame_masks = pickle.load(file)
+
+    for mask_dict in frame_masks.values():
+        split_legacy_masks(mask_dict)
+
+    return frame_masks
+
+
+def encode_mask(mask):
+    """
+    Encodes a binary mask as the bounding box of its foreground and
+    the bit-packed pixels inside the bounding box. Solid objects take
+    about one bit per bounding box pixel, instead of the two int64
+    coordinates per foreground pixel of a sparse COO tensor.
+
+    Parameters
+    ----------
+    mask : numpy.ndarray of bools
+        A mask with shape (height, width)
+
+    Returns
+    -------
+    bbox : tuple of ints
+        The `(top, left, bottom, right)` bounding box of the
+        foreground, with exclusive bottom and right values, or
+        `(0, 0, 0, 0)` if the mask is empty
+    bits : numpy.ndarray of uint8
+        The bit-packed pixels inside `bbox`, row by row
+
+    Examples
+    --------
+    >>> mask = np.zeros((4, 4), dtype=bool)
+    >>> mask[1:3, 2] = True
+    >>> encode_mask(mask)
+    ((1, 2, 3, 3), array([192], dtype=uint8))
+    """
+
+    mask = np.asarray(mask, dtype=bool)
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return (0, 0, 0, 0), np.zeros(0, dtype=np.uint8)
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    bbox = (int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1)
+    return bbox, np.packbits(mask[bbox[0]:bbox[2], bbox[1]:bbox[3]])
+
+
+def decode_mask(shape, bbox, bits):
+    """
+    Decodes a mask encoded by `encode_mask`.
+
+    Parameters
+    ----------
+    shape : tuple of ints
+        The `(height, width)` of the mask
+    bbox : tuple of ints
+        The `(top, left, bottom, right)` bounding box of the foreground
+    bits : numpy.ndarray of uint8
+        The bit-packed pixels inside `bbox`
+
+    Returns
+    -------
+    numpy.ndarray of bools
+        The mask with shape `shape`
+    """
+
+    top, left, bottom, right = bbox
+    mask = np.zeros(shape, dtype=bool)
+    if bottom > top:
+        crop_shape = (bottom - top, right - left)
+        crop = np.unpackbits(bits, count=crop_shape[0] * crop_shape[1])
+        mask[top:bottom, left:right] = crop.reshape(crop_shape).view(bool)
+    return mask
+
+
+def scan_records(buffer, position):
+    """
+    Returns the mask index of the complete records of a mask file
+    from `position` onwards, stopping at the first incomplete record or
+    at the mask index written when the file was closed.
+
+    Parameters
+    ----------
+    buffer : mmap.mmap or bytes
+        The contents of the mask file
+    position : int
+        The byte offset of the first record
+
+    Returns
+    -------
+    numpy.ndarray of ints
+        The mask index, one row of `INDEX_COLUMNS` per record
+    """
+
+    rows = []
+    while position + RECORD_HEADER.size <= len(buffer):
+        magic, *fields, nbytes = RECORD_HEADER.unpack_from(buffer, position)
+        offset = position + RECORD_HEADER.size
+        if magic != RECORD_MAGIC or offset + nbytes > len(buffer):
+            break
+        rows.append((*fields, offset, nbytes))
+        position = offset + nbytes
+
+    return np.array(rows, dtype=np.int64).reshape(-1, len(INDEX_COLUMNS))
+
+
+class MaskWriter:
+    """
+    A class used to stream the masks generated by SAM2 to a mask file
+    as they are produced, so only the small mask index is held in
+    memory. Each mask is cropped to its bounding box and bit-packed by
+    `encode_mask`, compressed with zlib and appended as a record
+    (`RECORD_HEADER` followed by the compressed bits). Closing the
+    writer appends the mask index, one row of `INDEX_COLUMNS` per
+    record, and a trailer pointing to it, so `MaskReader` can fetch any
+    frame or object without reading the rest of the file. A file that
+    was not closed, e.g. after a crash, is still readable by scanning
+    its records. An existing mask file can be resumed, appending after
+    the records committed by an earlier, interrupted run.
+
+    Methods
+    -------
+    __init__(self, masks_file, frame_count, resume_offset=None)
+        Creates or resumes the mask file
+    add(self, frame_idx, obj_id, mask)
+        Encodes and appends the mask of an object on a frame
+    tell(self)
+        Returns the byte offset the next record is written at
+    flush(self)
+        Flushes the appended masks to disk
+    commit(self)
+        Durably writes the appended masks to disk
+    close(self, keep_records=None)
+        Writes the mask index and closes the mask file
+    """
+
+    def __init__(self, masks_file, frame_count, resume_offset=None):
+        """
+        Creates the mask file and writes its header, or resumes an
+        existing mask file.
+
+        Parameters
+        ----------
+        masks_file : str
+            The path of the mask file to write
+        frame_count : int
+            The number of frames in the video
+        resume_offset : int or None
+            If given, the existing mask file is truncated to this byte
+            offset, e.g. the end of the last committed record, and new
+            records are appended after it
+
+        Raises
+        ------
+        ValueError
+            If the mask file to resume was not written by this version
+
+        Examples
+        --------
+        >>> with MaskWriter("./generated_frame_masks.masks", frame_count=100) as writer:
+        ...     writer.add(0, 1, mask)
+        """
+
+        self.masks_file = masks_file
+        self.frame_count = frame_count
+
+        # One row of INDEX_COLUMNS per appended record
+        self._index = []
+
+        header = MASK_FILE_MAGIC + bytes([MASK_FILE_VERSION]) + struct.pack("<q", frame_count)
+        if resume_offset is None:
+            self._file = open(masks_file, "wb")
+            self._file.write(header)
+            return
+
+        # Drop the mask index and any partly written records after resume_offset
+        self._file = open(masks_file, "r+b")
+        if self._file.read(len(header)) != header:
+            self._file.close()
+            raise ValueError(f"{masks_file} cannot be resumed, it was written by another version or for another video!")
+        self._file.truncate(resume_offset)
+        self._file.seek(resume_offset)
+
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            self._index = [tuple(row) for row in scan_records(buffer, len(header)).tolist()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, frame_idx, obj_id, mask):
+        """
+        Encodes and appends the mask of `obj_id` on `frame_idx`. A mask
+        added again for the same frame and object replaces the earlier
+        one when read.
+
+        Parameters
+        ----------
+        frame_idx : int
+            The frame index of the mask
+        obj_id : int
+            The object ID of the mask
+        mask : numpy.ndarray of bools
+            A mask with shape (height, width)
+        """
+
+        bbox, bits = encode_mask(mask)
+        blob = zlib.compress(bits.tobytes(), MASK_COMPRESSION_LEVEL)
+        fields = (int(frame_idx), int(obj_id), *np.shape(mask), *bbox)
+
+        offset = self._file.tell() + RECORD_HEADER.size
+        self._file.write(RECORD_HEADER.pack(RECORD_MAGIC, *fields, len(blob)))
+        self._file.write(blob)
+        self._index.append((*fields, offset, len(blob)))
+
+    def tell(self):
+        """
+        Returns the byte offset the next record is written at.
+        """
+
+        return self._file.tell()
+
+    def flush(self):
+        """
+        Flushes the appended masks to disk.
+        """
+
+        self._file.flush()
+
+    def commit(self):
+        """
+        Durably writes the appended masks to disk, so they survive a
+        crash or power loss.
+
+        Returns
+        -------
+        int
+            The byte offset of the end of the committed records
+        """
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self, keep_records=None):
+        """
+        Writes the mask index and closes the mask file.
+
+        Parameters
+        ----------
+        keep_records : list of tuples of ints or None
+            If given, only records matching one of these
+            `(start, end, obj_id)` tuples, i.e. records of `obj_id`
+            within the byte range `start` to `end`, are indexed, e.g.
+            to drop the stale records of recomputed chunks of a
+            resumed file
+        """
+
+        if self._file.closed:
+            return
+
+        index = np.array(self._index, dtype=np.int64).reshape(-1, len(INDEX_COLUMNS))
+        if keep_records is not None:
+            kept = np.zeros(len(index), dtype=bool)
+            for start, end, obj_id in keep_records:
+                kept |= (index[:, 8] >= start) & (index[:, 8] < end) & (index[:, 1] == obj_id)
+            index = index[kept]
+
+        index_offset = self._file.tell()
+        np.save(self._file, index)
+        self._file.write(struct.pack("<q", index_offset) + MASK_INDEX_MAGIC)
+        self._file.close()
+
+
+class MaskReader:
+    """
+    A class used to read masks written by `MaskWriter`. The file is
+    memory-mapped and only the mask index is loaded, so each frame or
+    object is decompressed from disk when it is requested. Mask files
+    pickled by older versions of `SAM2FishSegmenter.run_propagation`
+    (detected by their missing `MASK_FILE_MAGIC` header and read with
+    `load_frame_masks`, which needs PyTorch) are also supported.
+
+    Methods
+    -------
+    __init__(self, masks_file)
+        Opens the mask file and reads its index
+    __len__(self)
+        Returns the number of frames
+    obj_ids(self, frame_idx)
+        Returns the object IDs with a mask on a frame
+    get_mask(self, frame_idx, obj_id)
+        Returns the mask of an object on a frame
+    get_frame(self, frame_idx)
+        Returns the masks of all objects on a frame
+    close(self)
+        Closes the memory map of the mask file
+    """
+
+    def __init__(self, masks_file):
+        """
+        Opens the mask file and reads its index.
+
+        Parameters
+        ----------
+        masks_file : str
+            A mask file written by `MaskWriter`, or a pickle file
+            written by older versions
+
+        Raises
+        ------
+        ValueError
+            If the mask file was written by a newer, unsupported version
+
+        Examples
+        --------
+        >>> with MaskReader("./generated_frame_masks.masks") as reader:
+        ...     masks = reader.get_frame(0)
+        """
+
+        self.masks_file = masks_file
+        self._mmap = None
+
+        with open(masks_file, "rb") as file:
+            header = file.read(len(MASK_FILE_MAGIC) + 1)
+            is_legacy = header[:len(MASK_FILE_MAGIC)] != MASK_FILE_MAGIC
+
+            if is_legacy:
+                pass
+            elif header[-1] == MASK_FILE_VERSION:
+                self.frame_count = struct.unpack("<q", file.read(8))[0]
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._index = self._read_index(file.tell())
+            else:
+                raise ValueError(f"Mask file version {header[-1]} of {masks_file} is not supported!")
+
+        # Masks of pickle files, None for files written by MaskWriter
+        self._legacy_masks = None
+        if is_legacy:
+            self._legacy_masks = load_frame_masks(masks_file)
+            self.frame_count = max(self._legacy_masks, default=-1) + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        """
+        Returns the number of frames.
+        """
+
+        return self.frame_count
+
+    def close(self):
+        """
+        Closes the memory map of the mask file.
+        """
+
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _read_index(self, records_start):
+        """
+        Reads the mask index written when the file was closed, or
+        rebuilds it by scanning the records of a file that was not
+        closed. Only the last record of each frame and object is kept.
+        """
+
+        trailer_start = len(self._mmap) - 8 - len(MASK_INDEX_MAGIC)
+        if trailer_start >= records_start and self._mmap[trailer_start + 8:] == MASK_INDEX_MAGIC:
+            index_offset = struct.unpack_from("<q", self._mmap, trailer_start)[0]
+            index = np.load(io.BytesIO(self._mmap[index_offset:trailer_start]))
+        else:
+            print(f"Warning: {self.masks_file} was not closed, recovering its masks by scanning the file.")
+            index = scan_records(self._mmap, records_start)
+
+        # Sort by frame and object, keeping the order records were written in as the tie-breaker
+        index = index[np.lexsort((index[:, 8], index[:, 1], index[:, 0]))]
+        last = np.ones(len(index), dtype=bool)
+        last[:-1] = np.any(index[1:, :2] != index[:-1, :2], axis=1)
+        return index[last]
+
+    def _frame_rows(self, frame_idx):
+        """
+        Returns the rows of the mask index for `frame_idx`.
+        """
+
+        start, stop = np.searchsorted(self._index[:, 0], [frame_idx, frame_idx + 1])
+        return self._index[start:stop]
+
+    def _decode_row(self, row):
+        """
+        Decodes the mask of a row of the mask index.
+        """
+
+        _, _, height, width, top, left, bottom, right, offset, nbytes = row
+        bits = np.frombuffer(zlib.decompress(self._mmap[offset:offset + nbytes]), dtype=np.uint8)
+        return decode_mask((height, width), (top, left, bottom, right), bits)
+
+    def obj_ids(self, frame_idx):
+        """
+        Returns the object IDs with a mask on `frame_idx`.
+
+        Parameters
+        ----------
+        frame_idx : int
+            The frame index
+
+        Returns
+        -------
+        list of ints
+            The object IDs
+        """
+
+        if self._legacy_masks is not None:
+            return list(self._legacy_masks.get(frame_idx, {}))
+        return [int(obj_id) for obj_id in self._frame_rows(frame_idx)[:, 1]]
+
+    def get_mask(self, frame_idx, obj_id):
+        """
+        Returns the mask of `obj_id` on `frame_idx`.
+
+        Parameters
+        ----------
+        frame_idx : int
+            The frame index
+        obj_id : int
+            The object ID
+
+        Returns
+        -------
+        numpy.ndarray of bools or None
+            The mask with shape (height, width), or None if the object
+            has no mask on the frame
+        """
+
+        if self._legacy_masks is not None:
+            return self.get_frame(frame_idx).get(obj_id)
+
+        for row in self._frame_rows(frame_idx):
+            if row[1] == obj_id:
+                return self._decode_row(row)
+        return None
+
+    def get_frame(self, frame_idx):
+        """
+        Returns the masks of all objects on `frame_idx`.
+
+        Parameters
+        ----------
+        frame_idx : int
+            The frame index
+
+        Returns
+        -------
+        dict of numpy.ndarray
+            Dictionary with keys corresponding to object IDs and values
+            the mask of the object ID with shape (height, width)
+        """
+
+        if self._legacy_masks is not None:
+            return {obj_id: np.asarray(mask.to_dense() if hasattr(mask, "to_dense") else mask, dtype=bool)
+                    for obj_id, mask in self._legacy_masks.get(frame_idx, {}).items()}
+
+        return {int(row[1]): self._decode_row(row) for row in self._frame_rows(frame_idx)}
+
+
+class MaskManifest:
+    """
+    A class used to make mask propagation resumable. The manifest,
+    saved next to the mask file as `<masks_file>.manifest.json`, records
+    the byte range of the mask file holding the masks of each chunk
+    that was committed, keyed by a hash of everything the chunk's masks
+    depend on (see `chunk_key`). Chunks whose key is still present when
+    propagation is rerun can be skipped, while chunks whose annotations
+    changed get a new key and are recomputed. The manifest is replaced
+    atomically after each chunk, so it never refers to masks that were
+    not durably written.
+
+    Methods
+    -------
+    __init__(self, masks_file, settings)
+        Loads the manifest of `masks_file`, if it is still valid
+    chunk_key(chunk)
+        Returns the key of a chunk
+    is_complete(self, key)
+        Checks whether the masks of a chunk are committed
+    commit(self, key, chunk, start, end)
+        Records the committed byte range of a chunk
+    keep(self, keys)
+        Forgets committed chunks that are no longer needed
+    records(self)
+        Returns the byte ranges and object IDs of the committed chunks
+    """
+
+    def __init__(self, masks_file, settings):
+        """
+        Loads the manifest of `masks_file`. It is discarded, and every
+        chunk considered incomplete, if it does not exist, was made with
+        different `settings` or the mask file is shorter than it records.
+
+        Parameters
+        ----------
+        masks_file : str
+            The path of the mask file
+        settings : dict
+            The configurations every chunk's masks depend on, e.g. the
+            model and the frames
+
+        Examples
+        --------
+        >>> manifest = MaskManifest("./generated_frame_masks.masks", {"model_cfg": "sam2.1_hiera_l.yaml"})
+        """
+
+        self.manifest_file = masks_file + ".manifest.json"
+        self.settings_key = self.chunk_key(settings)
+
+        # End of the committed records, None if there is nothing to resume
+        self.committed_end = None
+        self.chunks = {}
+
+        try:
+            with open(self.manifest_file) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        if (manifest.get("settings_key") == self.settings_key and os.path.exists(masks_file) 
+                and os.path.getsize(masks_file) >= manifest["committed_end"]):
+            self.committed_end = manifest["committed_end"]
+            self.chunks = manifest["chunks"]
+
+    @staticmethod
+    def chunk_key(chunk):
+        """
+        Returns the key of a chunk, a hash of its JSON representation.
+
+        Parameters
+        ----------
+        chunk : dict
+            Everything the chunk's masks depend on, e.g. the object ID,
+            the enter and exit frames and the annotations
+
+        Returns
+        -------
+        str
+            The hexadecimal SHA-1 hash of `chunk`
+        """
+
+        # NumPy values are converted to Python values so equal chunks have equal keys
+        encoded = json.dumps(chunk, sort_keys=True, default=lambda value: value.tolist() if hasattr(value, "tolist") else str(value))
+        return hashlib.sha1(encoded.encode()).hexdigest()
+
+    def is_complete(self, key):
+        """
+        Checks whether the masks of the chunk with `key` are committed.
+        """
+
+        return key in self.chunks
+
+    def commit(self, key, chunk, start, end):
+        """
+        Records that the masks of a chunk are committed in the byte
+        range `start` to `end` of the mask file, and saves the manifest.
+
+        Parameters
+        ----------
+        key : str
+            The key of the chunk
+        chunk : dict
+            A description of the chunk, with at least its `obj_id`
+        start : int
+            The byte offset of the first record of the pass that
+            propagated the chunk
+        end : int
+            The byte offset of the end of the committed records, as
+            returned by `MaskWriter.commit`
+        """
+
+        self.chunks[key] = {**chunk, "start": start, "end": end}
+        self.committed_end = end
+        self._save()
+
+    def keep(self, keys):
+        """
+        Forgets committed chunks whose key is not in `keys`, e.g. chunks
+        whose annotations changed, and saves the manifest.
+        """
+
+        self.chunks = {key: chunk for key, chunk in self.chunks.items() if key in keys}
+        if self.committed_end is not None:
+            self._save()
+
+    def records(self):
+        """
+        Returns the `(start, end, obj_id)` byte ranges and object IDs of
+        the committed chunks, for `MaskWriter.close`. Chunks propagated
+        in the same pass share a byte range.
+        """
+
+        return [(chunk["start"], chunk["end"], int(chunk["obj_id"])) for chunk in self.chunks.values()]
+
+    def _save(self):
+        """
+        Atomically replaces the manifest file.
+        """
+
+        manifest = {"settings_key": self.settings_key, "committed_end": self.committed_end, "chunks": self.chunks}
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(manifest, file, indent=1, default=lambda value: value.tolist() if hasattr(value, "tolist") else str(value))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.manifest_file)
+
+
+def benchmark_mask_formats(pickle_file, masks_file=None):
+    """
+    Converts a pickle file of masks written by older versions of
+    `SAM2FishSegmenter.run_propagation` to a `MaskWriter` mask file,
+    and prints the file size and the time to write the file and to
+    read every frame for both formats.
+
+    Parameters
+    ----------
+    pickle_file : str
+        A pickle file composed of sparse tensors representing the
+        generated masks for each video frame
+    masks_file : str or None
+        The mask file to write, by default `pickle_file` with the
+        extension replaced by `.masks`
+
+    Returns
+    -------
+    dict of dict
+        The `size_mb`, `write_s` and `read_s` of each format,
+        keyed by `pickle` and `masks`
+
+    Examples
+    --------
+    >>> benchmark_mask_formats("./trial_1_generated_frame_masks.pkl")
+    """
+
+    if masks_file is None:
+        masks_file = os.path.splitext(pickle_file)[0] + ".masks"
+
+    results = {}
+
+    # Read every frame of the pickle file
+    start = time.perf_counter()
+    legacy_reader = MaskReader(pickle_file)
+    frames = [legacy_reader.get_frame(frame_idx) for frame_idx in range(len(legacy_reader))]
+    read_s = time.perf_counter() - start
+
+    # Pickle the loaded sparse tensors again to time writing them
+    start = time.perf_counter()
+    pickle.dumps(legacy_reader._legacy_masks)
+    write_s = time.perf_counter() - start
+    results["pickle"] = {"size_mb": os.path.getsize(pickle_file) / 1e6, "write_s": write_s, "read_s": read_s}
+
+    # Write and read every frame of the mask file
+    start = time.perf_counter()
+    with MaskWriter(masks_file, len(frames)) as writer:
+        for frame_idx, masks in enumerate(frames):
+            for obj_id, mask in masks.items():
+                writer.add(frame_idx, obj_id, mask)
+    write_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reader = MaskReader(masks_file)
+    for frame_idx in range(len(reader)):
+        reader.get_frame(frame_idx)
+    read_s = time.perf_counter() - start
+    results["masks"] = {"size_mb": os.path.getsize(masks_file) / 1e6, "write_s": write_s, "read_s": read_s}
+
+    print(f"{'Format':<8}{'Size (MB)':>12}{'Write (s)':>12}{'Read (s)':>12}")
+    for name, result in results.items():
+        print(f"{name:<8}{result['size_mb']:>12.2f}{result['write_s']:>12.2f}{result['read_s']:>12.2f}")
+
+    return results
@@ -1,7 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import colorsys
-import torch 
 
 
 def get_centroid(mask):
@@ -20,6 +19,9 @@ def get_centroid(mask):
         the centroid, respectively 
     """
 
+    # Imported here so the GUI, which has no PyTorch, can use the colors of this module
+    import torch
+
     # Get nonzero indices
     y_indices, x_indices = torch.where(mask)  
 
@@ -0,0 +1,244 @@
+import cv2
+import numpy as np
+from PIL import ImageColor
+
+# Figure resolution and subplot margins of the matplotlib figures this renderer reproduces
+DPI = 100
+SUBPLOT_LEFT, SUBPLOT_RIGHT, SUBPLOT_BOTTOM, SUBPLOT_TOP = 0.125, 0.9, 0.11, 0.88
+
+# Font used for all text, and the height of its capital letters relative to the font size
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+CAP_HEIGHT = 0.73
+
+
+def points_to_pixels(points):
+    """
+    Converts a length in points, e.g. a matplotlib font size, to pixels.
+    """
+
+    return points * DPI / 72
+
+
+def font_scale(font_size):
+    """
+    Returns the OpenCV font scale that draws capital letters as tall as
+    a matplotlib font of `font_size` points.
+
+    Parameters
+    ----------
+    font_size : float
+        The font size in points
+
+    Returns
+    -------
+    float
+        The `fontScale` for `cv2.putText`
+    """
+
+    (_, base_height), _ = cv2.getTextSize("H", FONT, 1.0, 1)
+    return points_to_pixels(font_size) * CAP_HEIGHT / base_height
+
+
+def to_bgr(color):
+    """
+    Converts a color name (e.g. "red"), a hex string or an RGB tuple to
+    a BGR tuple for OpenCV.
+    """
+
+    if isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    return tuple(int(c) for c in color[:3][::-1])
+
+
+class FrameRenderer:
+    """
+    A class used to render the frames of the output video with NumPy and
+    OpenCV, as a fast alternative to drawing each frame with matplotlib.
+    Frames look like the matplotlib figures of `utils.render_frames`: the
+    masked frame in an axes with tick marks in original pixel values,
+    axis labels, a title, and each object ID drawn at the centroid of its
+    mask. Everything except the frame, the object IDs and the title is
+    the same on every frame, so it is drawn once into a background
+    (the chrome) that each frame is copied into.
+
+    Methods
+    -------
+    __init__(self, width, height, orig_width, orig_height, colors, font_size=16, font_color="red", alpha=0.6)
+        Sets the layout and draws the chrome
+    render(self, image, mask_dict, title)
+        Renders one frame
+    """
+
+    def __init__(self, width, height, orig_width, orig_height, colors, font_size=16, font_color="red", alpha=0.6):
+        """
+        Sets the layout of the frames and draws the chrome.
+
+        Parameters
+        ----------
+        width : int
+            The width of the video
+        height : int
+            The height of the video
+        orig_width : int
+            The width of the frames before resizing
+        orig_height : int
+            The height of the frames before resizing
+        colors : list of tuples of ints
+            A list of tuples representing RGB colors for each segmentation mask
+        font_size : int
+            Font size for drawn object IDs
+        font_color : str or tuple of ints
+            Color of font for the drawn object IDs
+        alpha : float
+            Alpha value for the segmentation masks
+
+        Examples
+        --------
+        >>> renderer = FrameRenderer(900, 600, 1920, 1080, plot_utils.get_spaced_colors(100))
+        >>> frame = renderer.render(cv2.imread("00001.jpg"), mask_dict, "SAM2 frame: 0, Annotation frame: 0")
+        """
+
+        self.width = width
+        self.height = height
+        self.orig_width = orig_width
+        self.orig_height = orig_height
+        self.colors = np.array(colors, dtype=np.uint8)[:, ::-1]  # RGB to BGR
+        self.font_color = to_bgr(font_color)
+        self.alpha = alpha
+        self.id_font_scale = font_scale(font_size)
+
+        # The image keeps its aspect ratio and is centred in the axes, like matplotlib's imshow
+        axes_width = (SUBPLOT_RIGHT - SUBPLOT_LEFT) * width
+        axes_height = (SUBPLOT_TOP - SUBPLOT_BOTTOM) * height
+        self.scale = min(axes_width / width, axes_height / height)
+        self.image_width = int(round(width * self.scale))
+        self.image_height = int(round(height * self.scale))
+        self.left = int(round(SUBPLOT_LEFT * width + (axes_width - self.image_width) / 2))
+        self.top = int(round((1 - SUBPLOT_TOP) * height + (axes_height - self.image_height) / 2))
+
+        self.title_font_scale = font_scale(16)
+        self.chrome = self._draw_chrome()
+
+    def _draw_chrome(self):
+        """
+        Draws the white background, axes frame, ticks, tick labels and
+        axis labels shared by every frame.
+        """
+
+        chrome = np.full((self.height, self.width, 3), 255, dtype=np.uint8)
+        black = (0, 0, 0)
+        left, top = self.left, self.top
+        right, bottom = left + self.image_width, top + self.image_height
+
+        tick_length = int(round(points_to_pixels(3.5)))
+        pad = int(round(points_to_pixels(3.5)))
+        label_scale = font_scale(10)
+
+        # Axes frame just outside the image
+        cv2.rectangle(chrome, (left - 1, top - 1), (right, bottom), black, 1)
+
+        # 10 evenly spaced ticks, labelled with pixel values of the original frame
+        x_ticks = np.linspace(0, self.width, num=10)
+        x_labels = np.linspace(0, self.orig_width, num=10, dtype=int)
+        label_height = 0
+        for tick, label in zip(x_ticks, x_labels):
+            x = int(round(left + tick * self.scale))
+            cv2.line(chrome, (x, bottom), (x, bottom + tick_length), black, 1)
+            (text_width, text_height), _ = cv2.getTextSize(str(label), FONT, label_scale, 1)
+            label_height = max(label_height, text_height)
+            cv2.putText(chrome, str(label), (x - text_width // 2, bottom + tick_length + pad + text_height),
+                        FONT, label_scale, black, 1, cv2.LINE_AA)
+
+        y_ticks = np.linspace(0, self.height, num=10)
+        y_labels = np.linspace(0, self.orig_height, num=10, dtype=int)
+        label_width = 0
+        for tick, label in zip(y_ticks, y_labels):
+            y = int(round(top + tick * self.scale))
+            cv2.line(chrome, (left - tick_length - 1, y), (left - 1, y), black, 1)
+            (text_width, text_height), _ = cv2.getTextSize(str(label), FONT, label_scale, 1)
+            label_width = max(label_width, text_width)
+            cv2.putText(chrome, str(label), (left - tick_length - pad - text_width, y + text_height // 2),
+                        FONT, label_scale, black, 1, cv2.LINE_AA)
+
+        # Axis labels
+        axis_label = "Pixel value"
+        (text_width, text_height), baseline = cv2.getTextSize(axis_label, FONT, label_scale, 1)
+        label_pad = int(round(points_to_pixels(4)))
+        y = bottom + tick_length + pad + label_height + label_pad + text_height
+        if y + baseline < self.height:
+            cv2.putText(chrome, axis_label, ((left + right) // 2 - text_width // 2, y),
+                        FONT, label_scale, black, 1, cv2.LINE_AA)
+
+        # The y axis label is drawn horizontally, then rotated
+        text = np.full((text_height + baseline, text_width, 3), 255, dtype=np.uint8)
+        cv2.putText(text, axis_label, (0, text_height), FONT, label_scale, black, 1, cv2.LINE_AA)
+        text = np.ascontiguousarray(np.rot90(text))
+        x = left - tick_length - pad - label_width - label_pad - text.shape[1]
+        y = (top + bottom) // 2 - text.shape[0] // 2
+        if x >= 0 and y >= 0:
+            chrome[y:y + text.shape[0], x:x + text.shape[1]] = text
+
+        return chrome
+
+    def render(self, image, mask_dict, title):
+        """
+        Renders one frame: draws the masks in `mask_dict` on `image`,
+        places it in a copy of the chrome, and draws the object IDs at
+        the centroids of their masks and the title.
+
+        Parameters
+        ----------
+        image : numpy.ndarray
+            The frame as a (orig_height, orig_width, 3) BGR image, e.g.
+            read with `cv2.imread`
+        mask_dict : dict of numpy.ndarray
+            Dictionary with keys corresponding to object IDs and values
+            representing the mask of the object ID on this frame
+        title : str
+            The title drawn above the frame
+
+        Returns
+        -------
+        numpy.ndarray
+            The rendered frame as a (height, width, 3) BGR image
+        """
+
+        frame = self.chrome.copy()
+        size = (self.image_width, self.image_height)
+        region = cv2.resize(image, size, interpolation=cv2.INTER_LINEAR)
+
+        # Blend each mask into the resized frame, and find its centroid on the original frame
+        labels = []
+        for obj_id, mask in (mask_dict or {}).items():
+            mask = np.ascontiguousarray(mask, dtype=bool).view(np.uint8)
+            x, y, w, h = cv2.boundingRect(mask)
+            # Skip empty masks that occur
+            if w == 0:
+                continue
+
+            # Blend only inside the mask's bounding box, which is much smaller than the frame
+            small_mask = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+            x0, y0 = x * self.image_width // self.orig_width, y * self.image_height // self.orig_height
+            x1, y1 = -(-(x + w) * self.image_width // self.orig_width) + 1, -(-(y + h) * self.image_height // self.orig_height) + 1
+            crop = region[y0:y1, x0:x1]
+            blended = cv2.addWeighted(crop, 1 - self.alpha, np.broadcast_to(self.colors[obj_id], crop.shape).astype(np.uint8), self.alpha, 0)
+            np.copyto(crop, blended, where=small_mask[y0:y1, x0:x1, None].astype(bool))
+
+            moments = cv2.moments(mask[y:y + h, x:x + w], binaryImage=True)
+            labels.append((obj_id, int(x + moments["m10"] / moments["m00"]), int(y + moments["m01"] / moments["m00"])))
+
+        frame[self.top:self.top + self.image_height, self.left:self.left + self.image_width] = region
+
+        # Draw object IDs at their centroids, scaled to the displayed frame
+        for obj_id, centroid_x, centroid_y in labels:
+            x = int(round(self.left + centroid_x * self.image_width / self.orig_width))
+            y = int(round(self.top + centroid_y * self.image_height / self.orig_height))
+            cv2.putText(frame, str(obj_id), (x, y), FONT, self.id_font_scale, self.font_color, 1, cv2.LINE_AA)
+
+        # Title centred above the axes
+        (text_width, _), baseline = cv2.getTextSize(title, FONT, self.title_font_scale, 1)
+        x = self.left + self.image_width // 2 - text_width // 2
+        y = self.top - int(round(points_to_pixels(6))) - baseline
+        cv2.putText(frame, title, (max(x, 0), y), FONT, self.title_font_scale, (0, 0, 0), 1, cv2.LINE_AA)
+
+        return frame
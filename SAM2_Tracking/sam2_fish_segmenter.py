@@ -5,10 +5,20 @@ import os
 import sys 
 import torch 
 import numpy as np 
+import cv2
 import pandas as pd 
-import pickle 
+from PIL import Image
+import mask_utils
+import video_utils
+from feature_cache import FeatureCache
+import time
+import threading
+import sam2.sam2_video_predictor
 from sam2.build_sam import build_sam2_video_predictor
 
+# Serializes the swap of SAM2's module-level load_video_frames in set_inference_state across threads
+_load_video_frames_lock = threading.Lock()
+
 
 class SAM2FishSegmenter:
     """
@@ -17,22 +27,47 @@ class SAM2FishSegmenter:
     inference state, add annotations, and run the propagation of the 
     segmentation through a provided video. 
 
+    The predictor model is loaded once in `__init__` and can be reused 
+    for further trials that use the same model by calling `set_configs` 
+    before `run_propagation`, so only the inference state is rebuilt 
+    per trial.
+
     Methods
     -------
     __init__(self, configs, device)
         Initializes the predictor model and sets `self.configs`
+    set_configs(self, configs)
+        Sets `self.configs` for a new trial, keeping the loaded predictor
+    set_cpu_options(self)
+        Sets the thread count and data type for running on the CPU
+    enable_feature_cache(self)
+        Caches the image encoder features of frames across passes, 
+        trials and reruns
+    uses_same_model(self, configs)
+        Checks whether `configs` can reuse the loaded predictor
+    set_frame_source(self)
+        Sets where the frames are read from, JPGs or the video
+    read_frames(self, image_size)
+        Yields each frame, and the frame resized for SAM2
+    load_video_frames(self, image_size, offload_video_to_cpu, img_mean, img_std, compute_device)
+        Loads the frames in the format of SAM2's `load_video_frames`, 
+        storing them in `self.frame_array_path` if it is set
     set_inference_state(self)
-        Obtains the inference state for `self.predictor` and 
-        sets `self.frame_paths`
+        Obtains the inference state for `self.predictor`
     add_annotations(self, annotations)
         Adds provided annotations to predictor
-    run_propagation(self)
+    run_propagation(self, stream)
         Propagates the prompts to get the masklet across the video using the 
-        class predictor and inference state. Additionally, creates a pickle
-        file composed of sparse tensors representing the generated masks for 
-        each video frame.
+        class predictor and inference state. Additionally, creates a mask
+        file (see `mask_utils.MaskWriter`) representing the generated masks 
+        for each video frame, and optionally streams the masks to a renderer.
     """  
 
+    # Configuration keys that determine the loaded predictor model and its data type
+    MODEL_CONFIG_KEYS = ["sam2_install_dir", "model_cfg", "sam2_checkpoint", "non_overlap_masks", 
+                         "cpu_dtype", "cpu_threads", "feature_cache_memory_frames", "feature_cache_dir", 
+                         "feature_cache_disk_gb"]
+
     def __init__(self, configs=None, device=None):
         """
         Initializes the predictor model and sets `self.configs`.
@@ -50,7 +85,7 @@ class SAM2FishSegmenter:
         ValueError
             If `configs` is not a `str` or `dict`. 
         RuntimeError
-            If `device.type` is not equal to `cuda`. 
+            If `device.type` is not `cuda` or `cpu`. 
 
         Examples
         --------
@@ -59,29 +94,25 @@ class SAM2FishSegmenter:
         >>> segmenter = SAM2FishSegmenter(configs=yaml_file_path, device=device)
         """
 
-        if isinstance(configs, str): 
-            # Read and load the configuration YAML
-            self.configs = utils.read_config_yaml(configs)
-            # TODO: a routine for checking the provided configs should be ran
-
-        elif isinstance(configs, dict):
-            # Set class variable configs to the provided dict
-            self.configs = configs
-            # TODO: a routine for checking the provided configs should be ran
-
-        else:
-            raise TypeError("configs was not a str or dict!")
+        self.set_configs(configs)
+        self.inference_state = None
+        self.frame_source = None
+        self.frame_paths = None
+        self.frame_array_path = None
 
         # TODO: determine if this is the best place to put this, might be worth removing
         # Append install directory so we can use sam2_checkpoints and model configurations 
         sys.path.append(self.configs["sam2_install_dir"])
 
         # Set appropriate data types for SAM2
+        self.device = device
         if device.type == "cuda":
             torch.autocast("cuda", dtype=torch.bfloat16).__enter__()
             if torch.cuda.get_device_properties(0).major >= 8:
                 torch.backends.cuda.matmul.allow_tf32 = True
                 torch.backends.cudnn.allow_tf32 = True
+        elif device.type == "cpu":
+            self.set_cpu_options()
         else:
             raise RuntimeError(f"Device of type {device.type} not supported!")  
 
@@ -91,35 +122,371 @@ class SAM2FishSegmenter:
         self.predictor = build_sam2_video_predictor(self.configs["model_cfg"], ckpt_path=self.configs["sam2_checkpoint"], 
                                                     device=device, non_overlap_masks=self.configs["non_overlap_masks"])
 
-    def set_inference_state(self):
+        # Cache image encoder features, if a cache tier is configured
+        self.feature_cache = None
+        if self.configs.get("feature_cache_memory_frames") or self.configs.get("feature_cache_dir"):
+            self.enable_feature_cache()
+
+    def set_cpu_options(self):
         """
-        Obtains the inference state for `self.predictor` for a provided 
-        video path (specified by `self.configs["frame_dir"]`) and sets 
-        it as `self.inference_state`. Additionally, sets 
-        `self.frame_paths`, which are all of the JPG paths representing 
-        the frames.
+        Sets the number of intra-op threads and the data type used when 
+        running SAM2 on the CPU, as specified by `self.configs["cpu_threads"]` 
+        and `self.configs["cpu_dtype"]`. A `cpu_dtype` of `bfloat16` enables 
+        bfloat16 autocast, which is only fast on CPUs with native bfloat16 
+        support (AVX512 or AMX); on other CPUs float32 is used instead.
 
         Raises
         ------
         ValueError
-            If `self.configs["frame_dir"]` was not of type `str`. 
+            If `self.configs["cpu_dtype"]` is not `float32` or `bfloat16`. 
 
         Examples
         --------
-        >>> segmenter.set_inference_state()
+        >>> segmenter.set_cpu_options()
+        """
+
+        # Use all physical cores by default, otherwise the configured thread count
+        cpu_threads = self.configs.get("cpu_threads")
+        if cpu_threads:
+            torch.set_num_threads(int(cpu_threads))
+
+        cpu_dtype = self.configs.get("cpu_dtype", "float32")
+        if cpu_dtype == "bfloat16":
+            cpu_capability = torch.backends.cpu.get_cpu_capability()
+            if "AVX512" in cpu_capability or "AMX" in cpu_capability:
+                torch.autocast("cpu", dtype=torch.bfloat16).__enter__()
+            else:
+                print(f"Warning: CPU capability {cpu_capability} has no native bfloat16 support, using float32.")
+        elif cpu_dtype != "float32":
+            raise ValueError(f"cpu_dtype {cpu_dtype} not supported!")
+
+        print(f"Running SAM2 on CPU with {torch.get_num_threads()} threads")
+
+    def enable_feature_cache(self):
+        """
+        Caches the image encoder features of frames in a `FeatureCache`, 
+        sized by `self.configs["feature_cache_memory_frames"]`, 
+        `self.configs["feature_cache_dir"]` and 
+        `self.configs["feature_cache_disk_gb"]`. The predictor's 
+        `_get_image_feature` is wrapped so cached features are placed in 
+        the inference state's own feature cache before SAM2 looks for 
+        them, which skips the image encoder, and newly encoded features 
+        are added to the cache.
+
+        Examples
+        --------
+        >>> segmenter.enable_feature_cache()
         """
 
-        if not isinstance(self.configs["frame_dir"], str): 
-            raise TypeError(f"config frame_dir was not of type str!")
+        # Features depend on the model weights, the image size and the data type they were computed in
+        checkpoint = self.configs["sam2_checkpoint"]
+        model_key = ":".join(str(value) for value in [self.configs["model_cfg"], checkpoint, os.path.getmtime(checkpoint), 
+                                                      self.predictor.image_size, self.device.type, 
+                                                      self.configs.get("cpu_dtype")])
+        self.feature_cache = FeatureCache(model_key, memory_frames=self.configs.get("feature_cache_memory_frames") or 0, 
+                                          cache_dir=self.configs.get("feature_cache_dir") or None, 
+                                          disk_gb=self.configs.get("feature_cache_disk_gb") or 20)
+        self.feature_cache_hits, self.feature_cache_misses = 0, 0
+        self._frame_keys = {}
+
+        # ref: https://github.com/facebookresearch/sam2/blob/2b90b9f5ceec907a1c18123530e92e794ad901a4/sam2/sam2_video_predictor.py#L840
+        get_image_feature = self.predictor._get_image_feature
+
+        def cached_get_image_feature(inference_state, frame_idx, batch_size):
+            # SAM2 only keeps the features of the most recent frame in the inference state
+            if frame_idx in inference_state["cached_features"]:
+                return get_image_feature(inference_state, frame_idx, batch_size)
+
+            if frame_idx not in self._frame_keys:
+                if self.frame_source is not None:
+                    self._frame_keys[frame_idx] = self.feature_cache.frame_key(frame_id=self.frame_source.frame_id(frame_idx))
+                else:
+                    self._frame_keys[frame_idx] = self.feature_cache.frame_key(self.frame_paths[frame_idx])
+            key = self._frame_keys[frame_idx]
+
+            backbone_out = self.feature_cache.get(key, inference_state["device"])
+            if backbone_out is not None:
+                self.feature_cache_hits += 1
+                image = inference_state["images"][frame_idx].to(inference_state["device"]).float().unsqueeze(0)
+                inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
+                return get_image_feature(inference_state, frame_idx, batch_size)
+
+            self.feature_cache_misses += 1
+            result = get_image_feature(inference_state, frame_idx, batch_size)
+            self.feature_cache.put(key, inference_state["cached_features"][frame_idx][1])
+            return result
+
+        self.predictor._get_image_feature = cached_get_image_feature
+
+    def set_configs(self, configs=None):
+        """
+        Sets `self.configs`. Called by `__init__`, and again for each 
+        further trial that reuses the loaded predictor.
+
+        Parameters
+        ----------
+        configs : dict or str
+            A dictionary of configurations or a yaml file 
+            specifying configurations
+
+        Raises
+        ------
+        ValueError
+            If `configs` is not a `str` or `dict`. 
+        ValueError
+            If the predictor is already loaded and `configs` requires 
+            a different model. 
+
+        Examples
+        --------
+        >>> segmenter.set_configs(configs=trial_config)
+        """
+
+        if isinstance(configs, str): 
+            # Read and load the configuration YAML
+            configs = utils.read_config_yaml(configs)
+
+        elif not isinstance(configs, dict):
+            raise TypeError("configs was not a str or dict!")
+
+        # TODO: a routine for checking the provided configs should be ran
+
+        if hasattr(self, "predictor") and not self.uses_same_model(configs):
+            raise ValueError("configs require a different SAM2 model, create a new SAM2FishSegmenter instead!")
+
+        # Set class variable configs to the provided dict
+        self.configs = configs
+
+    def uses_same_model(self, configs=None):
+        """
+        Checks whether `configs` specify the same predictor model as 
+        `self.configs`, i.e., whether the loaded predictor can be reused.
+
+        Parameters
+        ----------
+        configs : dict
+            A dictionary of configurations
+
+        Returns
+        -------
+        bool
+            True if all `MODEL_CONFIG_KEYS` values match
+
+        Examples
+        --------
+        >>> segmenter.uses_same_model(configs=trial_config)
+        True
+        """
 
-        # Gather all the JPG paths representing the frames 
-        self.frame_paths = utils.get_jpg_paths(self.configs["frame_dir"])
+        return all(self.configs.get(key) == configs.get(key) for key in self.MODEL_CONFIG_KEYS)
+
+    def set_frame_source(self):
+        """
+        Sets where the frames of the trial are read from. With 
+        `self.configs["frame_source"]` set to `video`, frames are decoded 
+        straight from `self.configs["video_path"]` by a 
+        `video_utils.VideoFrameSource`, sampled by `fps`, `out_fps` and 
+        `SAM2_start` and optionally cached decoded in 
+        `self.configs["frame_cache_dir"]`, and set as `self.frame_source`. 
+        Otherwise, frames are read from the JPGs in 
+        `self.configs["frame_dir"]`, whose paths are set as 
+        `self.frame_paths`. Also sets `self.frame_count`.
+
+        Raises
+        ------
+        TypeError
+            If `self.configs["frame_dir"]` was not of type `str` when 
+            reading frames from JPGs. 
+        ValueError
+            If `self.configs["frame_source"]` is not `jpg` or `video`. 
+
+        Examples
+        --------
+        >>> segmenter.set_frame_source()
+        """
+
+        frame_source = self.configs.get("frame_source") or "jpg"
+        self.frame_source = None
+        self.frame_paths = None
+
+        if frame_source == "video":
+            self.frame_source = video_utils.VideoFrameSource(self.configs["video_path"], fps=self.configs["fps"], 
+                                                             out_fps=self.configs["out_fps"], SAM2_start=self.configs["SAM2_start"], 
+                                                             cache_dir=self.configs.get("frame_cache_dir") or None)
+            self.frame_count = len(self.frame_source)
+        elif frame_source == "jpg":
+            if not isinstance(self.configs["frame_dir"], str): 
+                raise TypeError(f"config frame_dir was not of type str!")
+
+            # Gather all the JPG paths representing the frames 
+            self.frame_paths = utils.get_jpg_paths(self.configs["frame_dir"])
+            self.frame_count = len(self.frame_paths)
+        else:
+            raise ValueError(f"frame_source must be 'jpg' or 'video', got '{frame_source}'.")
+
+    def read_frames(self, image_size):
+        """
+        Yields every frame of the trial in order, along with the frame 
+        resized for SAM2. Frames decoded from the video are resized with 
+        OpenCV, while JPGs are read and resized with PIL exactly as 
+        SAM2's own loader does.
+
+        Parameters
+        ----------
+        image_size : int
+            The size SAM2 resizes frames to
+
+        Yields
+        ------
+        frame_idx : int
+            The SAM2 frame index
+        frame : numpy.ndarray
+            The frame as a BGR image
+        image : numpy.ndarray
+            The frame as an (image_size, image_size, 3) RGB image
+        """
+
+        if self.frame_source is not None:
+            for frame_idx, frame in self.frame_source.frames():
+                image = cv2.cvtColor(cv2.resize(frame, (image_size, image_size), interpolation=cv2.INTER_CUBIC), cv2.COLOR_BGR2RGB)
+                yield frame_idx, frame, image
+            return
+
+        # ref: https://github.com/facebookresearch/sam2/blob/2b90b9f5ceec907a1c18123530e92e794ad901a4/sam2/utils/misc.py
+        for frame_idx, frame_path in enumerate(self.frame_paths):
+            with Image.open(frame_path) as image:
+                image = image.convert("RGB")
+            yield frame_idx, np.asarray(image)[:, :, ::-1], np.array(image.resize((image_size, image_size)))
+
+    def load_video_frames(self, image_size, offload_video_to_cpu, img_mean=(0.485, 0.456, 0.406), 
+                          img_std=(0.229, 0.224, 0.225), compute_device=torch.device("cuda"), **kwargs):
+        """
+        Loads the frames of the trial (see `read_frames`), resized and 
+        normalized in the same way as SAM2's `load_video_frames` loads 
+        JPGs, which it replaces while `set_inference_state` initializes 
+        the state. If `self.frame_array_path` is set, the frames are also 
+        stored, at their original size, in a memory-mapped `.npy` array 
+        at that path, which other processes can read without decoding 
+        the frames again.
+
+        Parameters
+        ----------
+        image_size : int
+            The size SAM2 resizes frames to
+        offload_video_to_cpu : bool
+            Whether to keep the frames on the CPU
+        img_mean : tuple of floats
+            The mean of each color channel the frames are normalized with
+        img_std : tuple of floats
+            The standard deviation of each color channel the frames are 
+            normalized with
+        compute_device : torch.device
+            The device frames are moved to unless `offload_video_to_cpu`
+
+        Returns
+        -------
+        images : torch.Tensor
+            (frames, 3, image_size, image_size) tensor of the frames
+        video_height : int
+            The height of the video
+        video_width : int
+            The width of the video
+
+        Raises
+        ------
+        RuntimeError
+            If there are no frames
+        """
+
+        if self.frame_count == 0:
+            frames_from = self.frame_source.video_path if self.frame_source is not None else self.configs["frame_dir"]
+            raise RuntimeError(f"No frames found in: {frames_from}.")
+
+        # ref: https://github.com/facebookresearch/sam2/blob/2b90b9f5ceec907a1c18123530e92e794ad901a4/sam2/utils/misc.py#L230
+        images = torch.zeros(self.frame_count, 3, image_size, image_size, dtype=torch.float32)
+        video_height, video_width = 0, 0
+        frame_array = None
+        decoded = 0
+        for frame_idx, frame, image in self.read_frames(image_size):
+            video_height, video_width = frame.shape[:2]
+            images[frame_idx] = torch.from_numpy(image).permute(2, 0, 1).float() / 255.0
+            if self.frame_array_path is not None:
+                if frame_array is None:
+                    frame_array = np.lib.format.open_memmap(self.frame_array_path, mode="w+", dtype=np.uint8, 
+                                                            shape=(self.frame_count,) + frame.shape)
+                frame_array[frame_idx] = frame
+            decoded += 1
+
+        if frame_array is not None:
+            frame_array.flush()
+            del frame_array
+
+        if decoded < self.frame_count:
+            print(f"Warning: the video ended early, the last {self.frame_count - decoded} frame(s) "
+                  f"of {self.frame_source.video_path} are blank.")
+
+        img_mean = torch.tensor(img_mean, dtype=torch.float32)[:, None, None]
+        img_std = torch.tensor(img_std, dtype=torch.float32)[:, None, None]
+        if not offload_video_to_cpu:
+            images = images.to(compute_device)
+            img_mean = img_mean.to(compute_device)
+            img_std = img_std.to(compute_device)
+        images -= img_mean
+        images /= img_std
+
+        return images, video_height, video_width
+
+    def set_inference_state(self):
+        """
+        Obtains the inference state for `self.predictor` for the frames 
+        set by `set_frame_source`, i.e. the JPGs in 
+        `self.configs["frame_dir"]` or frames decoded from 
+        `self.configs["video_path"]`, and sets it as 
+        `self.inference_state`. SAM2 loads the JPGs itself, unless 
+        `self.frame_array_path` is set, in which case they are loaded by 
+        `load_video_frames` to also store them in the frame array.
+
+        SAM2's `init_state` has no way to pass in frames, so while it 
+        runs, the `load_video_frames` of the SAM2 module is swapped for 
+        this class's. The swap affects the whole process, so every call 
+        to `init_state` is held under a lock, and `async_loading_frames` 
+        does not apply to frames loaded by this class.
+
+        Examples
+        --------
+        >>> segmenter.set_frame_source()
+        >>> segmenter.set_inference_state()
+        """
+
+        # Release the previous trial's state before loading the new frames 
+        self.inference_state = None
+        self._frame_keys = {}
 
         # ref: https://github.com/facebookresearch/sam2/blob/2b90b9f5ceec907a1c18123530e92e794ad901a4/sam2/sam2_video_predictor.py#L42
-        self.inference_state = self.predictor.init_state(video_path=self.configs["frame_dir"], 
-                                                         offload_video_to_cpu=self.configs["offload_video_to_cpu"], 
-                                                         offload_state_to_cpu=self.configs["offload_state_to_cpu"], 
-                                                         async_loading_frames=self.configs["async_loading_frames"])
+        if self.frame_source is None and self.frame_array_path is None:
+            # Held so another thread's swapped load_video_frames is never used for these JPGs
+            with _load_video_frames_lock:
+                self.inference_state = self.predictor.init_state(video_path=self.configs["frame_dir"], 
+                                                                 offload_video_to_cpu=self.configs["offload_video_to_cpu"], 
+                                                                 offload_state_to_cpu=self.configs["offload_state_to_cpu"], 
+                                                                 async_loading_frames=self.configs["async_loading_frames"])
+            return
+
+        if self.configs.get("async_loading_frames"):
+            print("Warning: async_loading_frames is ignored when frames are decoded from the video or kept for "
+                  "rendering, all frames are loaded before propagation.")
+
+        # init_state loads frames with the module's load_video_frames, which is swapped for this class's
+        video_path = self.configs["video_path"] if self.frame_source is not None else self.configs["frame_dir"]
+        with _load_video_frames_lock:
+            load_video_frames = sam2.sam2_video_predictor.load_video_frames
+            sam2.sam2_video_predictor.load_video_frames = lambda video_path, **kwargs: self.load_video_frames(**kwargs)
+            try:
+                self.inference_state = self.predictor.init_state(video_path=video_path, 
+                                                                 offload_video_to_cpu=self.configs["offload_video_to_cpu"], 
+                                                                 offload_state_to_cpu=self.configs["offload_state_to_cpu"])
+            finally:
+                sam2.sam2_video_predictor.load_video_frames = load_video_frames
 
 
     def add_annotations(self, annotations=None):
@@ -167,33 +534,38 @@ class SAM2FishSegmenter:
                 labels=labels,
             )
 
-    def get_masks(self, frame_masks=None, start_frame_idx=None, max_frame_num_to_track=None):
+    def get_masks(self, mask_writer=None, start_frame_idx=None, max_frame_num_to_track=None, obj_windows=None, 
+                  stream=None, final_before=None):
         """
         Propagates the prompts to get the masklet across the video using the 
-        class predictor and inference state. Modifies the frame key of 
-        `frame_masks` by adding a dictionary key corresponding to the `obj_id` 
-        with value as a sparse tensor representing the mask. 
+        class predictor and inference state. Adds the mask of each `obj_id` 
+        on each propagated frame to `mask_writer`, clipped to the object's 
+        own window when several objects are propagated jointly. 
+
+        With `stream`, the masks are also passed to the stream, and each 
+        propagated frame before `final_before`, which no later pass 
+        covers, is rendered as soon as its masks are added.
 
         Parameters
         ----------
-        frame_masks : dict of dict 
-            A dict where keys correspond to the frame number and values 
-            are a dict with keys corresponding to object ids and values 
-            are sparse tensors representing masks
+        mask_writer : mask_utils.MaskWriter
+            The writer storing the masks of every frame
         start_frame_idx : None or int
             The start frame for SAM2 `propagate_in_video`
         max_frame_num_to_track : None or int 
             The number of frames to track for SAM2 `propagate_in_video`
-
-        Returns
-        -------
-        dict or None 
-            A modified `frame_masks` with appropriate masks added
+        obj_windows : None or dict of tuples of ints
+            If given, the `(enter_frame, exit_frame)` of each object ID, 
+            masks outside of which are not stored
+        stream : utils.StreamingVideoRenderer or None
+            The renderer the masks are streamed to, if any
+        final_before : None or int
+            The first frame whose masks later passes may still add to
 
         Examples
         --------
-        >>> segmenter.run_propagation(frame_masks=my_masks, start_frame_idx=0, 
-                                      max_frame_num_to_track=100)
+        >>> segmenter.get_masks(mask_writer=writer, start_frame_idx=0, 
+                                max_frame_num_to_track=100)
         """
 
         # Perform prediction of masklets across video frames 
@@ -202,30 +574,68 @@ class SAM2FishSegmenter:
                                                                                              start_frame_idx=start_frame_idx, 
                                                                                              max_frame_num_to_track=max_frame_num_to_track):
 
+            self.propagated_frame_count += 1
+
             # Create Bool mask and delete unneeded tensor
             bool_masks = out_mask_logits > 0.0
             del out_mask_logits
 
-            # There's an extra dimension (1) to the masks, remove it
-            bool_masks = bool_masks.squeeze(1)
+            # There's an extra dimension (1) to the masks, remove it, and 
+            # move the masks of all objects to the CPU in a single transfer
+            bool_masks = bool_masks.squeeze(1).cpu().numpy()
 
-            # Convert mask tensor to sparse format and store it
-            for obj_id in out_obj_ids:
-                frame_masks[out_frame_idx][obj_id] = bool_masks.to_sparse().cpu()
+            # Store each object's own mask, in the same order as out_obj_ids
+            for i, obj_id in enumerate(out_obj_ids):
+                if obj_windows is not None and not obj_windows[obj_id][0] <= out_frame_idx <= obj_windows[obj_id][1]:
+                    continue
+                mask_writer.add(out_frame_idx, obj_id, bool_masks[i])
+                if stream is not None:
+                    stream.add_mask(out_frame_idx, obj_id, bool_masks[i])
 
-        return frame_masks
+            # Frames up to this one are final, unless a later pass starts before them
+            if stream is not None:
+                stream.render_until(min(out_frame_idx + 1, final_before))
 
-    def run_propagation(self):
+    @torch.inference_mode()
+    def run_propagation(self, stream=None):
         """
         Runs entire workflow: setting the inference state,
         collecting and adding annotations, getting SAM2
         provided masks, and saving masks. This function 
         expects annotations that have `labels_name` with 
         enter and exit values of 3 and 4, respectively.
+        Prints the propagation throughput in frames per second.
+
+        The masks of each object chunk are committed to the mask file 
+        as soon as the chunk finishes, and recorded in a 
+        `mask_utils.MaskManifest`. When rerun, e.g. after a crash or 
+        after the annotations file was edited, chunks whose object, 
+        enter and exit frames and annotations are unchanged are skipped, 
+        so only new or changed chunks are recomputed.
+
+        Chunks of different objects whose windows overlap are propagated 
+        jointly, up to `self.configs["max_objects_per_pass"]` objects per 
+        pass, so frames shared by several objects are only encoded once 
+        per pass. The number of encoded frames is printed along with the 
+        number a separate pass per chunk would have needed.
+
+        With `stream`, the frames loaded for the inference state are kept 
+        in the stream's frame array and the masks are streamed to it, so 
+        the output video is rendered during propagation. Passes are 
+        ordered by their first frame, so the masks of every frame before 
+        the next pass's first frame are final once the current pass has 
+        propagated it. Masks of chunks committed by an earlier run are 
+        only in the mask file, so in that case nothing is streamed and 
+        `stream.started` stays False.
+
+        Parameters
+        ----------
+        stream : utils.StreamingVideoRenderer or None
+            The renderer the masks are streamed to, if any
         """
 
-        # Set inference state for SAM2
-        self.set_inference_state()
+        # Gather the frames from the JPGs or the video
+        self.set_frame_source()
 
         # Get keys in annotations that will become DataFrame columns
         df_columns = [self.configs["frame_idx_name"], self.configs["labels_name"], 
@@ -241,38 +651,107 @@ class SAM2FishSegmenter:
                                                                   frame_name=self.configs["frame_idx_name"], 
                                                                   click_type_name=self.configs["labels_name"])
 
-        # Initialize dictionary of masks for each frame
-        frame_masks = {key: {} for key in range(len(self.frame_paths))}
-
+        # Collect the annotations of each chunk, keyed by everything the chunk's masks depend on
+        chunks = {}
         for index, row in obj_frame_chunks.iterrows():
 
-            # Get the enter, exit, and number of frames for obj label 
+            # Get the enter and exit frames for obj label 
             enter_frame = row['EnterFrame']
             exit_frame = row['ExitFrame']
-            num_frames = exit_frame - enter_frame
 
             # Get all of the annotations for the given object label
             obj_annotation = annotations.loc[row[self.configs["obj_id_name"]]]
 
-            # Get all chunks where annotation Frame values are between enter_frame and exit_frame inclusive 
-            chunk = (obj_annotation[self.configs["frame_idx_name"]] >= enter_frame) & (obj_annotation[self.configs["frame_idx_name"]] <= exit_frame)
-
             # Get annotation chunk 
             if isinstance(obj_annotation, pd.Series):
                 # Convert Series to a DataFrame with correct columns
                 annotation_chunk = obj_annotation.to_frame().T
             else:
+                # Get all chunks where annotation Frame values are between enter_frame and exit_frame inclusive 
+                chunk = (obj_annotation[self.configs["frame_idx_name"]] >= enter_frame) & (obj_annotation[self.configs["frame_idx_name"]] <= exit_frame)
                 annotation_chunk = obj_annotation[chunk]
 
+            chunk_info = {"obj_id": row[self.configs["obj_id_name"]], "enter_frame": int(enter_frame), "exit_frame": int(exit_frame)}
+            key = mask_utils.MaskManifest.chunk_key({**chunk_info, "annotations": annotation_chunk.to_dict("records")})
+            chunks[key] = (chunk_info, annotation_chunk)
+
+        # Load the record of chunks committed by earlier runs with the same model and frames
+        settings = {key: self.configs.get(key) for key in self.MODEL_CONFIG_KEYS + ["frame_dir", "max_objects_per_pass"]}
+        settings.update(frame_count=self.frame_count, device_type=self.device.type)
+        if self.frame_source is not None:
+            settings.update(frame_source=self.frame_source.frame_id(0))
+        manifest = mask_utils.MaskManifest(self.configs["masks_dict_file"], settings)
+        manifest.keep(chunks)
+        pending = [key for key in chunks if not manifest.is_complete(key)]
+        print(f"{len(chunks) - len(pending)} of {len(chunks)} chunk(s) already complete, propagating {len(pending)}")
+
+        # Initialize the writer streaming the masks of each frame to disk, after the committed chunks if there are any
+        mask_writer = mask_utils.MaskWriter(self.configs["masks_dict_file"], frame_count=self.frame_count, 
+                                            resume_offset=manifest.committed_end if manifest.chunks else None)
+
+        # Streaming needs every frame's masks, so it is skipped if earlier runs committed some of them
+        if stream is not None and (manifest.chunks or not pending):
+            stream = None
+        self.frame_array_path = stream.frame_array_path if stream is not None else None
+
+        # Set inference state for SAM2, only if there is anything to propagate
+        if pending:
+            self.set_inference_state()
+
+        # Group the chunks left to propagate into joint passes of overlapping chunks
+        passes = utils.get_propagation_passes([(key, chunks[key][0]["obj_id"], chunks[key][0]["enter_frame"], chunks[key][0]["exit_frame"]) 
+                                               for key in pending], self.configs.get("max_objects_per_pass", 1))
+
+        # Count frames propagated across all passes for the throughput report, 
+        # each is one run of the image encoder
+        self.propagated_frame_count = 0
+        self.feature_cache_hits, self.feature_cache_misses = 0, 0
+        chunk_frame_count = sum(chunks[key][0]["exit_frame"] - chunks[key][0]["enter_frame"] + 1 for key in pending)
+        start = time.perf_counter()
+
+        # First frame of each pass, followed by the frame count, as frames before the next pass's first frame are final
+        pass_starts = [min(chunks[key][0]["enter_frame"] for key in pass_keys) for pass_keys in passes] + [self.frame_count]
+        if stream is not None:
+            stream.render_until(pass_starts[0])
+
+        for pass_idx, pass_keys in enumerate(passes):
+            chunk_infos = [chunks[key][0] for key in pass_keys]
+            pass_start = pass_starts[pass_idx]
+            pass_end = max(chunk_info["exit_frame"] for chunk_info in chunk_infos)
+
             # Reset inference state for the new incoming annotations 
             self.predictor.reset_state(self.inference_state)   
 
-            # Add point annotations for provided annotation chunk 
-            self.add_annotations(annotations=annotation_chunk)
-
-            # Run propagation on chunk of annotated frames
-            frame_masks = self.get_masks(frame_masks=frame_masks, start_frame_idx=enter_frame, max_frame_num_to_track=num_frames)
-
-        # Save frame_masks as pkl file 
-        with open(self.configs["masks_dict_file"], "wb") as file:
-                pickle.dump(frame_masks, file)
+            # Add point annotations for the annotation chunks of every object in the pass 
+            self.add_annotations(annotations=pd.concat([chunks[key][1] for key in pass_keys]))
+
+            # Run propagation over the union of the chunks, keeping each object's masks within its own chunk
+            obj_windows = {int(chunk_info["obj_id"]): (chunk_info["enter_frame"], chunk_info["exit_frame"]) 
+                           for chunk_info in chunk_infos}
+            pass_offset = mask_writer.tell()
+            self.get_masks(mask_writer=mask_writer, start_frame_idx=pass_start, 
+                           max_frame_num_to_track=pass_end - pass_start, obj_windows=obj_windows, 
+                           stream=stream, final_before=pass_starts[pass_idx + 1])
+
+            # Durably write the pass's masks before recording its chunks as complete
+            committed_end = mask_writer.commit()
+            for key in pass_keys:
+                manifest.commit(key, chunks[key][0], pass_offset, committed_end)
+
+            # Frames between the end of this pass and the start of the next are final too
+            if stream is not None:
+                stream.render_until(pass_starts[pass_idx + 1])
+
+        elapsed = time.perf_counter() - start
+        print(f"Propagated {self.propagated_frame_count} frames in {elapsed:.1f} s "
+              f"({self.propagated_frame_count / max(elapsed, 1e-9):.2f} frames/s on {self.device.type})")
+        if passes:
+            print(f"Encoded {self.propagated_frame_count} frames in {len(passes)} pass(es) for {len(pending)} chunk(s) "
+                  f"spanning {chunk_frame_count} frames ({chunk_frame_count / max(self.propagated_frame_count, 1):.2f}x fewer)")
+            if self.feature_cache is not None:
+                print(f"Feature cache: {self.feature_cache_hits} hit(s) skipped the image encoder, {self.feature_cache_misses} miss(es)")
+
+        # Save the masks to the mask file, indexing only the records of current chunks
+        mask_writer.close(keep_records=manifest.records())
+        if self.frame_source is not None:
+            self.frame_source.close()
@@ -0,0 +1,13 @@
+import torch
+import utils
+
+# Specify the path to the configuration YAML file
+config_file = "./template_configs.yaml"
+
+# Guarded so the rendering worker processes of run_segmentation_and_rendering can import this script
+if __name__ == "__main__":
+    # Set device for PyTorch
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # Segment each trial and render its video while it is propagated
+    utils.run_segmentation_and_rendering(config_file, device)
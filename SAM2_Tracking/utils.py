@@ -1,10 +1,13 @@
 import yaml 
 import glob
 import numpy as np  
+import torch
 import os  
 import plot_utils
+import render_utils
+import video_utils
+import mask_utils
 from torchvision.io import decode_image
-from torchvision.utils import draw_segmentation_masks
 from torchvision import transforms
 from PIL import Image, ImageDraw, ImageFont
 from pathlib import Path
@@ -12,8 +15,15 @@ import cv2
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import pandas as pd 
-import pickle
+import time
+import tempfile
+import multiprocessing
+import queue
+from collections import deque
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from sam2_fish_segmenter import SAM2FishSegmenter
+from frame_utils import FrameMapping
 
 def read_config_yaml(config_path):
     """
@@ -179,6 +189,63 @@ def get_trial_config(configs, i):
             trial_config[key] = value
     return trial_config
 
+def run_frame_extraction(config_file):
+    """
+    Extracts the frames ingested by SAM2 from the video of one or more trials.
+
+    This function reads a YAML configuration file and, for each trial, extracts 
+    the SAM2 frames of `video_path` to JPGs in `frame_dir` using 
+    `video_utils.extract_frames`, sampling the video with the same `fps`, 
+    `out_fps` and `SAM2_start` values used to adjust the annotations. 
+    `extraction_workers` trials are extracted at the same time, each writing 
+    JPGs with `extraction_threads` threads. Frames already extracted are skipped, 
+    so rerunning the extraction only writes missing frames.
+
+    Parameters
+    ----------
+    config_file : str
+        Path to the YAML configuration file. Each parameter should either be a 
+        scalar (applied to all trials) or a list of values (with one entry per trial).
+
+    Returns
+    -------
+    None
+        The function does not return anything explicitly. However, it saves the 
+        frames of each trial as JPGs in the trial's `frame_dir`.
+
+    Examples
+    --------
+    >>> run_frame_extraction("template_configs.yaml")
+    Extracting frames for 2 trial(s)
+    Extracting 1520 of 1520 frames from /path/to/video1.MP4 to /path/to/frames/trial1
+    Extracting 980 of 980 frames from /path/to/video2.MP4 to /path/to/frames/trial2
+    """
+
+    # Load the YAML configuration file
+    configs = read_config_yaml(config_file)
+
+    # Retrieve trial count from the length of values provided for each configuration key
+    trial_count = extract_config_lens(configs)
+    print(f"Extracting frames for {trial_count} trial(s)")
+
+    def extract_trial(i):
+        trial_config = get_trial_config(configs, i)
+        return video_utils.extract_frames(
+            video_path=trial_config["video_path"],
+            frame_dir=trial_config["frame_dir"],
+            fps=trial_config["fps"],
+            out_fps=trial_config["out_fps"],
+            SAM2_start=trial_config["SAM2_start"],
+            jpg_quality=trial_config.get("jpg_quality") or 95,
+            threads=trial_config.get("extraction_threads") or 4
+            )
+
+    # Decoding and JPG encoding release the GIL, so trials are extracted in threads
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, configs.get("extraction_workers") or 1)) as pool:
+        written = sum(pool.map(extract_trial, range(trial_count)))
+    print(f"Extracted {written} frames in {time.perf_counter() - start:.1f} s")
+
 def run_segmentation(config_file, device):
     """
     Runs SAM2 segmentation and mask propagation for one or more trial configurations.
@@ -186,8 +253,16 @@ def run_segmentation(config_file, device):
     This function reads a YAML configuration file and processes it to extract 
     parameters for each trial. Each configuration parameter in the YAML file must 
     either be a single value (applied to all trials) or a list of values (one per trial). 
-    For each trial, the function initializes a `SAM2FishSegmenter` object with the appropriate 
-    configuration and executes the segmentation and propagation process.
+    The SAM2 model is loaded once into a `SAM2FishSegmenter` object and reused for every 
+    trial with the same model configuration; only the inference state is rebuilt per 
+    trial. The time spent loading models and running propagation is printed.
+
+    With `segmentation_workers` greater than 1, trials are run in parallel by that 
+    many worker processes, each loading its own model on the device assigned by 
+    `segmentation_devices` (see `get_worker_devices`). Idle workers take the next 
+    trial from a shared queue, so a worker that finishes a short trial starts 
+    another one instead of waiting. Trials that fail are reported together once 
+    every trial has finished.
 
     Parameters
     ----------
@@ -201,8 +276,8 @@ def run_segmentation(config_file, device):
     Returns
     -------
     None
-        The function does not return anything explicitly. However, it saves a pickled 
-        dictionary of masks (as specified by `masks_dict_file` in each trial config) 
+        The function does not return anything explicitly. However, it saves a mask 
+        file of masks (as specified by `masks_dict_file` in each trial config) 
         for each trial after segmentation and propagation.
 
     Notes
@@ -211,6 +286,9 @@ def run_segmentation(config_file, device):
       configuration file. All such parameters must have the same length.
     - The function uses `read_config_yaml`, `extract_config_lens`, and `get_trial_config` 
       as helpers in utils to parse and manage configurations.
+    - Worker processes are spawned, so scripts calling this function with 
+      `segmentation_workers` greater than 1 must guard it with 
+      `if __name__ == "__main__":`.
     
     Warnings
     --------
@@ -222,8 +300,12 @@ def run_segmentation(config_file, device):
     Examples
     --------
     >>> run_segmentation("template_configs.yaml", device=torch.device("cuda"))
-    Processing Trial 0: Frames from ./data/frames1, Annotations from ./data/annotations1.npy, Masks saving to ./generated_frame_masks1.pkl
-    Processing Trial 1: Frames from ./data/frames2, Annotations from ./data/annotations2.npy, Masks saving to ./generated_frame_masks2.pkl
+    Loaded SAM2 model configs/sam2.1/sam2.1_hiera_l.yaml in 6.2 s
+    Processing Trial 0: Frames from ./data/frames1, Annotations from ./data/annotations1.npy, Masks saving to ./generated_frame_masks1.masks
+    Trial 0 propagated in 41.3 s
+    Processing Trial 1: Frames from ./data/frames2, Annotations from ./data/annotations2.npy, Masks saving to ./generated_frame_masks2.masks
+    Trial 1 propagated in 38.7 s
+    Model loading: 6.2 s, propagation: 80.0 s
     """
     # Load the YAML configuration file
     configs = read_config_yaml(config_file)
@@ -232,14 +314,323 @@ def run_segmentation(config_file, device):
     trial_count = extract_config_lens(configs)
     print(f"Running segmentation for {trial_count} trial(s)")
 
-    # Iterate over each trial and extract configuration values
+    # More workers than trials would only load models that are never used
+    workers = min(configs.get("segmentation_workers") or 1, trial_count)
+    if workers <= 1:
+        # Iterate over each trial, reusing the loaded model between trials
+        segmenter = None
+        load_time, propagation_time = 0.0, 0.0
+        for i in range(trial_count): 
+            trial_config = get_trial_config(configs, i)
+            segmenter, trial_load_time, trial_propagation_time = segment_trial(segmenter, trial_config, i, device)
+            load_time += trial_load_time
+            propagation_time += trial_propagation_time
+
+        print(f"Model loading: {load_time:.1f} s, propagation: {propagation_time:.1f} s")
+        return
+
+    # Fan the trials out over worker processes, each taking the next trial from a shared queue when idle
+    devices = get_worker_devices(configs.get("segmentation_devices") or "auto", device, workers)
+    print(f"Running {workers} segmentation workers on: {', '.join(name for name, _ in devices)}")
+
+    # CUDA cannot be used in forked processes, so workers are spawned
+    context = multiprocessing.get_context("spawn")
+    task_queue, result_queue = context.Queue(), context.Queue()
+    for i in range(trial_count):
+        task_queue.put(i)
+    for _ in range(workers):
+        task_queue.put(None)
+
+    processes = [context.Process(target=segmentation_worker, args=(worker_id, device_name, cpu_cores, configs, task_queue, result_queue))
+                 for worker_id, (device_name, cpu_cores) in enumerate(devices)]
+    for process in processes:
+        process.start()
+
+    # Collect the result of each trial, stopping early if every worker died
+    start = time.perf_counter()
+    load_time, propagation_time = 0.0, 0.0
+    failed = {}
+    remaining = set(range(trial_count))
+    while remaining:
+        try:
+            i, worker_id, trial_load_time, trial_propagation_time, error = result_queue.get(timeout=5)
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                break
+            continue
+
+        remaining.discard(i)
+        load_time += trial_load_time
+        propagation_time += trial_propagation_time
+        if error is not None:
+            failed[i] = error
+
+    for process in processes:
+        process.join()
+
+    print(f"Model loading: {load_time:.1f} s, propagation: {propagation_time:.1f} s summed over workers, "
+          f"{time.perf_counter() - start:.1f} s wall time")
+
+    failed.update({i: "worker exited before finishing the trial" for i in remaining})
+    if failed:
+        raise RuntimeError("Segmentation failed for trial(s):\n" + "\n".join(f" - Trial {i}: {error}" for i, error in sorted(failed.items())))
+
+def segment_trial(segmenter, trial_config, i, device, stream=None):
+    """
+    Runs SAM2 segmentation and mask propagation for one trial, loading 
+    the model only if `segmenter` is None or uses a different model 
+    than `trial_config`, and prints the time spent on each.
+
+    Parameters
+    ----------
+    segmenter : SAM2FishSegmenter or None
+        The segmenter of the previous trial, reused if it uses the same model
+    trial_config : dict
+        The configuration of the trial, see `get_trial_config`
+    i : int
+        The index of the trial
+    device : torch.device 
+        A `torch.device` class specifying the device to use for `build_sam2_video_predictor`
+    stream : StreamingVideoRenderer or None
+        The renderer the masks are streamed to, see 
+        `SAM2FishSegmenter.run_propagation`
+
+    Returns
+    -------
+    segmenter : SAM2FishSegmenter
+        The segmenter used for the trial
+    load_time : float
+        Seconds spent loading the model
+    propagation_time : float
+        Seconds spent running propagation
+
+    Examples
+    --------
+    >>> segmenter, load_time, propagation_time = segment_trial(None, trial_config, 0, torch.device("cuda"))
+    """
+
+    load_time = 0.0
+    if segmenter is None or not segmenter.uses_same_model(trial_config):
+        # Load the model, releasing any previously loaded model first
+        segmenter = None
+        start = time.perf_counter()
+        segmenter = SAM2FishSegmenter(configs = trial_config, device = device)
+        load_time = time.perf_counter() - start
+        print(f"Loaded SAM2 model {trial_config['model_cfg']} on {device} in {load_time:.1f} s")
+    else:
+        # Reuse the loaded model with the modified trial configs
+        segmenter.set_configs(trial_config)
+
+    frames_from = trial_config["video_path"] if trial_config.get("frame_source") == "video" else trial_config["frame_dir"]
+    print(f"Processing Trial {i}: Frames from {frames_from}, Annotations from {trial_config['annotations_file']}, Masks saving to {trial_config['masks_dict_file']}")
+    start = time.perf_counter()
+    segmenter.run_propagation(stream=stream)
+    propagation_time = time.perf_counter() - start
+    print(f"Trial {i} propagated in {propagation_time:.1f} s")
+
+    return segmenter, load_time, propagation_time
+
+def run_segmentation_and_rendering(config_file, device):
+    """
+    Runs SAM2 segmentation and mask propagation for one or more trial 
+    configurations like `run_segmentation`, and renders the output video 
+    of each trial like `run_video_processing` while it is propagated.
+
+    The frames loaded for the segmenter's inference state are also kept 
+    in a memory-mapped array that the rendering processes read, so the 
+    frames are only decoded once, and the masks of each frame are 
+    streamed from the segmenter to the renderer as soon as no pass left 
+    to propagate covers the frame (see `StreamingVideoRenderer`). Each 
+    video is then finished shortly after its propagation, instead of in 
+    a second full pass over the frames and the mask file. The mask file 
+    is still written, so videos can be recreated by `run_video_processing`.
+
+    Trials run one after another in the main process, reusing the loaded 
+    model. If earlier runs committed some of a trial's chunks, their 
+    masks are only in the mask file, so that trial's video is rendered 
+    from the mask file once propagation has finished.
+
+    Parameters
+    ----------
+    config_file : str
+        Path to the YAML configuration file containing all segmentation 
+        and video generation parameters. Each parameter should either be 
+        a scalar (applied to all trials) or a list of values (with one 
+        entry per trial).
+    device : torch.device 
+        A `torch.device` class specifying the device to use for 
+        `build_sam2_video_predictor` and for drawing the masks in the 
+        main process
+
+    Notes
+    -----
+    - The frame array holds the frames uncompressed, about 6 MB per 1080p 
+      frame, in a temporary file in `frame_cache_dir`, or the system's 
+      temporary directory if it is not set. It is deleted once the video 
+      is finished.
+    - Rendering worker processes are spawned, so scripts calling this 
+      function must guard it with `if __name__ == "__main__":`.
+
+    Examples
+    --------
+    >>> run_segmentation_and_rendering("template_configs.yaml", device=torch.device("cuda"))
+    Loaded SAM2 model configs/sam2.1/sam2.1_hiera_l.yaml in 6.2 s
+    Processing Trial 0: Frames from ./data/frames1, Annotations from ./data/annotations1.npy, Masks saving to ./generated_frame_masks1.masks
+    Trial 0 propagated in 41.3 s
+    Trial 0 video ./output_trial1.mp4 finished 0.8 s after propagation
+    Model loading: 6.2 s, propagation: 41.3 s
+    """
+    # Load the YAML configuration file
+    configs = read_config_yaml(config_file)
+    
+    # Retrieve trial count from the length of values provided for each configuration key
+    trial_count = extract_config_lens(configs)
+    print(f"Running segmentation and rendering for {trial_count} trial(s)")
+
+    # Iterate over each trial, reusing the loaded model between trials
+    segmenter = None
+    load_time, propagation_time = 0.0, 0.0
     for i in range(trial_count): 
         trial_config = get_trial_config(configs, i)
 
-        # Initialize the segmenter with modified trial configs
-        segmenter = SAM2FishSegmenter(configs = trial_config, device = device)
-        print(f"Processing Trial {i}: Frames from {trial_config['frame_dir']}, Annotations from {trial_config['annotations_file']}, Masks saving to {trial_config['masks_dict_file']}")
-        segmenter.run_propagation()
+        # The frame array is uncompressed, so it is kept with the decoded-frame cache if there is one
+        array_dir = trial_config.get("frame_cache_dir") or None
+        if array_dir is not None:
+            os.makedirs(array_dir, exist_ok=True)
+        handle, frame_array_path = tempfile.mkstemp(suffix=".npy", prefix="sam2_frames_", dir=array_dir)
+        os.close(handle)
+
+        try:
+            stream = StreamingVideoRenderer(trial_config["video_file"], frame_array_path, device=device, 
+                                            **get_video_settings(trial_config))
+            try:
+                segmenter, trial_load_time, trial_propagation_time = segment_trial(segmenter, trial_config, i, device, stream=stream)
+            except BaseException:
+                stream.terminate()
+                raise
+            load_time += trial_load_time
+            propagation_time += trial_propagation_time
+
+            start = time.perf_counter()
+            if stream.started:
+                stream.close()
+                print(f"Trial {i} video {trial_config['video_file']} finished {time.perf_counter() - start:.1f} s after propagation")
+            else:
+                print(f"Trial {i} masks were not streamed, as chunks were committed by an earlier run, creating video: "
+                      f"{trial_config['video_file']} from {trial_config['masks_dict_file']}")
+                write_output_video(
+                    frame_dir = trial_config["frame_dir"],
+                    frame_masks_file = trial_config["masks_dict_file"],
+                    video_file=trial_config["video_file"],
+                    device=device,
+                    video_path=trial_config["video_path"] if trial_config.get("frame_source") == "video" else None,
+                    frame_cache_dir=trial_config.get("frame_cache_dir") or None,
+                    **get_video_settings(trial_config)
+                    )
+        finally:
+            os.remove(frame_array_path)
+
+    print(f"Model loading: {load_time:.1f} s, propagation: {propagation_time:.1f} s")
+
+def get_worker_devices(segmentation_devices, device, workers):
+    """
+    Assigns a device to each segmentation worker. CPU workers are also 
+    assigned an equal, contiguous block of the available CPU cores, so 
+    workers do not compete for cores (contiguous cores usually share a 
+    socket). 
+
+    Parameters
+    ----------
+    segmentation_devices : str
+        `auto` to spread workers over all visible GPUs, or over the CPU 
+        if `device` is not a CUDA device, or a comma separated list of 
+        devices (e.g., `cuda:0,cuda:1` or `cpu`) assigned to workers in turn
+    device : torch.device
+        The device passed to `run_segmentation`
+    workers : int
+        The number of workers
+
+    Returns
+    -------
+    list of tuples
+        One `(device_name, cpu_cores)` tuple per worker, where `cpu_cores` 
+        is a list of core IDs for CPU workers and None otherwise
+
+    Examples
+    --------
+    >>> get_worker_devices("cuda:0,cuda:1", torch.device("cuda"), 4)
+    [('cuda:0', None), ('cuda:1', None), ('cuda:0', None), ('cuda:1', None)]
+    """
+
+    if segmentation_devices == "auto":
+        if device.type == "cuda":
+            device_names = [f"cuda:{k}" for k in range(torch.cuda.device_count())]
+        else:
+            device_names = ["cpu"]
+    else:
+        device_names = [name.strip() for name in segmentation_devices.split(",")]
+
+    worker_devices = [device_names[k % len(device_names)] for k in range(workers)]
+
+    # Split the cores this process may use among the CPU workers
+    cpu_workers = [k for k, name in enumerate(worker_devices) if name == "cpu"]
+    cpu_cores = {}
+    if cpu_workers and hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        for block, k in enumerate(cpu_workers):
+            cpu_cores[k] = cores[block * len(cores) // len(cpu_workers):(block + 1) * len(cores) // len(cpu_workers)] or None
+
+    return [(name, cpu_cores.get(k)) for k, name in enumerate(worker_devices)]
+
+def segmentation_worker(worker_id, device_name, cpu_cores, configs, task_queue, result_queue):
+    """
+    Runs in a worker process started by `run_segmentation`. Takes trial 
+    indices from `task_queue` until it receives None, segments each 
+    trial on the worker's device, reusing the loaded model between 
+    trials, and puts a `(trial, worker_id, load_time, propagation_time, 
+    error)` tuple on `result_queue` for each trial. 
+
+    Parameters
+    ----------
+    worker_id : int
+        The index of the worker
+    device_name : str
+        The device of the worker, e.g. `cuda:1` or `cpu`
+    cpu_cores : list of ints or None
+        The CPU cores a CPU worker is pinned to
+    configs : dict
+        The configuration dictionary, see `read_config_yaml`
+    task_queue : multiprocessing.Queue
+        Queue of trial indices shared by all workers
+    result_queue : multiprocessing.Queue
+        Queue the results of each trial are put on
+    """
+
+    device = torch.device(device_name)
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    elif cpu_cores:
+        os.sched_setaffinity(0, cpu_cores)
+
+    segmenter = None
+    while True:
+        i = task_queue.get()
+        if i is None:
+            break
+
+        trial_config = get_trial_config(configs, i)
+        if cpu_cores and not trial_config.get("cpu_threads"):
+            # One thread per pinned core, unless set in the configs
+            trial_config["cpu_threads"] = len(cpu_cores)
+
+        try:
+            segmenter, load_time, propagation_time = segment_trial(segmenter, trial_config, i, device)
+            result_queue.put((i, worker_id, load_time, propagation_time, None))
+        except Exception as error:
+            traceback.print_exc()
+            result_queue.put((i, worker_id, 0.0, 0.0, repr(error)))
+            # The segmenter may be left in a broken state, reload it for the next trial
+            segmenter = None
 
 def adjust_annotations(annotations_file=None, fps=None, out_fps=None, SAM2_start=None, 
                        df_columns=None, frame_col_name=None):
@@ -250,6 +641,9 @@ def adjust_annotations(annotations_file=None, fps=None, out_fps=None, SAM2_start
     with the reduced frames provided to SAM2. 
     Adjustment is dictated by the formula: 
     `(frame_index - SAM2_start) / (fps / out_fps)`
+    computed exactly, and vectorized over all annotations, by 
+    `frame_utils.FrameMapping`, so non-integer FPS values such as 
+    29.97 do not drift.
     This formula takes the frame index provided from the unreduced video 
     and subtracts the SAM2_start value to align with the specified 
     frame delay at extraction (which can be used for syncing sequential videos).
@@ -262,7 +656,7 @@ def adjust_annotations(annotations_file=None, fps=None, out_fps=None, SAM2_start
     ----------
     annotations_file : str
         The full path to the annotation file
-    fps : int
+    fps : int or float
         The FPS of the unreduced video that the annotations were
         initially meant for
     out_fps: int
@@ -314,23 +708,17 @@ def adjust_annotations(annotations_file=None, fps=None, out_fps=None, SAM2_start
     df = df[df_columns]
 
     # Correct annotation frame value, so it coincides with video frame value
-    df[frame_col_name] = (df[frame_col_name] - SAM2_start) / (fps / out_fps)
-
-    # Store original frame values
-    original_values = df[frame_col_name].copy()
-
-    # Round and convert frame value to an integer 
-    df[frame_col_name] = round(df[frame_col_name]).astype(int)
-
-    # Identify which values were rounded
-    rounded_indices = original_values != df[frame_col_name]
-
-    # Print warning for affected frames
-    if rounded_indices.any():
-        rounded_values = original_values[rounded_indices]
-        new_values = df.loc[rounded_indices, frame_col_name]
-        for original, new in zip(rounded_values, new_values):
-            print(f"Warning: Frame value {original} was rounded to {new}.")
+    original_values = df[frame_col_name].to_numpy()
+    mapping = FrameMapping(fps, out_fps, SAM2_start)
+    sam2_frames, exact = mapping.to_sam2(original_values)
+    df[frame_col_name] = sam2_frames
+
+    # Print a single warning summarizing the frames that had to be rounded
+    if not exact.all():
+        examples = ", ".join(f"{original} -> {new}" for original, new 
+                             in zip(original_values[~exact][:5], sam2_frames[~exact][:5]))
+        print(f"Warning: {np.count_nonzero(~exact)} frame value(s) are not SAM2 frames and were "
+              f"rounded to the nearest SAM2 frame (annotation frame -> SAM2 frame: {examples}).")
 
     return df  
 
@@ -412,6 +800,52 @@ def get_frame_chunks_df(df=None, obj_name=None, frame_name=None, click_type_name
 
     return obj_frame_chunks, df
 
+def get_propagation_passes(chunks=None, max_objects_per_pass=1):
+    """
+    Groups object chunks whose enter/exit windows overlap into joint
+    propagation passes, so SAM2 propagates several objects over the 
+    union of their windows at once and the image encoder runs over 
+    each frame once per pass instead of once per object. A pass holds 
+    at most `max_objects_per_pass` chunks and each object at most once, 
+    as SAM2 tracks every object ID of a pass as a single object. 
+
+    Parameters
+    ----------
+    chunks : list of tuples
+        One `(key, obj_id, enter_frame, exit_frame)` tuple per chunk
+    max_objects_per_pass : int
+        The maximum number of chunks in a pass, 1 propagates every 
+        chunk on its own
+
+    Returns
+    -------
+    list of lists
+        The keys of the chunks of each pass, with passes ordered by 
+        their first frame
+
+    Examples
+    --------
+    >>> chunks = [("a", 1, 0, 10), ("b", 2, 5, 20), ("c", 1, 8, 30), ("d", 3, 40, 50)]
+    >>> get_propagation_passes(chunks, max_objects_per_pass=4)
+    [['a', 'b'], ['c'], ['d']]
+    """
+
+    # Each pass holds its chunk keys, object IDs and the last frame of the union of their windows
+    passes = []
+    for key, obj_id, enter_frame, exit_frame in sorted(chunks, key=lambda chunk: chunk[2]):
+        joined = next((propagation_pass for propagation_pass in passes 
+                       if enter_frame <= propagation_pass["end"] and obj_id not in propagation_pass["obj_ids"] 
+                       and len(propagation_pass["keys"]) < max_objects_per_pass), None)
+        if joined is None:
+            joined = {"keys": [], "obj_ids": set(), "end": exit_frame}
+            passes.append(joined)
+
+        joined["keys"].append(key)
+        joined["obj_ids"].add(obj_id)
+        joined["end"] = max(joined["end"], exit_frame)
+
+    return [propagation_pass["keys"] for propagation_pass in passes]
+
 def run_video_processing(configs, device):
     """
     Generates output videos visualizing SAM2 segmentation results for one or more trials.
@@ -455,8 +889,8 @@ def run_video_processing(configs, device):
     Examples
     --------
     >>> run_video_processing("template_configs.yaml", device=torch.device("cuda"))
-    Creating video: ./output_trial1.mp4 from ./frames1 and ./generated_frame_masks1.pkl
-    Creating video: ./output_trial2.mp4 from ./frames2 and ./generated_frame_masks2.pkl
+    Creating video: ./output_trial1.mp4 from ./frames1 and ./generated_frame_masks1.masks
+    Creating video: ./output_trial2.mp4 from ./frames2 and ./generated_frame_masks2.masks
     """
     # Load the YAML configuration file
     configs = read_config_yaml(configs)
@@ -470,21 +904,54 @@ def run_video_processing(configs, device):
         trial_config = get_trial_config(configs,i)
         
         # Write the output with modified trial configs
-        print(f"Creating video: {trial_config['video_file']} from {trial_config['frame_dir']} and {trial_config['masks_dict_file']}")
+        frames_from = trial_config["video_path"] if trial_config.get("frame_source") == "video" else trial_config["frame_dir"]
+        print(f"Creating video: {trial_config['video_file']} from {frames_from} and {trial_config['masks_dict_file']}")
 
         write_output_video(
             frame_dir = trial_config["frame_dir"],
             frame_masks_file = trial_config["masks_dict_file"],
             video_file=trial_config["video_file"],
-            out_fps=trial_config["out_fps"],
-            video_frame_size=trial_config["video_frame_size"],
-            fps=trial_config["fps"],
-            SAM2_start=trial_config["SAM2_start"],
-            font_size=trial_config["font_size"],
-            font_color=trial_config["font_color"],
-            alpha=trial_config["alpha"],
-            device=device
+            device=device,
+            video_path=trial_config["video_path"] if trial_config.get("frame_source") == "video" else None,
+            frame_cache_dir=trial_config.get("frame_cache_dir") or None,
+            **get_video_settings(trial_config)
             )
+
+def get_video_settings(trial_config):
+    """
+    Returns the settings of a trial's output video shared by 
+    `write_output_video` and `StreamingVideoRenderer`, with the defaults 
+    of settings missing from older configuration files.
+
+    Parameters
+    ----------
+    trial_config : dict
+        The configuration of the trial, see `get_trial_config`
+
+    Returns
+    -------
+    dict
+        Keyword arguments of `write_output_video` and `StreamingVideoRenderer`
+    """
+
+    return dict(
+        out_fps=trial_config["out_fps"],
+        video_frame_size=trial_config["video_frame_size"],
+        fps=trial_config["fps"],
+        SAM2_start=trial_config["SAM2_start"],
+        font_size=trial_config["font_size"],
+        font_color=trial_config["font_color"],
+        alpha=trial_config["alpha"],
+        workers=trial_config.get("workers") or 1,
+        renderer=trial_config.get("renderer") or "matplotlib",
+        batch_size=trial_config.get("render_batch_size") or 4,
+        video_writer=trial_config.get("video_writer") or "opencv",
+        codec=trial_config.get("video_codec") or "mpeg4",
+        crf=trial_config.get("video_crf", 23),
+        preset=trial_config.get("video_preset") or "medium",
+        encoder_threads=trial_config.get("video_encoder_threads") or 0,
+        queue_size=trial_config.get("video_queue_size") or 16
+        )
         
 def get_jpg_paths(jpg_dir):
     """
@@ -513,11 +980,12 @@ def get_jpg_paths(jpg_dir):
 def draw_masks(mask_dict, frame_path, colors, device, alpha=0.6):
     """
     For each mask provided in `mask_dict`, draws masks on top of the 
-    image provided by `frame_path`. 
+    image provided by `frame_path`. See `draw_masks_batch` to draw 
+    several frames at once.
 
     Parameters
     ----------
-    mask_dict : dict of sparse tensors
+    mask_dict : dict of numpy.ndarray
         Dictionary with keys corresponding to object IDs and 
         values representing the mask created for the object ID. 
     frame_path : str 
@@ -540,43 +1008,385 @@ def draw_masks(mask_dict, frame_path, colors, device, alpha=0.6):
         centroids of the object  
     """    
 
-    # Read in frame and convert it to a tensor 
-    image = decode_image(frame_path)
-    image = image.to(device)
-    
-    # Dictionary that will hold calculated centroids 
-    centroids = {}
+    images, centroids = draw_masks_batch([mask_dict], [frame_path], colors, device, alpha)
+    return images[0], centroids[0]
 
-    # Draw each mask on top of the image representing the frame
-    if mask_dict:
-        for obj_id, mask in mask_dict.items():
+def draw_masks_batch(mask_dicts, frame_paths, colors, device, alpha=0.6, images=None):
+    """
+    Draws the masks of several frames of the same size on top of the 
+    frames at once. The masks of all objects on all frames are stacked 
+    into one tensor, every centroid is computed in one vectorized 
+    reduction, and all colors are blended in a single pass, so the cost 
+    per frame stays nearly flat as the number of objects grows. Where 
+    masks overlap, only the color of the last object in `mask_dict` is 
+    blended in. This differs from the older `draw_masks`, which called 
+    `draw_segmentation_masks` once per object so overlapping colors were 
+    blended on top of each other; only overlapping pixels look different.
 
-            # Convert sparse tensor to dense and drop first channel dimension 
-            mask = mask.to_dense()
-            mask = mask.to(device)
-            mask = mask.squeeze(0)
+    Parameters
+    ----------
+    mask_dicts : list of dicts of numpy.ndarray
+        For each frame, a dictionary with keys corresponding to object 
+        IDs and values representing the mask created for the object ID
+    frame_paths : list of str 
+        The video frames corresponding to `mask_dicts`
+    colors : list of tuples of ints
+        A list of tuples representing RGB colors for each segmentation mask
+    device : torch.device 
+        A `torch.device` class specifying the device to use for mask drawing 
+    alpha : float 
+        Alpha value for the segmentation masks 
+    images : list of numpy.ndarray or None
+        The frames as (height, width, 3) RGB images, e.g. decoded from 
+        the video, used instead of reading `frame_paths`
 
-            # Get centroid for object ID
-            centroids[obj_id] = plot_utils.get_centroid(mask)
+    Returns
+    -------
+    images : Image tensor 
+        (frames, 3, height, width) tensor of the frames with the masks 
+        drawn on them
+    centroids : list of dicts of tuple
+        For each frame, a dictionary with keys corresponding to the 
+        object ID and values a tuple representing the x, y centroids of 
+        the object, or None for empty masks
 
-            # Draw masks on image 
-            image = draw_segmentation_masks(image, mask, colors=colors[obj_id], alpha=alpha)
+    Examples
+    --------
+    >>> images, centroids = draw_masks_batch([reader.get_frame(0), reader.get_frame(1)], 
+                                             ["frames/00001.jpg", "frames/00002.jpg"], 
+                                             plot_utils.get_spaced_colors(100), torch.device("cuda"))
+    """
 
-    return image, centroids
+    # Read in the frames and stack them into one tensor 
+    if images is None:
+        images = torch.stack([decode_image(frame_path) for frame_path in frame_paths]).to(device)
+    else:
+        images = torch.stack([torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1) for image in images]).to(device)
+    frame_count, _, height, width = images.shape
+    mask_dicts = [mask_dict or {} for mask_dict in mask_dicts]
+    obj_ids = [list(mask_dict) for mask_dict in mask_dicts]
+
+    max_objects = max(len(ids) for ids in obj_ids)
+    if max_objects == 0:
+        return images, [{} for _ in range(frame_count)]
+
+    # (frames, objects, height, width) masks, padding frames with fewer objects with empty masks
+    masks = torch.zeros((frame_count, max_objects, height, width), dtype=torch.bool)
+    for i, mask_dict in enumerate(mask_dicts):
+        for j, mask in enumerate(mask_dict.values()):
+            masks[i, j] = torch.from_numpy(mask)
+    masks = masks.to(device)
+
+    # Centroid of every mask from its pixel count and its row and column sums 
+    counts = masks.sum(dim=(2, 3))
+    centroid_x = (masks.sum(dim=2) * torch.arange(width, device=device)).sum(dim=2) / counts.clamp(min=1)
+    centroid_y = (masks.sum(dim=3) * torch.arange(height, device=device)).sum(dim=2) / counts.clamp(min=1)
+    counts, centroid_x, centroid_y = counts.tolist(), centroid_x.tolist(), centroid_y.tolist()
+    centroids = [{obj_id: (int(centroid_x[i][j]), int(centroid_y[i][j])) if counts[i][j] else None 
+                  for j, obj_id in enumerate(ids)} for i, ids in enumerate(obj_ids)]
+
+    # 1 + index of the topmost (last) mask covering each pixel, 0 where no mask does. Each mask 
+    # overwrites the label map in place, so no other (frames, objects, height, width) tensor is made
+    label_dtype = torch.uint8 if max_objects < 255 else torch.int16
+    labels = torch.zeros((frame_count, height, width), dtype=label_dtype, device=device)
+    for j in range(max_objects):
+        labels.masked_fill_(masks[:, j], j + 1)
+    covered = labels != 0
+
+    # Color of each frame's objects, looked up for every pixel, with row 0 for uncovered pixels
+    palette = torch.zeros((frame_count, max_objects + 1, 3), dtype=torch.float32)
+    for i, ids in enumerate(obj_ids):
+        if ids:
+            palette[i, 1:len(ids) + 1] = torch.tensor([colors[obj_id] for obj_id in ids], dtype=torch.float32)
+    palette = palette.to(device)
+    overlay = palette[torch.arange(frame_count, device=device)[:, None, None], labels.int()].permute(0, 3, 1, 2)
+
+    # Blend all masks in one pass
+    blended = (images * (1 - alpha) + overlay * alpha).to(images.dtype)
+    images = torch.where(covered[:, None], blended, images)
+
+    return images, centroids
+
+def render_frames(tasks, mask_dicts, colors, width, height, font_size=16, font_color="red", alpha=0.6, device="cuda", 
+                  images=None):
+    """
+    Renders frames of the output video: draws the masks in `mask_dicts` 
+    on the frames, resizes them, and adds the object IDs, a title with 
+    the frame numbers, and axis ticks in original pixel values.
+
+    Parameters
+    ----------
+    tasks : list of tuples
+        The `(frame_idx, frame_path, annotation_frame)` of each frame, 
+        i.e. its SAM2 frame index, JPG and annotation frame
+    mask_dicts : list of dicts of numpy.ndarray
+        For each frame, a dictionary with keys corresponding to object 
+        IDs and values representing the mask of the object ID on the frame
+    colors : list of tuples of ints
+        A list of tuples representing RGB colors for each segmentation mask
+    width : int
+        The width of the video
+    height : int
+        The height of the video
+    font_size : int
+        Font size for drawn object IDs
+    font_color : str
+        Color of font for the drawn object IDs
+    alpha : float 
+        Alpha value for the segmentation masks 
+    device : torch.device 
+        A `torch.device` class specifying the device to use for mask drawing 
+    images : list of numpy.ndarray or None
+        The frames as (height, width, 3) RGB images, used instead of 
+        reading the JPGs of `tasks`
+
+    Returns
+    -------
+    list of numpy.ndarray
+        The rendered frames as (height, width, 3) BGR images
+    """
+
+    # Draw masks on the frames, if they exist
+    images, centroids = draw_masks_batch(mask_dicts=mask_dicts, frame_paths=[task[1] for task in tasks], 
+                                         colors=colors, device=device, alpha=alpha, images=images)
+
+    # Get original image dimensions (before resizing)
+    orig_height, orig_width = images.shape[2:]
+
+    # Define the transformation to resize the images
+    resize_transform = transforms.Resize((height, width))  # Resize to width x height
+
+    # Apply the resize transformation to the image tensors
+    images = resize_transform(images)
+
+    # Rearrange image tensors from (N, C, H, W) to (N, H, W, C)
+    images = images.permute(0, 2, 3, 1).cpu().numpy()
+
+    # Scaling factors for centroids 
+    scale_x = width / orig_width  # Scaling factor for width
+    scale_y = height / orig_height  # Scaling factor for height
+
+    frames = []
+    for (frame_idx, _, annotation_frame), image, frame_centroids in zip(tasks, images, centroids):
+        # Create a matplotlib figure
+        fig, ax = plt.subplots(figsize=(width / 100, height / 100))
+
+        # Display the image
+        ax.imshow(image)
+
+        # Draw object ID on object, if a centroid exists for it 
+        for obj_id, centroid in frame_centroids.items():
+            # Skip empty masks that occur
+            if centroid is not None:
+                ax.text(centroid[0]*scale_x, centroid[1]*scale_y, obj_id, fontsize=font_size, color=font_color)
+
+        # Set title with frame number
+        ax.set_title(f"SAM2 frame: {frame_idx}, Annotation frame: {annotation_frame}", fontsize=16)
+
+        # Set tick marks based on the original image dimensions
+        ax.set_xticks(np.linspace(0, width, num=10))  # 10 evenly spaced ticks
+        ax.set_xticklabels(np.linspace(0, orig_width, num=10, dtype=int))  # Map to original width
+        ax.set_yticks(np.linspace(0, height, num=10))
+        ax.set_yticklabels(np.linspace(0, orig_height, num=10, dtype=int))  # Map to original height
+
+        # Set axis labels
+        ax.set_xlabel("Pixel value")
+        ax.set_ylabel("Pixel value")
+
+        # Remove tick labels to keep only marks
+        ax.tick_params(axis='both', labelsize=10, color='black')
+
+        # Convert Matplotlib figure to an image
+        fig.canvas.draw()
+        frame = np.array(fig.canvas.renderer.buffer_rgba())
+
+        # Close the figure to save memory
+        plt.close(fig)
+
+        # Convert RGBA to BGR for OpenCV
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR))
+
+    return frames
+
+# Mask file, renderer and frame source of a video rendering worker process, set by `init_render_worker`
+_render_worker_state = {}
+
+def get_frame_renderer(renderer, width, height, first_frame, colors, font_size=16, font_color="red", alpha=0.6):
+    """
+    Returns the renderer of the output video frames.
+
+    Parameters
+    ----------
+    renderer : str
+        `matplotlib` or `opencv`
+    width : int
+        The width of the video
+    height : int
+        The height of the video
+    first_frame : numpy.ndarray
+        A frame of the video before resizing
+    colors : list of tuples of ints
+        A list of tuples representing RGB colors for each segmentation mask
+    font_size : int
+        Font size for drawn object IDs
+    font_color : str
+        Color of font for the drawn object IDs
+    alpha : float 
+        Alpha value for the segmentation masks 
+
+    Returns
+    -------
+    render_utils.FrameRenderer or None
+        The renderer for `opencv`, or None for `matplotlib`, whose frames 
+        are drawn by `render_frames`
+
+    Raises
+    ------
+    ValueError
+        If `renderer` is not `matplotlib` or `opencv`
+    """
+
+    if renderer == "opencv":
+        # The layout only depends on the frame size, which is the same for every frame
+        orig_height, orig_width = first_frame.shape[:2]
+        return render_utils.FrameRenderer(width, height, orig_width, orig_height, colors, 
+                                          font_size=font_size, font_color=font_color, alpha=alpha)
+    if renderer == "matplotlib":
+        return None
+    raise ValueError(f"renderer must be 'matplotlib' or 'opencv', got '{renderer}'.")
+
+def init_render_worker(frame_masks_file, render_settings, frame_renderer=None, single_thread=False, frame_source_args=None, 
+                       frame_array_path=None):
+    """
+    Initializes a video rendering worker process of `write_output_video` 
+    or `StreamingVideoRenderer`, opening its own reader of the mask file.
+
+    Parameters
+    ----------
+    frame_masks_file : str or None
+        The mask file of the video, or None if the masks are passed 
+        with the tasks
+    render_settings : dict
+        Keyword arguments of `render_frames` shared by every frame
+    frame_renderer : render_utils.FrameRenderer or None
+        The renderer used instead of `render_frames`, if any
+    single_thread : bool
+        Whether to limit PyTorch and OpenCV to one thread, for pools of 
+        workers that each render one batch of frames at a time
+    frame_source_args : dict or None
+        Keyword arguments of the `video_utils.VideoFrameSource` frames are 
+        read from, or None to read the JPGs of the tasks
+    frame_array_path : str or None
+        A `.npy` array of the BGR frames, memory-mapped and read instead 
+        of decoding the frames, see `SAM2FishSegmenter.load_video_frames`
+    """
+
+    if single_thread:
+        # Extra threads would only compete with the other workers for cores
+        torch.set_num_threads(1)
+        cv2.setNumThreads(1)
+
+    _render_worker_state["frame_masks"] = None if frame_masks_file is None else mask_utils.MaskReader(frame_masks_file)
+    _render_worker_state["render_settings"] = render_settings
+    _render_worker_state["frame_renderer"] = frame_renderer
+    _render_worker_state["frame_source"] = None if frame_source_args is None else video_utils.VideoFrameSource(**frame_source_args)
+    _render_worker_state["frame_array"] = None if frame_array_path is None else np.load(frame_array_path, mmap_mode="r")
+
+def _source_frame_or_blank(frame_source, frame_idx):
+    """
+    Returns SAM2 frame `frame_idx` of a `video_utils.VideoFrameSource`, 
+    or a black frame if the video ended before it. The frame count of a 
+    video can be too high, and `SAM2FishSegmenter.load_video_frames` 
+    loads the frames past the end as blank, so they are rendered blank.
+    """
+
+    try:
+        return frame_source.get_frame(frame_idx)
+    except IndexError:
+        capture = frame_source.reader.capture
+        height, width = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        return np.zeros((height, width, 3), dtype=np.uint8)
+
+def render_worker_frames(tasks, encoded_masks=None):
+    """
+    Renders a batch of frames in a video rendering worker process.
+
+    Parameters
+    ----------
+    tasks : list of tuples
+        The `(frame_idx, frame_path, annotation_frame)` of each frame
+    encoded_masks : list of dicts of tuples or None
+        For each frame, a dictionary with keys corresponding to object 
+        IDs and values the mask of the object ID encoded by 
+        `mask_utils.encode_mask`, or None to read the masks from the 
+        mask file
+
+    Returns
+    -------
+    list of numpy.ndarray
+        The rendered frames, see `render_frames`
+    """
+
+    frame_renderer = _render_worker_state["frame_renderer"]
+    frame_source = _render_worker_state["frame_source"]
+    frame_array = _render_worker_state["frame_array"]
+
+    # BGR frames from the frame array or decoded from the video, if frames are not read from JPGs
+    if frame_array is not None:
+        images = [np.asarray(frame_array[frame_idx]) for frame_idx, _, _ in tasks]
+    elif frame_source is not None:
+        images = [_source_frame_or_blank(frame_source, frame_idx) for frame_idx, _, _ in tasks]
+    else:
+        images = None
+
+    if encoded_masks is None:
+        mask_dicts = [_render_worker_state["frame_masks"].get_frame(frame_idx) for frame_idx, _, _ in tasks]
+    else:
+        shape = images[0].shape[:2]
+        mask_dicts = [{obj_id: mask_utils.decode_mask(shape, bbox, bits) for obj_id, (bbox, bits) in masks.items()} 
+                      for masks in encoded_masks]
+
+    if frame_renderer is not None:
+        if images is None:
+            images = [cv2.imread(frame_path) for _, frame_path, _ in tasks]
+        return [frame_renderer.render(image, mask_dict, f"SAM2 frame: {frame_idx}, Annotation frame: {annotation_frame}")
+                for (frame_idx, _, annotation_frame), image, mask_dict in zip(tasks, images, mask_dicts)]
+    if images is not None:
+        images = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in images]
+    return render_frames(tasks, mask_dicts, images=images, **_render_worker_state["render_settings"])
 
 def write_output_video(frame_dir, frame_masks_file, video_file, out_fps, 
-                       video_frame_size, fps, SAM2_start, font_size=16, font_color="red", alpha=0.6, device="cuda"):
+                       video_frame_size, fps, SAM2_start, font_size=16, font_color="red", alpha=0.6, device="cuda",
+                       workers=1, renderer="matplotlib", batch_size=4, video_writer="opencv", codec="mpeg4", 
+                       crf=23, preset="medium", encoder_threads=0, queue_size=16, video_path=None, frame_cache_dir=None):
     """
     Constructs an MP4 of all frames in `frame_dir` and draws masks 
     on said frames using the masks found in `frame_masks_file`. 
 
+    With `video_path`, frames are decoded straight from the source video 
+    (see `video_utils.VideoFrameSource`) instead of read from the JPGs in 
+    `frame_dir`.
+
+    Frames are encoded by the `video_writer` backend (see 
+    `video_utils.open_video_writer`) in a background thread, so encoding 
+    overlaps rendering.
+
+    With `workers` greater than 1, frames are rendered in parallel by a 
+    pool of worker processes drawing on the CPU, while the main process 
+    writes the rendered frames to the video in order.
+
+    Frames are drawn with matplotlib by default. The `opencv` renderer 
+    (see `render_utils.FrameRenderer`) draws frames that look close to 
+    the matplotlib ones directly with NumPy and OpenCV, which is more 
+    than 10x faster.
+
     Parameters
     ----------
     frame_dir : str 
         Directory containing JPGs corresponding to the frames of the video
     frame_masks_file : str
-        A pickle file composed of sparse tensors representing the generated 
-        masks for each video frame
+        A mask file written by `mask_utils.MaskWriter` (or a pickle file written 
+        by older versions) representing the generated masks for each video frame
     video_file : str
         The name of the video file to be created demonstrating the generated 
         masks on each frame.
@@ -586,7 +1396,7 @@ def write_output_video(frame_dir, frame_masks_file, video_file, out_fps,
         Specifies the frame size for the video, with the first 
         element representing the width and the second corresponding
         to the height
-    fps : int 
+    fps : int or float
         The FPS of the unreduced video that the annotations were 
         initially created for
     SAM2_start : int 
@@ -600,104 +1410,362 @@ def write_output_video(frame_dir, frame_masks_file, video_file, out_fps,
         Alpha value for the segmentation masks 
     device : torch.device 
         A `torch.device` class specifying the device to use for mask drawing 
+        when rendering in the main process
+    workers : int
+        The number of processes rendering frames, 1 renders every frame 
+        in the main process
+    renderer : str
+        `matplotlib` or `opencv`
+    batch_size : int
+        The number of frames whose masks are drawn together, see 
+        `draw_masks_batch`
+    video_writer : str
+        The writer backend, `opencv`, `ffmpeg` or `pyav`
+    codec : str
+        `h264`, `h265`, `vp9` or `mpeg4`, or an FFmpeg encoder (e.g. 
+        `h264_nvenc`) for the `ffmpeg` and `pyav` writers
+    crf : int
+        The constant rate factor of the `h264`, `h265` and `vp9` codecs, 
+        lower is better quality and larger files
+    preset : str
+        The speed preset of the `h264` and `h265` codecs
+    encoder_threads : int
+        The number of encoding threads, 0 lets the encoder choose
+    queue_size : int
+        The maximum number of rendered frames waiting to be encoded
+    video_path : str or None
+        The source video to decode frames from, None reads the JPGs in 
+        `frame_dir`
+    frame_cache_dir : str or None
+        The directory of the decoded-frame cache of `video_path`, filled 
+        by the segmentation, None disables it
 
     Raises
     ------
     RuntimeError
         If no images are found in `frame_dir`
+    ValueError
+        If `renderer` is not `matplotlib` or `opencv`
 
     Examples
     --------
-    >>> write_output_video(frame_dir="/path/to/jpgs", frame_masks_file="masks.pkl", 
+    >>> write_output_video(frame_dir="/path/to/jpgs", frame_masks_file="masks.masks", 
                            video_file="./test_video.mp4", out_fps=3, 
-                           video_frame_size=[900, 600])
+                           video_frame_size=[900, 600], workers=8, renderer="opencv", 
+                           video_writer="ffmpeg", codec="h264", crf=23)
     """
 
-    # Open and load the pickle file holding the masks 
-    with open(frame_masks_file, 'rb') as file:
-        frame_masks = pickle.load(file)
-
     # Generate a list of RGB colors for segmentation masks 
     colors = plot_utils.get_spaced_colors(100)
 
-    # Paths to the video frames
-    frame_paths = get_jpg_paths(frame_dir)
+    if video_path is not None:
+        # Frames are decoded from the video, by each process that renders
+        frame_source_args = dict(video_path=video_path, fps=fps, out_fps=out_fps, SAM2_start=SAM2_start, 
+                                 cache_dir=frame_cache_dir)
+        frame_source = video_utils.VideoFrameSource(**frame_source_args)
+        try:
+            frame_paths = [None] * len(frame_source)
+            first_frame = frame_source.get_frame(0)
+            try:
+                frame_source.get_frame(len(frame_source) - 1)
+            except IndexError:
+                print(f"Warning: {video_path} ended before its reported frame count, frames past its end "
+                      f"are rendered blank like the segmenter loads them.")
+        finally:
+            frame_source.close()
+    else:
+        # Paths to the video frames
+        frame_source_args = None
+        frame_paths = get_jpg_paths(frame_dir)
 
-    if not frame_paths:
-        raise RuntimeError(f"No images found in the path: {frame_dir}.")
+        if not frame_paths:
+            raise RuntimeError(f"No images found in the path: {frame_dir}.")
+        first_frame = cv2.imread(frame_paths[0])
 
     # Set the width and height of the video 
     width = video_frame_size[0]
     height = video_frame_size[1]
     
-    # Define the video codec and create VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video = cv2.VideoWriter(video_file, fourcc, out_fps, (width, height))
-
-    # Write each image to the video and draw masks on images that contain them
-    for frame_idx, img_path in tqdm(enumerate(frame_paths), total=len(frame_paths)):
-
-        # Draw masks on the frame, if they exist
-        image, centroids = draw_masks(mask_dict=frame_masks[frame_idx], frame_path=img_path, 
-                                      colors=colors, device=device, alpha=alpha)
-
-        # Get original image dimensions (before resizing)
-        orig_height, orig_width = image.shape[1:]
-
-        # Define the transformation to resize the image
-        resize_transform = transforms.Resize((height, width))  # Resize to width x height
-
-        # Apply the resize transformation to the image tensor
-        image = resize_transform(image)
-
-        # Rearrange image tensor from (C, H, W) to (H, W, C)
-        image = image.permute(1, 2, 0).cpu().numpy()
-
-        # Create a matplotlib figure
-        fig, ax = plt.subplots(figsize=(width / 100, height / 100))
-
-        # Display the image
-        ax.imshow(image)
-
-        # Scaling factors for centroids 
-        scale_x = width / orig_width  # Scaling factor for width
-        scale_y = height / orig_height  # Scaling factor for height
-
-        # Draw object ID on object, if a centroid exists for it 
-        if centroids:
-            for obj_id, centroid in centroids.items():
-                # Skip empty masks that occur
-                if centroid is not None:
-                    ax.text(centroid[0]*scale_x, centroid[1]*scale_y, obj_id, fontsize=font_size, color=font_color)
-
-        # Set title with frame number
-        ax.set_title(f"SAM2 frame: {frame_idx}, Annotation frame: {frame_idx * (fps/out_fps) + SAM2_start}", fontsize=16)
-
-        # Set tick marks based on the original image dimensions
-        ax.set_xticks(np.linspace(0, width, num=10))  # 10 evenly spaced ticks
-        ax.set_xticklabels(np.linspace(0, orig_width, num=10, dtype=int))  # Map to original width
-        ax.set_yticks(np.linspace(0, height, num=10))
-        ax.set_yticklabels(np.linspace(0, orig_height, num=10, dtype=int))  # Map to original height
-
-        # Set axis labels
-        ax.set_xlabel("Pixel value")
-        ax.set_ylabel("Pixel value")
-
-        # Remove tick labels to keep only marks
-        ax.tick_params(axis='both', labelsize=10, color='black')
-
-        # Convert Matplotlib figure to an image
-        fig.canvas.draw()
-        frame = np.array(fig.canvas.renderer.buffer_rgba())
-
-        # Convert RGBA to BGR for OpenCV
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
-
-        # Write the frame to the video
-        video.write(frame)
+    # Annotation frame corresponding to each SAM2 frame
+    annotation_frames = FrameMapping(fps, out_fps, SAM2_start).to_raw(np.arange(len(frame_paths)))
+
+    render_settings = dict(colors=colors, width=width, height=height, font_size=font_size, 
+                           font_color=font_color, alpha=alpha)
+    tasks = [(frame_idx, img_path, int(annotation_frames[frame_idx])) for frame_idx, img_path in enumerate(frame_paths)]
+    batches = [tasks[k:k + batch_size] for k in range(0, len(tasks), batch_size)]
+
+    frame_renderer = get_frame_renderer(renderer, width, height, first_frame, colors, 
+                                        font_size=font_size, font_color=font_color, alpha=alpha)
+
+    # Open the video writer, which encodes frames in a background thread
+    video = video_utils.open_video_writer(video_file, out_fps, width, height, writer=video_writer, codec=codec, crf=crf, 
+                                          preset=preset, threads=encoder_threads, queue_size=queue_size)
+
+    # Always close the writer, so a failed render does not leave its thread or an ffmpeg process running
+    try:
+        if workers <= 1:
+            # Render in this process, drawing masks on `device`
+            init_render_worker(frame_masks_file, dict(render_settings, device=device), frame_renderer, 
+                               frame_source_args=frame_source_args)
+
+            # Write each image to the video and draw masks on images that contain them
+            try:
+                for batch in tqdm(batches):
+                    for frame in render_worker_frames(batch):
+                        video.write(frame)
+            finally:
+                _render_worker_state["frame_masks"].close()
+                if _render_worker_state["frame_source"] is not None:
+                    _render_worker_state["frame_source"].close()
+        else:
+            # Workers draw on the CPU, so they do not each need their own CUDA context
+            render_settings["device"] = "cpu"
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(workers, initializer=init_render_worker, initargs=(frame_masks_file, render_settings, frame_renderer, True, frame_source_args)) as pool:
+                # imap returns batches in order, holding back batches that finish before earlier ones
+                for frames in tqdm(pool.imap(render_worker_frames, batches), total=len(batches)):
+                    for frame in frames:
+                        video.write(frame)
+    finally:
+        # Encode the remaining frames and finish the video
+        video.close()
+
+class StreamingVideoRenderer:
+    """
+    A class used to render the output video of a trial while SAM2 
+    propagates it, for `run_segmentation_and_rendering`. The segmenter 
+    stores the frames it loads for its inference state in the 
+    memory-mapped array at `frame_array_path` (see 
+    `SAM2FishSegmenter.load_video_frames`), which the rendering 
+    processes read instead of decoding the frames again, and passes the 
+    mask of each object on each propagated frame to `add_mask`. Once no 
+    pass left to propagate covers a frame, its masks are final and 
+    `render_until` renders it, in the same way as `write_output_video`. 
+    `started` is set by the first call to `render_until`, and stays False 
+    if the segmenter streamed nothing.
+
+    Methods
+    -------
+    __init__(self, video_file, frame_array_path, out_fps, video_frame_size, fps, SAM2_start, font_size=16, font_color="red", alpha=0.6, device="cuda", workers=1, renderer="matplotlib", batch_size=4, video_writer="opencv", codec="mpeg4", crf=23, preset="medium", encoder_threads=0, queue_size=16)
+        Sets the output video settings
+    add_mask(self, frame_idx, obj_id, mask)
+        Stores the mask of an object on a frame until the frame is rendered
+    render_until(self, frame_idx)
+        Renders the frames before `frame_idx`, whose masks are final
+    close(self)
+        Renders the remaining frames and finishes the video
+    terminate(self)
+        Stops rendering without finishing the video
+    """
 
-        # Close the figure to save memory
-        plt.close(fig)
-    
-    # Release the video writer
-    video.release()
\ No newline at end of file
+    def __init__(self, video_file, frame_array_path, out_fps, video_frame_size, fps, SAM2_start, font_size=16, 
+                 font_color="red", alpha=0.6, device="cuda", workers=1, renderer="matplotlib", batch_size=4, 
+                 video_writer="opencv", codec="mpeg4", crf=23, preset="medium", encoder_threads=0, queue_size=16):
+        """
+        Sets the output video settings. The video and the rendering 
+        processes are opened by the first call to `render_until`, once 
+        the segmenter has filled the frame array.
+
+        Parameters
+        ----------
+        video_file : str
+            The name of the video file to be created
+        frame_array_path : str
+            The `.npy` array the segmenter stores the BGR frames in
+        out_fps, video_frame_size, fps, SAM2_start, font_size, font_color, alpha, device, workers, renderer, batch_size, 
+        video_writer, codec, crf, preset, encoder_threads, queue_size
+            See `write_output_video`
+
+        Raises
+        ------
+        ValueError
+            If `renderer` is not `matplotlib` or `opencv`
+
+        Examples
+        --------
+        >>> stream = StreamingVideoRenderer("./test_video.mp4", "/tmp/frames.npy", out_fps=3, 
+                                            video_frame_size=[900, 600], fps=24, SAM2_start=0, 
+                                            workers=8, renderer="opencv")
+        >>> segmenter.run_propagation(stream=stream)
+        >>> stream.close()
+        """
+
+        if renderer not in ("matplotlib", "opencv"):
+            raise ValueError(f"renderer must be 'matplotlib' or 'opencv', got '{renderer}'.")
+
+        self.video_file = video_file
+        self.frame_array_path = frame_array_path
+        self.out_fps = out_fps
+        self.width, self.height = video_frame_size[0], video_frame_size[1]
+        self.mapping = FrameMapping(fps, out_fps, SAM2_start)
+        self.colors = plot_utils.get_spaced_colors(100)
+        self.font_size = font_size
+        self.font_color = font_color
+        self.alpha = alpha
+        self.device = device
+        self.workers = workers
+        self.renderer = renderer
+        self.batch_size = batch_size
+        self.writer_options = dict(writer=video_writer, codec=codec, crf=crf, preset=preset, 
+                                   threads=encoder_threads, queue_size=queue_size)
+
+        self.started = False
+        self.frame_count = 0
+        self.next_frame = 0
+        self.masks = {}
+        self.pending = deque()
+        self.pool = None
+        self.video = None
+
+    def _start(self):
+        """
+        Opens the video writer and the rendering processes, or the 
+        rendering state of this process if `workers` is 1.
+        """
+
+        frames = np.load(self.frame_array_path, mmap_mode="r")
+        self.frame_count = len(frames)
+        frame_renderer = get_frame_renderer(self.renderer, self.width, self.height, frames[0], self.colors, 
+                                            font_size=self.font_size, font_color=self.font_color, alpha=self.alpha)
+        del frames
+
+        render_settings = dict(colors=self.colors, width=self.width, height=self.height, font_size=self.font_size, 
+                               font_color=self.font_color, alpha=self.alpha)
+        if self.workers <= 1:
+            # Render in this process, drawing masks on `device`
+            init_render_worker(None, dict(render_settings, device=self.device), frame_renderer, 
+                               frame_array_path=self.frame_array_path)
+        else:
+            # Workers draw on the CPU, and are spawned as CUDA cannot be used in forked processes
+            context = multiprocessing.get_context("spawn")
+            self.pool = context.Pool(self.workers, initializer=init_render_worker, 
+                                     initargs=(None, dict(render_settings, device="cpu"), frame_renderer, True, None, 
+                                               self.frame_array_path))
+
+        self.video = video_utils.open_video_writer(self.video_file, self.out_fps, self.width, self.height, **self.writer_options)
+        self.started = True
+
+    def add_mask(self, frame_idx, obj_id, mask):
+        """
+        Stores the mask of `obj_id` on `frame_idx` until the frame is 
+        rendered. Masks are encoded by `mask_utils.encode_mask`, so the 
+        masks of frames waiting for later passes take little memory and 
+        are cheap to send to the rendering processes.
+
+        Parameters
+        ----------
+        frame_idx : int
+            The frame index
+        obj_id : int
+            The object ID
+        mask : numpy.ndarray of bools
+            The mask with shape (height, width)
+        """
+
+        self.masks.setdefault(int(frame_idx), {})[int(obj_id)] = mask_utils.encode_mask(mask)
+
+    def render_until(self, frame_idx):
+        """
+        Renders the frames before `frame_idx`, whose masks are final, in 
+        batches of `batch_size` frames; the frames of an incomplete batch 
+        wait for later frames or `close`. Rendered batches are written 
+        to the video in order as they finish, waiting for the oldest 
+        batch once every rendering process has two batches queued.
+
+        Parameters
+        ----------
+        frame_idx : int
+            The first frame whose masks are not final
+        """
+
+        if not self.started:
+            self._start()
+
+        end = min(frame_idx, self.frame_count)
+        while end - self.next_frame >= self.batch_size:
+            self._submit(self.next_frame + self.batch_size)
+            self._write(max_pending=2 * self.workers)
+        self._write()
+
+    def _submit(self, end):
+        """
+        Renders the frames from `self.next_frame` up to `end`, in the 
+        pool if there is one.
+        """
+
+        frame_idxs = np.arange(self.next_frame, end)
+        tasks = [(int(frame_idx), None, int(annotation_frame)) 
+                 for frame_idx, annotation_frame in zip(frame_idxs, self.mapping.to_raw(frame_idxs))]
+        encoded_masks = [self.masks.pop(frame_idx, {}) for frame_idx, _, _ in tasks]
+        self.next_frame = end
+
+        if self.pool is None:
+            self.pending.append(render_worker_frames(tasks, encoded_masks))
+        else:
+            self.pending.append(self.pool.apply_async(render_worker_frames, (tasks, encoded_masks)))
+
+    def _write(self, max_pending=None):
+        """
+        Writes the rendered batches to the video in order, stopping at 
+        the first unfinished batch, or waiting for it while more than 
+        `max_pending` batches are left.
+        """
+
+        while self.pending:
+            batch = self.pending[0]
+            if not isinstance(batch, list):
+                if not batch.ready() and (max_pending is None or len(self.pending) <= max_pending):
+                    break
+                batch = batch.get()
+
+            self.pending.popleft()
+            for frame in batch:
+                self.video.write(frame)
+
+    def close(self):
+        """
+        Renders the remaining frames and finishes the video.
+
+        Examples
+        --------
+        >>> stream.close()
+        """
+
+        if self.video is None:
+            return
+
+        self.render_until(self.frame_count)
+        if self.next_frame < self.frame_count:
+            self._submit(self.frame_count)
+        self._write(max_pending=0)
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self._release()
+
+    def terminate(self):
+        """
+        Stops the rendering processes without rendering the remaining 
+        frames, e.g. if propagation failed.
+        """
+
+        if self.video is None:
+            return
+
+        if self.pool is not None:
+            self.pool.terminate()
+        self.pending.clear()
+        self._release()
+
+    def _release(self):
+        """
+        Closes the video and releases the frame array and the masks.
+        """
+
+        self.video.close()
+        if self.pool is None:
+            _render_worker_state["frame_array"] = None
+        self.video = None
+        self.pool = None
+        self.masks = {}
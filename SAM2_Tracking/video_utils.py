@@ -0,0 +1,915 @@
+import hashlib
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from frame_utils import FrameMapping, exact_fps
+
+
+class SeekIndex:
+    """
+    A class used to hold the keyframe positions of a video, so a jump
+    to any frame decodes at most one group of pictures (GOP). The index
+    is built once per video with `ffprobe`, which only reads packet
+    headers, and cached next to the video as `<video>_seekindex.npz`.
+
+    Methods
+    -------
+    __init__(self, keyframes)
+        Sets the sorted keyframe indices
+    load_or_build(cls, video_path)
+        Loads the cached index for a video, building it if needed
+    keyframe_before(self, index)
+        Returns the last keyframe at or before `index`
+    """
+
+    def __init__(self, keyframes):
+        """
+        Sets the sorted keyframe indices.
+
+        Parameters
+        ----------
+        keyframes : numpy.ndarray of ints
+            The frame indices, in display order, of the keyframes
+        """
+
+        self.keyframes = np.asarray(keyframes, dtype=np.int64)
+
+    @classmethod
+    def load_or_build(cls, video_path):
+        """
+        Loads the cached index for `video_path`, building and caching
+        it if there is none or the video changed since it was built.
+
+        Parameters
+        ----------
+        video_path : str
+            The full path to the video file
+
+        Returns
+        -------
+        SeekIndex or None
+            The seek index, or None if `ffprobe` is not available or
+            could not read the video
+        """
+
+        index_path = os.path.splitext(video_path)[0] + "_seekindex.npz"
+        stat = os.stat(video_path)
+
+        if os.path.exists(index_path):
+            try:
+                with np.load(index_path) as cached:
+                    if cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+                        return cls(cached["keyframes"])
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                # A truncated or corrupt index is rebuilt
+                pass
+
+        # Only packet headers are read, no frames are decoded
+        try:
+            result = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0",
+                                     "-show_entries", "packet=pts,flags", "-of", "csv=p=0", video_path],
+                                    capture_output=True, text=True, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            print("Warning: ffprobe could not index the video's keyframes, seeking may be slower.")
+            return None
+
+        pts, is_keyframe = [], []
+        for line in result.stdout.splitlines():
+            fields = line.strip().split(",")
+            if len(fields) < 2 or not fields[0].lstrip("-").isdigit():
+                continue
+            pts.append(int(fields[0]))
+            is_keyframe.append("K" in fields[1])
+
+        # Packets are in decode order, sorting by pts gives the display order
+        order = np.argsort(np.array(pts, dtype=np.int64), kind="stable")
+        keyframes = np.flatnonzero(np.array(is_keyframe, dtype=bool)[order])
+        if len(keyframes) == 0:
+            return None
+
+        try:
+            np.savez(index_path, keyframes=keyframes, size=stat.st_size, mtime=stat.st_mtime)
+        except OSError:
+            # The video directory may be read only, the index is then rebuilt next time
+            pass
+
+        return cls(keyframes)
+
+    def keyframe_before(self, index):
+        """
+        Returns the last keyframe at or before `index`.
+
+        Parameters
+        ----------
+        index : int
+            The frame index in the unreduced video
+
+        Returns
+        -------
+        int
+            The index of the keyframe decoding has to start from
+        """
+
+        position = np.searchsorted(self.keyframes, index, side="right") - 1
+        return int(self.keyframes[max(position, 0)])
+
+
+class VideoFrameReader:
+    """
+    A class used to decode chosen frames of a video in order, seeking
+    only when decoding forward to the next frame would pass a keyframe,
+    so each needed frame costs at most one group of pictures (GOP) of
+    decoding and frames between needed frames are skipped without
+    being converted.
+
+    Methods
+    -------
+    __init__(self, video_path)
+        Opens the video and loads its seek index
+    read_frames(self, indices)
+        Yields the frames at the given indices
+    close(self)
+        Releases the video
+    """
+
+    def __init__(self, video_path):
+        """
+        Opens the video and loads or builds its seek index, see
+        `SeekIndex.load_or_build`.
+
+        Parameters
+        ----------
+        video_path : str
+            The full path to the video file
+
+        Raises
+        ------
+        RuntimeError
+            If the video cannot be opened
+        """
+
+        self.video_path = video_path
+        self.capture = cv2.VideoCapture(video_path)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"Could not open the video: {video_path}.")
+
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.seek_index = SeekIndex.load_or_build(video_path)
+
+        # Without a seek index, skip at most this many frames by decoding instead of seeking
+        self.forward_decode_limit = 16
+
+        # Index of the frame the capture decodes next
+        self._next_index = 0
+
+    def read_frames(self, indices):
+        """
+        Yields the frames at `indices`, stopping early if the video ends
+        before the last index.
+
+        Parameters
+        ----------
+        indices : array-like of ints
+            Increasing frame indices in the unreduced video
+
+        Yields
+        ------
+        index : int
+            The frame index
+        frame : numpy.ndarray
+            The frame as a BGR image
+
+        Examples
+        --------
+        >>> reader = VideoFrameReader("path/to/GX137102.MP4")
+        >>> for index, frame in reader.read_frames([0, 8, 16]):
+        ...     cv2.imwrite(f"{index}.jpg", frame)
+        """
+
+        for index in indices:
+            index = int(index)
+            if not self._can_decode_forward(index):
+                start = index if self.seek_index is None else self.seek_index.keyframe_before(index)
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+                self._next_index = start
+
+            # Skipped frames are decoded but not converted to images
+            while self._next_index < index:
+                if not self.capture.grab():
+                    return
+                self._next_index += 1
+
+            ret, frame = self.capture.read()
+            if not ret:
+                # The reported frame count can overestimate the video length
+                return
+            self._next_index = index + 1
+            yield index, frame
+
+    def _can_decode_forward(self, index):
+        """
+        Returns whether `index` can be reached by decoding forward from
+        the capture's position without passing a keyframe.
+        """
+
+        if index < self._next_index:
+            return False
+        if self.seek_index is None:
+            return index - self._next_index <= self.forward_decode_limit
+        return self.seek_index.keyframe_before(index) <= self._next_index
+
+    def close(self):
+        """
+        Releases the video.
+        """
+
+        self.capture.release()
+
+
+class VideoFrameSource:
+    """
+    A class used to provide the frames ingested by SAM2 straight from
+    the source video, sampled by `out_fps` and `SAM2_start` like
+    `extract_frames`, so frames do not have to be extracted to JPGs and
+    decoded again. The segmenter and the video renderer both read
+    frames from it.
+
+    With `cache_dir`, the first full pass over the frames (see
+    `frames`) also stores them, decoded, in a memory-mapped `.npy` file
+    that later passes, trials and processes read instead of decoding
+    the video again. The cache holds uncompressed frames, so it is much
+    larger than the JPGs.
+
+    Methods
+    -------
+    __init__(self, video_path, fps, out_fps, SAM2_start=0, cache_dir=None)
+        Opens the video and the decoded-frame cache
+    __len__(self)
+        Returns the number of SAM2 frames
+    frame_id(self, frame_idx)
+        Returns a string identifying a frame of this video
+    frames(self)
+        Yields every frame in order, filling the cache
+    get_frame(self, frame_idx)
+        Returns one frame
+    close(self)
+        Releases the video and the cache
+    """
+
+    def __init__(self, video_path, fps, out_fps, SAM2_start=0, cache_dir=None):
+        """
+        Opens the video and, if there is one, the complete decoded-frame
+        cache of the video.
+
+        Parameters
+        ----------
+        video_path : str
+            The full path to the video file
+        fps : int, float or Fraction
+            The FPS of the unreduced video that the annotations were
+            created for
+        out_fps : int, float or Fraction
+            The FPS of the frames ingested by SAM2
+        SAM2_start : int
+            The raw frame that is the first SAM2 frame
+        cache_dir : str or None
+            The directory of the decoded-frame cache, None disables it
+
+        Examples
+        --------
+        >>> source = VideoFrameSource("path/to/GX137102.MP4", fps=24, out_fps=3, SAM2_start=2)
+        >>> frame = source.get_frame(10)
+        """
+
+        self.video_path = video_path
+        self.reader = VideoFrameReader(video_path)
+        self.mapping = FrameMapping(fps, out_fps, SAM2_start, self.reader.frame_count)
+        self.raw_frames = self.mapping.sam2_frames
+
+        # The video file and sampling identify the frames, e.g. for caches
+        stat = os.stat(video_path)
+        self._video_id = ":".join(str(value) for value in [os.path.abspath(video_path), stat.st_size, stat.st_mtime,
+                                                           self.mapping.fps, self.mapping.out_fps, self.mapping.SAM2_start])
+
+        self.cache = None
+        self.cache_path = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            name = hashlib.sha1(self._video_id.encode()).hexdigest()[:16]
+            self.cache_path = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(video_path))[0]}_{name}.npy")
+            # The marker is only written once every frame is in the cache
+            if os.path.exists(self.cache_path + ".complete"):
+                self.cache = np.load(self.cache_path, mmap_mode="r")
+
+    def __len__(self):
+        """
+        Returns the number of SAM2 frames.
+        """
+
+        return len(self.raw_frames)
+
+    def frame_id(self, frame_idx):
+        """
+        Returns a string identifying SAM2 frame `frame_idx` of this
+        video, which changes if the video file changes.
+        """
+
+        return f"{self._video_id}:{int(self.raw_frames[frame_idx])}"
+
+    def frames(self):
+        """
+        Yields every SAM2 frame in order, decoding only the needed frames
+        of the video. If the cache is enabled but not filled yet, the
+        frames are also stored in it.
+
+        Yields
+        ------
+        frame_idx : int
+            The SAM2 frame index
+        frame : numpy.ndarray
+            The frame as a BGR image
+        """
+
+        if self.cache is not None:
+            for frame_idx in range(len(self)):
+                yield frame_idx, self.cache[frame_idx]
+            return
+
+        cache = None
+        position = {raw_frame: frame_idx for frame_idx, raw_frame in enumerate(self.raw_frames.tolist())}
+        decoded = 0
+        for raw_frame, frame in self.reader.read_frames(self.raw_frames):
+            frame_idx = position[raw_frame]
+            if self.cache_path is not None:
+                if cache is None:
+                    cache = np.lib.format.open_memmap(self.cache_path + ".tmp", mode="w+", dtype=np.uint8,
+                                                      shape=(len(self),) + frame.shape)
+                cache[frame_idx] = frame
+            decoded += 1
+            yield frame_idx, frame
+
+        if cache is not None and decoded == len(self):
+            # Complete caches are renamed into place, so readers never load a partly written cache
+            cache.flush()
+            del cache
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+            with open(self.cache_path + ".complete", "w"):
+                pass
+            self.cache = np.load(self.cache_path, mmap_mode="r")
+
+    def get_frame(self, frame_idx):
+        """
+        Returns SAM2 frame `frame_idx`, from the cache if it is filled.
+        Reading frames in increasing order is fastest, since the video
+        is then decoded forward without seeking.
+
+        Parameters
+        ----------
+        frame_idx : int
+            The SAM2 frame index
+
+        Returns
+        -------
+        numpy.ndarray
+            The frame as a BGR image
+
+        Raises
+        ------
+        IndexError
+            If the frame could not be decoded
+        """
+
+        if self.cache is not None:
+            return self.cache[frame_idx]
+
+        for _, frame in self.reader.read_frames([self.raw_frames[frame_idx]]):
+            return frame
+        raise IndexError(f"Frame {frame_idx} could not be decoded from {self.video_path}.")
+
+    def close(self):
+        """
+        Releases the video and the cache.
+        """
+
+        self.reader.close()
+        self.cache = None
+
+
+def extract_frames(video_path, frame_dir, fps, out_fps, SAM2_start=0, jpg_quality=95, threads=4):
+    """
+    Extracts the frames ingested by SAM2 from a video to JPGs named
+    `00001.jpg`, `00002.jpg`, ... in `frame_dir`. SAM2 frame `k` is raw
+    frame `SAM2_start + round(k * fps / out_fps)` (see
+    `frame_utils.FrameMapping`), so non-integer frame rates are sampled
+    without drift. Only the needed frames are decoded (see
+    `VideoFrameReader`), JPGs are encoded and written by a pool of
+    threads, and frames whose JPG already exists are skipped, so an
+    interrupted extraction resumes where it stopped.
+
+    Parameters
+    ----------
+    video_path : str
+        The full path to the video file
+    frame_dir : str
+        The directory to write the JPGs to, created if needed
+    fps : int, float or Fraction
+        The FPS of the unreduced video that the annotations were
+        created for
+    out_fps : int, float or Fraction
+        The FPS of the frames ingested by SAM2
+    SAM2_start : int
+        The raw frame that is the first SAM2 frame
+    jpg_quality : int
+        The JPG quality, from 0 to 100
+    threads : int
+        The number of threads encoding and writing JPGs
+
+    Returns
+    -------
+    int
+        The number of JPGs written
+
+    Examples
+    --------
+    >>> extract_frames("path/to/GX137102.MP4", "./frames", fps=24, out_fps=3, SAM2_start=2)
+    Extracting 1520 of 1520 frames from path/to/GX137102.MP4 to ./frames
+    1520
+    """
+
+    os.makedirs(frame_dir, exist_ok=True)
+    reader = VideoFrameReader(video_path)
+    mapping = FrameMapping(fps, out_fps, SAM2_start, reader.frame_count)
+
+    # SAM2 frames whose JPG is not on disk yet
+    paths = [os.path.join(frame_dir, f"{k + 1:05d}.jpg") for k in range(len(mapping.sam2_frames))]
+    pending = [k for k, path in enumerate(paths) if not os.path.exists(path)]
+    print(f"Extracting {len(pending)} of {len(paths)} frames from {video_path} to {frame_dir}")
+
+    def write_jpg(frame, path):
+        # Written under a temporary name first, so a partly written JPG is never skipped on a rerun
+        ok, jpg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, int(jpg_quality)])
+        if not ok:
+            raise RuntimeError(f"Could not encode {path}.")
+        with open(path + ".tmp", "wb") as file:
+            file.write(jpg.tobytes())
+        os.replace(path + ".tmp", path)
+
+    written = 0
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = []
+        sam2_of_raw = dict(zip(mapping.sam2_frames[pending].tolist(), pending))
+        for index, frame in reader.read_frames(mapping.sam2_frames[pending]):
+            futures.append(pool.submit(write_jpg, frame, paths[sam2_of_raw[index]]))
+
+            # Bound the number of decoded frames waiting to be written
+            if len(futures) >= 4 * max(1, threads):
+                futures.pop(0).result()
+                written += 1
+        for future in futures:
+            future.result()
+            written += 1
+    reader.close()
+
+    if written < len(pending):
+        print(f"Warning: the video ended early, {len(pending) - written} frame(s) of {video_path} were not extracted.")
+
+    return written
+
+
+# Encoder of each codec name for FFmpeg and PyAV, and its OpenCV fourcc
+CODECS = {
+    "h264": ("libx264", "avc1"),
+    "h265": ("libx265", "hvc1"),
+    "vp9": ("libvpx-vp9", "VP90"),
+    "mpeg4": ("mpeg4", "mp4v"),
+}
+
+# Encoders that take a constant rate factor and a preset
+CRF_ENCODERS = {"libx264", "libx265", "libvpx-vp9"}
+PRESET_ENCODERS = {"libx264", "libx265"}
+
+VIDEO_WRITERS = ["opencv", "ffmpeg", "pyav"]
+
+
+def encoder_options(encoder, crf=23, preset="medium", threads=0):
+    """
+    Returns the encoder options for FFmpeg and PyAV. Options an encoder
+    does not support are left out, so any encoder FFmpeg knows, e.g. a
+    hardware encoder such as `h264_nvenc`, can be used with its defaults.
+
+    Parameters
+    ----------
+    encoder : str
+        The FFmpeg encoder, e.g. `libx264`
+    crf : int
+        The constant rate factor, lower is better quality and larger files
+    preset : str
+        The speed preset, slower presets compress better
+    threads : int
+        The number of encoding threads, 0 lets the encoder choose
+
+    Returns
+    -------
+    dict
+        The options, as strings
+    """
+
+    options = {"threads": str(threads)}
+    if encoder in CRF_ENCODERS and crf is not None:
+        options["crf"] = str(crf)
+        if encoder == "libvpx-vp9":
+            # VP9 is only constant quality without a target bitrate
+            options["b:v"] = "0"
+    if encoder in PRESET_ENCODERS and preset:
+        options["preset"] = preset
+    return options
+
+
+class OpenCVVideoWriter:
+    """
+    A class used to write video frames with `cv2.VideoWriter`. Which
+    codecs are available depends on how OpenCV was built; `mpeg4` is
+    always available.
+
+    Methods
+    -------
+    __init__(self, video_file, fps, width, height, codec="mpeg4")
+        Opens the video for writing
+    write(self, frame)
+        Writes a frame
+    close(self)
+        Finishes the video
+    """
+
+    def __init__(self, video_file, fps, width, height, codec="mpeg4"):
+        """
+        Opens the video for writing.
+
+        Parameters
+        ----------
+        video_file : str
+            The video file to write
+        fps : int or float
+            The frames per second of the video
+        width : int
+            The width of the frames
+        height : int
+            The height of the frames
+        codec : str
+            A codec of `CODECS`, or a fourcc
+
+        Raises
+        ------
+        RuntimeError
+            If OpenCV cannot write the video with `codec`
+        """
+
+        fourcc = CODECS[codec][1] if codec in CODECS else codec
+        self.video = cv2.VideoWriter(video_file, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+        if not self.video.isOpened():
+            raise RuntimeError(f"OpenCV cannot write {video_file} with the codec '{codec}', "
+                               "use the 'mpeg4' codec or the 'ffmpeg' or 'pyav' video writer.")
+
+    def write(self, frame):
+        """
+        Writes a (height, width, 3) BGR frame.
+        """
+
+        self.video.write(frame)
+
+    def close(self):
+        """
+        Finishes the video.
+        """
+
+        self.video.release()
+
+
+class FFmpegVideoWriter:
+    """
+    A class used to write video frames by streaming them as raw BGR
+    pixels to an `ffmpeg` process, which encodes them with any encoder
+    FFmpeg supports.
+
+    Methods
+    -------
+    __init__(self, video_file, fps, width, height, codec="h264", crf=23, preset="medium", threads=0)
+        Starts the encoder process
+    write(self, frame)
+        Writes a frame
+    close(self)
+        Finishes the video
+    """
+
+    def __init__(self, video_file, fps, width, height, codec="h264", crf=23, preset="medium", threads=0):
+        """
+        Starts the encoder process.
+
+        Parameters
+        ----------
+        video_file : str
+            The video file to write
+        fps : int or float
+            The frames per second of the video
+        width : int
+            The width of the frames
+        height : int
+            The height of the frames
+        codec : str
+            A codec of `CODECS`, or an FFmpeg encoder, e.g. `h264_nvenc`
+        crf : int
+            The constant rate factor, lower is better quality and larger files
+        preset : str
+            The speed preset, slower presets compress better
+        threads : int
+            The number of encoding threads, 0 lets the encoder choose
+
+        Raises
+        ------
+        RuntimeError
+            If `ffmpeg` is not installed
+        """
+
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg was not found, install it or use the 'opencv' video writer.")
+
+        encoder = CODECS[codec][0] if codec in CODECS else codec
+        command = ["ffmpeg", "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(exact_fps(fps)), "-i", "-",
+                   "-c:v", encoder, "-pix_fmt", "yuv420p"]
+        for option, value in encoder_options(encoder, crf, preset, threads).items():
+            command += [f"-{option}", value]
+        command.append(video_file)
+
+        self.video_file = video_file
+        # A file instead of a pipe, so ffmpeg never blocks on a full stderr pipe that is only read at the end
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self.stderr)
+        self.error = ""
+
+    def write(self, frame):
+        """
+        Writes a (height, width, 3) BGR frame.
+
+        Raises
+        ------
+        RuntimeError
+            If the encoder process exited
+        """
+
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except BrokenPipeError:
+            # close raises if ffmpeg failed, but the frame is lost even if it exited cleanly
+            self.close()
+            raise RuntimeError(f"ffmpeg exited before the video {self.video_file} was finished:\n{self.error}")
+
+    def close(self):
+        """
+        Finishes the video.
+
+        Raises
+        ------
+        RuntimeError
+            If the encoder failed
+        """
+
+        if self.process.stdin.closed:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        self.error = self.stderr.read().decode(errors="replace")
+        self.stderr.close()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to write {self.video_file}:\n{self.error}")
+
+
+class PyAVVideoWriter:
+    """
+    A class used to write video frames with PyAV, which encodes them with
+    the FFmpeg libraries in this process. Requires the `av` package.
+
+    Methods
+    -------
+    __init__(self, video_file, fps, width, height, codec="h264", crf=23, preset="medium", threads=0)
+        Opens the video for writing
+    write(self, frame)
+        Writes a frame
+    close(self)
+        Finishes the video
+    """
+
+    def __init__(self, video_file, fps, width, height, codec="h264", crf=23, preset="medium", threads=0):
+        """
+        Opens the video for writing.
+
+        Parameters
+        ----------
+        video_file : str
+            The video file to write
+        fps : int or float
+            The frames per second of the video
+        width : int
+            The width of the frames
+        height : int
+            The height of the frames
+        codec : str
+            A codec of `CODECS`, or an FFmpeg encoder, e.g. `h264_nvenc`
+        crf : int
+            The constant rate factor, lower is better quality and larger files
+        preset : str
+            The speed preset, slower presets compress better
+        threads : int
+            The number of encoding threads, 0 lets the encoder choose
+        """
+
+        import av
+
+        self.av = av
+        encoder = CODECS[codec][0] if codec in CODECS else codec
+        options = encoder_options(encoder, crf, preset, threads)
+
+        self.container = av.open(video_file, mode="w")
+        self.stream = self.container.add_stream(encoder, rate=exact_fps(fps))
+        self.stream.width = width
+        self.stream.height = height
+        self.stream.pix_fmt = "yuv420p"
+        self.stream.thread_count = int(options.pop("threads"))
+        self.stream.options = options
+
+    def write(self, frame):
+        """
+        Writes a (height, width, 3) BGR frame.
+        """
+
+        video_frame = self.av.VideoFrame.from_ndarray(frame, format="bgr24")
+        for packet in self.stream.encode(video_frame):
+            self.container.mux(packet)
+
+    def close(self):
+        """
+        Finishes the video, flushing the encoder.
+        """
+
+        for packet in self.stream.encode():
+            self.container.mux(packet)
+        self.container.close()
+
+
+class ThreadedVideoWriter:
+    """
+    A class used to encode video frames in a background thread, so
+    encoding overlaps rendering. Frames wait in a bounded queue, so a
+    slow encoder holds back rendering instead of buffering every frame
+    in memory.
+
+    Methods
+    -------
+    __init__(self, writer, queue_size=16)
+        Starts the encoding thread
+    write(self, frame)
+        Queues a frame
+    close(self)
+        Encodes the queued frames and finishes the video
+    """
+
+    def __init__(self, writer, queue_size=16):
+        """
+        Starts the encoding thread.
+
+        Parameters
+        ----------
+        writer : OpenCVVideoWriter, FFmpegVideoWriter or PyAVVideoWriter
+            The writer encoding the frames
+        queue_size : int
+            The maximum number of frames waiting to be encoded
+        """
+
+        self.writer = writer
+        self.frames = queue.Queue(maxsize=max(1, queue_size))
+        self.error = None
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def _encode(self):
+        """
+        Writes queued frames until it receives None.
+        """
+
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.write(frame)
+                except Exception as error:
+                    # Kept to be raised in the rendering thread, the queue is still drained
+                    self.error = error
+
+    def write(self, frame):
+        """
+        Queues a (height, width, 3) BGR frame, waiting while the queue
+        is full.
+
+        Raises
+        ------
+        Exception
+            Any error of the writer on an earlier frame
+        """
+
+        if self.error is not None:
+            raise self.error
+        self.frames.put(frame)
+
+    def close(self):
+        """
+        Encodes the queued frames and finishes the video. The writer is
+        closed even if it failed on a frame, so its file is released.
+
+        Raises
+        ------
+        Exception
+            Any error of the writer
+        """
+
+        self.frames.put(None)
+        self.thread.join()
+        try:
+            self.writer.close()
+        finally:
+            if self.error is not None:
+                raise self.error
+
+
+def open_video_writer(video_file, fps, width, height, writer="opencv", codec="mpeg4", crf=23,
+                      preset="medium", threads=0, queue_size=16):
+    """
+    Opens a video for writing with the chosen writer backend, encoding in
+    a background thread.
+
+    Parameters
+    ----------
+    video_file : str
+        The video file to write
+    fps : int or float
+        The frames per second of the video
+    width : int
+        The width of the frames
+    height : int
+        The height of the frames
+    writer : str
+        The writer backend, `opencv`, `ffmpeg` or `pyav`
+    codec : str
+        `h264`, `h265`, `vp9` or `mpeg4`, or an FFmpeg encoder (e.g.
+        `h264_nvenc`) for the `ffmpeg` and `pyav` writers
+    crf : int
+        The constant rate factor of the `h264`, `h265` and `vp9` codecs,
+        lower is better quality and larger files
+    preset : str
+        The speed preset of the `h264` and `h265` codecs
+    threads : int
+        The number of encoding threads, 0 lets the encoder choose
+    queue_size : int
+        The maximum number of frames waiting to be encoded
+
+    Returns
+    -------
+    ThreadedVideoWriter
+        The writer, with `write(frame)` and `close()` methods
+
+    Raises
+    ------
+    ValueError
+        If `writer` is not a writer backend
+
+    Examples
+    --------
+    >>> video = open_video_writer("./test_video.mp4", 3, 900, 600, writer="ffmpeg", codec="h264", crf=23)
+    >>> video.write(frame)
+    >>> video.close()
+    """
+
+    if writer == "opencv":
+        backend = OpenCVVideoWriter(video_file, fps, width, height, codec)
+    elif writer == "ffmpeg":
+        backend = FFmpegVideoWriter(video_file, fps, width, height, codec, crf, preset, threads)
+    elif writer == "pyav":
+        backend = PyAVVideoWriter(video_file, fps, width, height, codec, crf, preset, threads)
+    else:
+        raise ValueError(f"writer must be one of {VIDEO_WRITERS}, got '{writer}'.")
+
+    return ThreadedVideoWriter(backend, queue_size)
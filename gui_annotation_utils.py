@@ -0,0 +1,1046 @@
+import csv
+from collections import defaultdict
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from tkinter import ttk, VERTICAL
+
+import numpy as np
+import pandas as pd
+
+# Keys of the annotation dicts, in the order they are saved
+ANNOTATION_KEYS = ["Frame", "ClickType", "ObjID", "ObjType", "Location"]
+
+
+def write_annotations_npy(file_path, records):
+    """
+    Saves annotations as an array of dicts, the format read by
+    `utils.adjust_annotations`.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the `.npy` file to write
+    records : list of dict
+        Annotations with keys "Frame", "ClickType", "ObjID",
+        "ObjType" and "Location"
+    """
+
+    np.save(file_path, records)
+
+
+def write_annotations_csv(file_path, records):
+    """
+    Saves annotations as a CSV with one column per annotation key and
+    the location written as a list.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the `.csv` file to write
+    records : list of dict
+        Annotations with keys "Frame", "ClickType", "ObjID",
+        "ObjType" and "Location"
+    """
+
+    with open(file_path, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=ANNOTATION_KEYS)
+        writer.writeheader()
+        for record in records:
+            writer.writerow({**record, "Location": np.asarray(record["Location"]).tolist()})
+
+
+def read_annotations_csv(file_path):
+    """
+    Reads annotations from a CSV written by `write_annotations_csv`
+    as columns ready for `AnnotationStore.extend_columns`. All columns
+    are validated and parsed at once, and the "Location" column is
+    parsed with vectorized string operations instead of `eval`.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the `.csv` file to read
+
+    Returns
+    -------
+    dict
+        Dictionary with keys "frames", "click_types", "obj_ids",
+        "obj_types" and "locations"
+
+    Raises
+    ------
+    ValueError
+        If a column is missing or a value could not be parsed
+    """
+
+    # ObjID is read as a string, as the GUI stores the fish name typed in
+    df = pd.read_csv(file_path, dtype={"ObjID": str, "ObjType": str, "Location": str})
+
+    missing = [col for col in ANNOTATION_KEYS if col not in df.columns]
+    if missing:
+        raise ValueError(f"The CSV file must contain the following columns: {', '.join(ANNOTATION_KEYS)}.")
+
+    for col in ["Frame", "ClickType"]:
+        values = pd.to_numeric(df[col], errors="coerce")
+        if values.isna().any():
+            rows = np.flatnonzero(values.isna())[:5].tolist()
+            raise ValueError(f"Column {col} has missing or non-numeric values on row(s) {rows}.")
+        df[col] = values
+
+    # Locations are written as "[x, y]", also accept "(x, y)" and "[x y]"
+    location = df["Location"].str.extract(r"^\s*[\[(]?\s*([-+0-9.eE]+)[\s,]+([-+0-9.eE]+)")
+    location = location.apply(pd.to_numeric, errors="coerce")
+    invalid = location.isna().any(axis=1)
+    if invalid.any():
+        rows = np.flatnonzero(invalid)[:5].tolist()
+        raise ValueError(f"Column Location could not be parsed on row(s) {rows}.")
+
+    return {
+        "frames": df["Frame"].to_numpy(dtype=np.int64),
+        "click_types": df["ClickType"].to_numpy(dtype=np.int64),
+        "obj_ids": df["ObjID"].tolist(),
+        "obj_types": df["ObjType"].tolist(),
+        "locations": location.to_numpy(dtype=np.float64),
+    }
+
+
+class AnnotationStore:
+    """
+    A class used to hold the annotations collected in the GUI in a
+    compact, array-backed (columnar) form. Every annotation gets a
+    stable ID when it is added, which is its row in the column arrays,
+    and secondary indexes map each frame and each `ObjID` to the IDs of
+    their annotations. Listeners are notified of each insert, update,
+    delete or clear, so views such as the annotation table can update
+    incrementally instead of being rebuilt after every change.
+
+    Methods
+    -------
+    subscribe(self, listener)
+        Registers `listener` to be called with every change
+    unsubscribe(self, listener)
+        Stops notifying `listener` of changes
+    add(self, annotation)
+        Adds a single annotation and returns its ID
+    extend(self, annotations)
+        Adds several annotations with a single notification
+    extend_columns(self, frames, click_types, obj_ids, obj_types, locations)
+        Adds annotations given as columns with a single notification
+    update(self, ann_id, **fields)
+        Changes fields of an existing annotation
+    delete(self, ann_ids)
+        Deletes the annotations with the given IDs
+    clear(self)
+        Deletes all annotations
+    get(self, ann_id)
+        Returns the annotation with the given ID as a dict
+    ids(self, start=0, stop=None)
+        Returns the IDs between two positions of the store
+    ids_for_frame(self, frame)
+        Returns the IDs of the annotations on a frame
+    ids_for_obj(self, obj_id)
+        Returns the IDs of the annotations of an object
+    entry_exit_counts(self)
+        Returns the number of entries and exits of each object
+    columns(self, ann_ids=None)
+        Returns a copy of annotations as columns
+    to_records(self, click_types)
+        Returns annotations as the dicts saved in `*_annotations.npy`
+    save_npy(self, file_path, click_types=(0, 1, 3, 4))
+        Saves annotations in the `*_annotations.npy` format
+    save_csv(self, file_path, click_types=(2,))
+        Saves annotations in the `*_bites.csv` format
+    """
+
+    def __init__(self, capacity=1024):
+        self._listeners = []
+        self._allocate(capacity)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return (self.get(ann_id) for ann_id in self._live_ids())
+
+    def subscribe(self, listener):
+        """
+        Registers `listener` to be called as `listener(event, ann_ids)`
+        after every change, where `event` is one of "insert",
+        "update", "delete" or "clear".
+
+        Parameters
+        ----------
+        listener : callable
+            The function to notify of changes
+        """
+
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """
+        Stops notifying `listener` of changes.
+
+        Parameters
+        ----------
+        listener : callable
+            A function registered with `subscribe`
+        """
+
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def add(self, annotation):
+        """
+        Adds a single annotation.
+
+        Parameters
+        ----------
+        annotation : dict
+            Annotation with keys "Frame", "ClickType", "ObjID",
+            "ObjType" and "Location"
+
+        Returns
+        -------
+        int
+            The ID of the new annotation
+        """
+
+        return self.extend([annotation])[0]
+
+    def extend(self, annotations):
+        """
+        Adds several annotations, notifying listeners once.
+
+        Parameters
+        ----------
+        annotations : iterable of dict
+            Annotations with keys "Frame", "ClickType", "ObjID",
+            "ObjType" and "Location"
+
+        Returns
+        -------
+        list of int
+            The IDs of the new annotations
+        """
+
+        annotations = list(annotations)
+        return self.extend_columns(
+            frames=[annotation["Frame"] for annotation in annotations],
+            click_types=[annotation["ClickType"] for annotation in annotations],
+            obj_ids=[annotation["ObjID"] for annotation in annotations],
+            obj_types=[annotation["ObjType"] for annotation in annotations],
+            locations=[np.asarray(annotation["Location"], dtype=np.float64)[:2] for annotation in annotations],
+        )
+
+    def extend_columns(self, frames, click_types, obj_ids, obj_types, locations):
+        """
+        Adds annotations given as columns, notifying listeners once.
+
+        Parameters
+        ----------
+        frames : array-like of ints
+            The frame of each annotation
+        click_types : array-like of ints
+            The click type of each annotation
+        obj_ids : sequence
+            The object ID (fish name) of each annotation
+        obj_types : sequence of str
+            The object type (fish family) of each annotation
+        locations : array-like of floats
+            Array of shape (n, 2) with the x, y location of each annotation
+
+        Returns
+        -------
+        list of int
+            The IDs of the new annotations
+        """
+
+        count = len(frames)
+        start = self._size
+        stop = start + count
+        self._reserve(stop)
+
+        self._frame[start:stop] = frames
+        self._click_type[start:stop] = click_types
+        self._obj_code[start:stop] = [self._code(self._obj_codes, self._obj_values, obj_id) for obj_id in obj_ids]
+        self._type_code[start:stop] = [self._code(self._type_codes, self._type_values, obj_type) for obj_type in obj_types]
+        if count:
+            self._location[start:stop] = np.asarray(locations, dtype=np.float64).reshape(count, 2)
+        self._alive[start:stop] = True
+        self._size = stop
+        self._count += count
+        self._order = None
+
+        ann_ids = list(range(start, stop))
+        for ann_id in ann_ids:
+            self._index(ann_id)
+
+        self._notify("insert", ann_ids)
+        return ann_ids
+
+    def update(self, ann_id, **fields):
+        """
+        Changes fields of an existing annotation.
+
+        Parameters
+        ----------
+        ann_id : int
+            The ID of the annotation to change
+        **fields
+            The annotation keys and their new values
+        """
+
+        self._unindex(ann_id)
+        if "Frame" in fields:
+            self._frame[ann_id] = fields["Frame"]
+        if "ClickType" in fields:
+            self._click_type[ann_id] = fields["ClickType"]
+        if "ObjID" in fields:
+            self._obj_code[ann_id] = self._code(self._obj_codes, self._obj_values, fields["ObjID"])
+        if "ObjType" in fields:
+            self._type_code[ann_id] = self._code(self._type_codes, self._type_values, fields["ObjType"])
+        if "Location" in fields:
+            self._location[ann_id] = np.asarray(fields["Location"], dtype=np.float64)[:2]
+        self._index(ann_id)
+
+        self._notify("update", [ann_id])
+
+    def delete(self, ann_ids):
+        """
+        Deletes the annotations with the given IDs. IDs are not reused.
+
+        Parameters
+        ----------
+        ann_ids : iterable of int
+            The IDs of the annotations to delete
+        """
+
+        ann_ids = [ann_id for ann_id in ann_ids if 0 <= ann_id < self._size and self._alive[ann_id]]
+        for ann_id in ann_ids:
+            self._alive[ann_id] = False
+            self._unindex(ann_id)
+
+        self._count -= len(ann_ids)
+        self._order = None
+        self._notify("delete", ann_ids)
+
+    def clear(self):
+        """
+        Deletes all annotations.
+        """
+
+        self._allocate(len(self._frame))
+        self._notify("clear", [])
+
+    def get(self, ann_id):
+        """
+        Returns the annotation with ID `ann_id`.
+
+        Returns
+        -------
+        dict
+            Annotation with keys "Frame", "ClickType", "ObjID",
+            "ObjType" and "Location"
+        """
+
+        return {
+            "Frame": int(self._frame[ann_id]),
+            "ClickType": int(self._click_type[ann_id]),
+            "ObjID": self._obj_values[self._obj_code[ann_id]],
+            "ObjType": self._type_values[self._type_code[ann_id]],
+            "Location": self._location[ann_id].copy(),
+        }
+
+    def ids(self, start=0, stop=None):
+        """
+        Returns the IDs of the annotations between positions `start`
+        and `stop` of the store, in the order they were added.
+        """
+
+        return self._live_ids()[start:stop].tolist()
+
+    def ids_for_frame(self, frame):
+        """
+        Returns the IDs of all annotations on `frame`.
+        """
+
+        return sorted(self._by_frame.get(frame, ()))
+
+    def ids_for_obj(self, obj_id):
+        """
+        Returns the IDs of all annotations of object `obj_id`.
+        """
+
+        return sorted(self._by_obj.get(obj_id, ()))
+
+    def entry_exit_counts(self):
+        """
+        Counts the entries (ClickType 3) and exits (ClickType 4) of
+        every object that has at least one of either.
+
+        Returns
+        -------
+        dict of tuple of ints
+            Dictionary with keys corresponding to the object ID and
+            values the number of entries and exits, respectively
+        """
+
+        alive = self._alive[:self._size]
+        click_type = self._click_type[:self._size]
+        obj_code = self._obj_code[:self._size]
+
+        entries = np.bincount(obj_code[alive & (click_type == 3)], minlength=len(self._obj_values))
+        exits = np.bincount(obj_code[alive & (click_type == 4)], minlength=len(self._obj_values))
+
+        return {self._obj_values[code]: (int(entries[code]), int(exits[code]))
+                for code in np.flatnonzero(entries + exits)}
+
+    def columns(self, ann_ids=None):
+        """
+        Returns a copy of the annotations with IDs `ann_ids` as columns,
+        taken with vectorised indexing so it stays cheap for many rows.
+
+        Parameters
+        ----------
+        ann_ids : sequence of ints, optional
+            The IDs to include, all live annotations in the order they
+            were added if None
+
+        Returns
+        -------
+        dict
+            Arrays under "id", "Frame", "ClickType", "ObjID", "ObjType"
+            and "Location", one row per annotation
+        """
+
+        ann_ids = self._live_ids() if ann_ids is None else np.asarray(ann_ids, dtype=np.int64)
+        return {
+            "id": ann_ids.copy(),
+            "Frame": self._frame[ann_ids],
+            "ClickType": self._click_type[ann_ids],
+            "ObjID": self._decode(self._obj_values, self._obj_code[ann_ids]),
+            "ObjType": self._decode(self._type_values, self._type_code[ann_ids]),
+            "Location": self._location[ann_ids],
+        }
+
+    def to_records(self, click_types):
+        """
+        Returns the annotations with a click type in `click_types` as
+        dicts, in the order they were added.
+
+        Parameters
+        ----------
+        click_types : sequence of ints
+            The click types to include
+
+        Returns
+        -------
+        list of dict
+            Annotations with keys "Frame", "ClickType", "ObjID",
+            "ObjType" and "Location"
+        """
+
+        order = self._live_ids()
+        selected = order[np.isin(self._click_type[order], click_types)]
+        return [self.get(ann_id) for ann_id in selected]
+
+    def save_npy(self, file_path, click_types=(0, 1, 3, 4)):
+        """
+        Saves the annotations with a click type in `click_types` as an
+        array of dicts, the format read by `utils.adjust_annotations`.
+
+        Returns
+        -------
+        int
+            The number of annotations saved
+        """
+
+        records = self.to_records(click_types)
+        write_annotations_npy(file_path, records)
+        return len(records)
+
+    def save_csv(self, file_path, click_types=(2,)):
+        """
+        Saves the annotations with a click type in `click_types` as a
+        CSV with one column per annotation key.
+
+        Returns
+        -------
+        int
+            The number of annotations saved
+        """
+
+        records = self.to_records(click_types)
+        write_annotations_csv(file_path, records)
+        return len(records)
+
+    def _allocate(self, capacity):
+        """
+        Creates empty columns and indexes with room for `capacity`
+        annotations.
+        """
+
+        self._frame = np.zeros(capacity, dtype=np.int64)
+        self._click_type = np.zeros(capacity, dtype=np.int8)
+        self._obj_code = np.zeros(capacity, dtype=np.int32)
+        self._type_code = np.zeros(capacity, dtype=np.int32)
+        self._location = np.zeros((capacity, 2), dtype=np.float64)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._size = 0
+        self._count = 0
+
+        # Object IDs and types are stored as codes into these lists
+        self._obj_values, self._obj_codes = [], {}
+        self._type_values, self._type_codes = [], {}
+
+        # IDs of live annotations in the order they were added, built by _live_ids when needed
+        self._order = None
+
+        # Secondary indexes from frame and object ID to annotation IDs
+        self._by_frame = defaultdict(set)
+        self._by_obj = defaultdict(set)
+
+    def _reserve(self, size):
+        """
+        Grows the columns, doubling their capacity, until `size` fits.
+        """
+
+        capacity = len(self._frame)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+
+        for name in ["_frame", "_click_type", "_obj_code", "_type_code", "_location", "_alive"]:
+            column = getattr(self, name)
+            grown = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    def _live_ids(self):
+        """
+        Returns the IDs of the live annotations in the order they were
+        added. IDs are assigned in increasing order and never reused,
+        so this is every ID still alive; the array is cached until the
+        next insert or delete, which only mark IDs in `_alive`.
+        """
+
+        if self._order is None:
+            self._order = np.flatnonzero(self._alive[:self._size])
+        return self._order
+
+    @staticmethod
+    def _decode(values, codes):
+        lookup = np.empty(len(values), dtype=object)
+        lookup[:] = values
+        return lookup[codes]
+
+    @staticmethod
+    def _code(codes, values, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def _index(self, ann_id):
+        self._by_frame[int(self._frame[ann_id])].add(ann_id)
+        self._by_obj[self._obj_values[self._obj_code[ann_id]]].add(ann_id)
+
+    def _unindex(self, ann_id):
+        self._by_frame[int(self._frame[ann_id])].discard(ann_id)
+        self._by_obj[self._obj_values[self._obj_code[ann_id]]].discard(ann_id)
+
+    def _notify(self, event, ann_ids):
+        for listener in self._listeners:
+            listener(event, ann_ids)
+
+
+def autosave_journal_path(video_path, autosave_dir="autosave"):
+    """
+    Returns the path of the autosave journal of a video, so each video
+    has its own journal and exported files. The name combines the
+    video's file name with a hash of its full path, which tells apart
+    videos with the same name in different folders.
+
+    Parameters
+    ----------
+    video_path : str
+        The path of the annotated video
+    autosave_dir : str
+        The directory holding the journals
+
+    Returns
+    -------
+    str
+        The path of the journal file
+
+    Examples
+    --------
+    >>> autosave_journal_path("/data/trial1/GX137102.MP4")
+    'autosave/GX137102_863c3ad6.journal'
+    """
+
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    digest = hashlib.sha1(os.path.abspath(video_path).encode()).hexdigest()[:8]
+    return os.path.join(autosave_dir, f"{name}_{digest}.journal")
+
+
+class AnnotationJournal:
+    """
+    A class used to autosave an `AnnotationStore` to a crash-safe,
+    append-only journal. Every insert, update, delete and clear is
+    written as one JSON line by a background thread and fsync'd, so
+    at most the change being written is lost if the GUI crashes. The
+    GUI thread only queues a copy of the changed columns; records are
+    serialised by the writer thread, and a bulk insert such as a CSV
+    import is a single record. Periodic compaction rewrites the
+    journal to hold only the live annotations and exports them as
+    `<prefix>_annotations.npy` and `<prefix>_bites.csv`, the same
+    files "Save Annotations" creates.
+
+    Methods
+    -------
+    __init__(self, store, journal_path, compact_every=500)
+        Sets the store and journal file to use
+    pending_records(self)
+        Returns the number of records in an existing journal
+    replay(self)
+        Rebuilds the store from the journal
+    start(self)
+        Starts journaling changes to the store
+    backup(self)
+        Moves an existing journal aside instead of replaying it
+    compact(self)
+        Queues a compaction of the journal
+    close(self)
+        Compacts the journal and stops the writer thread
+    """
+
+    def __init__(self, store, journal_path, compact_every=500):
+        """
+        Sets the store and journal file to use.
+
+        Parameters
+        ----------
+        store : AnnotationStore
+            The annotations to journal
+        journal_path : str
+            The path of the journal file, e.g. from
+            `autosave_journal_path`. The exported files use the path
+            without its extension as their prefix.
+        compact_every : int
+            The number of records written between compactions
+        """
+
+        self.store = store
+        self.journal_path = journal_path
+        self.export_prefix = os.path.splitext(journal_path)[0]
+        self.compact_every = compact_every
+
+        self._queue = queue.Queue()
+        self._records_since_compaction = 0
+        self._thread = None
+
+    def pending_records(self):
+        """
+        Returns the number of records in an existing journal.
+
+        Returns
+        -------
+        int
+            The number of lines in the journal, 0 if there is none
+        """
+
+        if not os.path.exists(self.journal_path):
+            return 0
+        with open(self.journal_path, "rb") as file:
+            return sum(1 for _ in file)
+
+    def replay(self):
+        """
+        Rebuilds the store from the journal. Annotations are added
+        with a single notification, and the journal is compacted
+        afterwards so its IDs match the rebuilt store.
+
+        Returns
+        -------
+        int
+            The number of annotations restored
+        """
+
+        live = {}
+        with open(self.journal_path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash can leave the last line partly written
+                    break
+
+                op = record["op"]
+                if op in ("add", "update"):
+                    # Records hold full rows as columns, an update replaces live rows
+                    for row, ann_id in enumerate(record["id"]):
+                        if op == "add" or ann_id in live:
+                            live[ann_id] = {key: record[key][row] for key in ANNOTATION_KEYS}
+                elif op == "delete":
+                    for ann_id in record["ids"]:
+                        live.pop(ann_id, None)
+                elif op == "clear":
+                    live.clear()
+
+        for record in live.values():
+            record["Location"] = np.array(record["Location"], dtype=np.float64)
+        self.store.extend(live.values())
+
+        return len(live)
+
+    def start(self):
+        """
+        Starts the writer thread, writes the current annotations as a
+        fresh journal and journals every later change to the store.
+        """
+
+        os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        self.store.subscribe(self._on_change)
+        self.compact()
+
+    def backup(self):
+        """
+        Moves an existing journal to a backup named after the current
+        time, `<journal_path>.<YYYYmmdd-HHMMSS>.bak`, so declining to
+        restore it never overwrites an earlier backup.
+
+        Returns
+        -------
+        str
+            The path of the backup
+        """
+
+        backup_path = f"{self.journal_path}.{time.strftime('%Y%m%d-%H%M%S')}.bak"
+        os.replace(self.journal_path, backup_path)
+        return backup_path
+
+    def compact(self):
+        """
+        Queues a compaction: the journal is rewritten to hold only the
+        current annotations, which are also exported as
+        `<prefix>_annotations.npy` and `<prefix>_bites.csv`.
+        """
+
+        # Copy the columns now, so they match the records queued before them
+        self._queue.put(("compact", self.store.columns()))
+        self._records_since_compaction = 0
+
+    def close(self):
+        """
+        Stops journaling changes to the store, compacts the journal and
+        waits for the writer thread to finish.
+        """
+
+        if self._thread is None:
+            return
+        self.store.unsubscribe(self._on_change)
+        self.compact()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _on_change(self, event, ann_ids):
+        """
+        Queues a change to the store for the writer thread. Only the
+        changed columns are copied here, on the GUI thread; the JSON
+        record is built by `_write_loop`.
+        """
+
+        if event == "insert":
+            self._queue.put(("record", {"op": "add", "columns": self.store.columns(ann_ids)}))
+        elif event == "update":
+            self._queue.put(("record", {"op": "update", "columns": self.store.columns(ann_ids)}))
+        elif event == "delete":
+            self._queue.put(("record", {"op": "delete", "ids": list(ann_ids)}))
+        elif event == "clear":
+            self._queue.put(("record", {"op": "clear"}))
+
+        self._records_since_compaction += max(1, len(ann_ids))
+        if self._records_since_compaction >= self.compact_every:
+            self.compact()
+
+    def _write_loop(self):
+        """
+        Writes queued records to the journal, fsyncing once per batch
+        of records that were queued together, and runs compactions.
+        """
+
+        file = open(self.journal_path, "a")
+        try:
+            while True:
+                item = self._queue.get()
+                batch = [item]
+                while item is not None and item[0] == "record":
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(item)
+
+                lines = [self._dumps(self._record(item[1])) for item in batch if item is not None and item[0] == "record"]
+                if lines:
+                    file.write("".join(lines))
+                    file.flush()
+                    os.fsync(file.fileno())
+
+                last = batch[-1]
+                if last is None:
+                    return
+                if last[0] == "compact":
+                    file.close()
+                    try:
+                        self._compact(last[1])
+                    except OSError as e:
+                        # Keep appending to the existing journal, nothing is lost
+                        print(f"Warning: could not compact the autosave journal: {e}")
+                    file = open(self.journal_path, "a")
+        finally:
+            file.close()
+
+    def _compact(self, columns):
+        """
+        Atomically replaces the journal and exported files with the
+        annotations in `columns`, a copy from `AnnotationStore.columns`.
+        """
+
+        lines = [self._dumps(self._record({"op": "add", "columns": columns}))] if len(columns["id"]) else []
+        self._replace(self.journal_path, lambda path: self._write_lines(path, lines))
+
+        records = [
+            dict(zip(ANNOTATION_KEYS, row))
+            for row in zip(columns["Frame"].tolist(), columns["ClickType"].tolist(),
+                           columns["ObjID"].tolist(), columns["ObjType"].tolist(), columns["Location"])
+        ]
+        general = [record for record in records if record["ClickType"] in [0, 1, 3, 4]]
+        bites = [record for record in records if record["ClickType"] == 2]
+        self._replace(f"{self.export_prefix}_annotations.npy", lambda path: write_annotations_npy(path, general))
+        self._replace(f"{self.export_prefix}_bites.csv", lambda path: write_annotations_csv(path, bites))
+
+    @staticmethod
+    def _replace(file_path, write):
+        """
+        Writes a file through `write(tmp_path)` and moves it over
+        `file_path`, so a crash never leaves a partly written file.
+        """
+
+        root, ext = os.path.splitext(file_path)
+        tmp_path = f"{root}.tmp{ext}"
+        write(tmp_path)
+        with open(tmp_path, "rb+") as file:
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def _record(change):
+        """
+        Turns a queued change into a journal record, with the rows of
+        an add or update written as one list per annotation key.
+        """
+
+        if "columns" not in change:
+            return change
+        columns = change["columns"]
+        return {"op": change["op"], **{key: columns[key].tolist() for key in ["id", *ANNOTATION_KEYS]}}
+
+    @staticmethod
+    def _write_lines(file_path, lines):
+        with open(file_path, "w") as file:
+            file.write("".join(lines))
+
+    @staticmethod
+    def _dumps(record):
+        """
+        Serialises a journal record as one JSON line, converting NumPy
+        values to plain Python values.
+        """
+
+        def default(value):
+            if isinstance(value, np.ndarray):
+                return value.tolist()
+            if isinstance(value, np.generic):
+                return value.item()
+            raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+        return json.dumps(record, default=default) + "\n"
+
+
+class AnnotationTable:
+    """
+    A class used to show an `AnnotationStore` in a `ttk.Treeview`. The
+    table is virtualised: only the rows that fit on screen exist as
+    Treeview items and a separate scrollbar moves the window over the
+    store. Changes from the store redraw at most the visible rows, so
+    the cost of an update does not grow with the number of annotations.
+
+    Methods
+    -------
+    __init__(self, parent, store, columns, column_width=150)
+        Creates the Treeview and scrollbar and subscribes to `store`
+    pack(self, **kwargs)
+        Packs the scrollbar and the Treeview
+    selected_ids(self)
+        Returns the IDs of the selected annotations
+    """
+
+    def __init__(self, parent, store, columns, column_width=150):
+        """
+        Creates the Treeview and scrollbar and subscribes to `store`.
+
+        Parameters
+        ----------
+        parent : tkinter widget
+            The widget the table is placed in
+        store : AnnotationStore
+            The annotations to show
+        columns : tuple of str
+            The column headings, in the order "ID", "Frame",
+            "Click Type", "Fish Label", "ObjType" and "Coordinates"
+        column_width : int
+            The width of each column
+        """
+
+        self.store = store
+        self.treeview = ttk.Treeview(parent, columns=columns, show="headings")
+        for col in columns:
+            self.treeview.heading(col, text=col)
+            self.treeview.column(col, width=column_width)
+        self.scrollbar = ttk.Scrollbar(parent, orient=VERTICAL, command=self._on_scroll)
+
+        # Position in the store of the first visible row
+        self.top = 0
+        self.visible_rows = 1
+
+        self.treeview.bind("<Configure>", self._on_resize)
+        self.treeview.bind("<MouseWheel>", self._on_mousewheel)
+        self.treeview.bind("<Button-4>", lambda event: self._scroll_to(self.top - 3))
+        self.treeview.bind("<Button-5>", lambda event: self._scroll_to(self.top + 3))
+
+        store.subscribe(self._on_change)
+
+    def pack(self, **kwargs):
+        """
+        Packs the scrollbar and the Treeview into the parent widget.
+        """
+
+        self.scrollbar.pack(side="right", fill="y")
+        self.treeview.pack(**kwargs)
+
+    def selected_ids(self):
+        """
+        Returns the IDs of the selected annotations.
+
+        Returns
+        -------
+        list of int
+            The annotation IDs of the selected rows
+        """
+
+        return [int(item) for item in self.treeview.selection()]
+
+    def _on_change(self, event, ann_ids):
+        """
+        Redraws the visible rows if they are affected by a change.
+        """
+
+        if event == "insert":
+            # Follow new annotations when the end of the table is in view
+            previous_len = len(self.store) - len(ann_ids)
+            if self.top + self.visible_rows >= previous_len:
+                self.top = max(0, len(self.store) - self.visible_rows)
+                self._render()
+            else:
+                self._update_scrollbar()
+        elif event == "update":
+            if any(self.treeview.exists(str(ann_id)) for ann_id in ann_ids):
+                self._render()
+        else:
+            self._render()
+
+    def _render(self):
+        """
+        Shows the rows of the store from `self.top`, reusing the
+        Treeview items of annotations that stay in view.
+        """
+
+        self.top = max(0, min(self.top, len(self.store) - self.visible_rows))
+        ann_ids = self.store.ids(self.top, self.top + self.visible_rows)
+        visible = {str(ann_id) for ann_id in ann_ids}
+
+        for item in self.treeview.get_children():
+            if item not in visible:
+                self.treeview.delete(item)
+
+        for position, ann_id in enumerate(ann_ids):
+            annotation = self.store.get(ann_id)
+            values = (
+                self.top + position,
+                annotation["Frame"],
+                annotation["ClickType"],
+                annotation["ObjID"],
+                annotation["ObjType"],
+                annotation["Location"][:2],
+            )
+            item = str(ann_id)
+            if self.treeview.exists(item):
+                self.treeview.item(item, values=values)
+                self.treeview.move(item, "", position)
+            else:
+                self.treeview.insert("", position, iid=item, values=values)
+
+        self._update_scrollbar()
+
+    def _update_scrollbar(self):
+        total = len(self.store)
+        if total <= self.visible_rows:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.top / total, (self.top + self.visible_rows) / total)
+
+    def _scroll_to(self, top):
+        self.top = top
+        self._render()
+        return "break"
+
+    def _on_scroll(self, action, amount, unit=None):
+        """
+        Handles the scrollbar's "moveto" and "scroll" commands.
+        """
+
+        if action == "moveto":
+            self._scroll_to(int(float(amount) * len(self.store)))
+        elif unit == "pages":
+            self._scroll_to(self.top + int(amount) * self.visible_rows)
+        else:
+            self._scroll_to(self.top + int(amount))
+
+    def _on_mousewheel(self, event):
+        # Windows reports multiples of 120 per notch, macOS reports small deltas
+        step = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        return self._scroll_to(self.top - step)
+
+    def _on_resize(self, event):
+        """
+        Recomputes how many rows fit in the Treeview.
+        """
+
+        row_height = ttk.Style().lookup("Treeview", "rowheight") or 20
+        row_height = int(row_height)
+        # Leave room for the heading row
+        visible_rows = max(1, (event.height - row_height - 5) // row_height)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self._render()
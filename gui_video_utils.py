@@ -0,0 +1,542 @@
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# The SAM2 pipeline's mask reader, mask colors and video seek index are shared with the GUI
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "SAM2_Tracking"))
+from mask_utils import MaskReader
+from plot_utils import get_spaced_colors
+from video_utils import SeekIndex
+
+
+class FrameSource:
+    """
+    A class used to provide the frames of a video to the annotation GUI
+    without decoding the whole video up front. Frames are decoded on
+    demand, resized to the video player size and kept in a bounded
+    least-recently-used (LRU) cache. A background thread reads ahead of
+    the last requested frame in the direction of playback, so memory
+    use stays flat no matter how long the video is.
+
+    Methods
+    -------
+    __init__(self, video_path, frame_size, cache_size=120, read_ahead=30)
+        Opens the video and starts the read-ahead and indexing threads
+    get_frame(self, index)
+        Returns the resized BGR frame at `index`
+    close(self)
+        Stops the read-ahead thread and releases the video
+    """
+
+    def __init__(self, video_path, frame_size, cache_size=120, read_ahead=30):
+        """
+        Opens the video and starts the read-ahead thread. The seek
+        index is loaded on its own thread, so the first frame can be
+        shown before it is ready.
+
+        Parameters
+        ----------
+        video_path : str
+            The full path to the video file
+        frame_size : list or tuple of ints
+            The size frames are resized to, with the first element
+            representing the width and the second the height
+        cache_size : int
+            The maximum number of decoded frames held in memory
+        read_ahead : int
+            The number of frames decoded ahead of the last requested
+            frame in the direction of playback. Should be smaller
+            than `cache_size`.
+
+        Raises
+        ------
+        RuntimeError
+            If the video could not be opened
+        """
+
+        self.capture = cv2.VideoCapture(video_path)
+        if not self.capture.isOpened():
+            raise RuntimeError(f"Could not open the video: {video_path}")
+
+        self.video_path = video_path
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.width = self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)
+        self.height = self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        self.frame_size = tuple(frame_size)
+        self.cache_size = cache_size
+        self.read_ahead = min(read_ahead, cache_size // 2)
+
+        # Without keyframe positions, frames at most this far ahead are
+        # decoded forward instead of seeking
+        self.forward_decode_limit = 16
+
+        # Decoded frames, ordered from least to most recently used
+        self._cache = OrderedDict()
+
+        # Guards the capture, the cache and the read-ahead position
+        self._lock = threading.Condition()
+
+        # Frame index the capture will decode next without seeking
+        self._next_index = 0
+
+        # Last requested frame and the direction playback is moving in
+        self._last_index = 0
+        self._direction = 1
+        self._closed = False
+
+        # Keyframe positions, None until loaded or if they are unavailable
+        self.seek_index = None
+        threading.Thread(target=self._load_seek_index, daemon=True).start()
+
+        self._thread = threading.Thread(target=self._read_ahead_loop, daemon=True)
+        self._thread.start()
+
+    def get_frame(self, index):
+        """
+        Returns the resized BGR frame at `index`, decoding it if it
+        is not already cached, and moves the read-ahead window to it.
+
+        Parameters
+        ----------
+        index : int
+            The frame index in the unreduced video
+
+        Returns
+        -------
+        numpy.ndarray or None
+            The resized BGR frame, or None if it could not be decoded
+        """
+
+        with self._lock:
+            frame = self._cache.get(index)
+            if frame is not None:
+                self._cache.move_to_end(index)
+            else:
+                frame = self._decode(index)
+
+            # Read ahead in the direction the user is moving through the video
+            if index != self._last_index:
+                self._direction = 1 if index > self._last_index else -1
+            self._last_index = index
+            self._lock.notify()
+
+        return frame
+
+    def close(self):
+        """
+        Stops the read-ahead thread and releases the video.
+        """
+
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._thread.join()
+        self.capture.release()
+        self._cache.clear()
+
+    def _decode(self, index):
+        """
+        Decodes, resizes and caches the frame at `index`. Must be
+        called with `self._lock` held.
+        """
+
+        # Only seek when decoding forward from the current position
+        # would take longer than decoding from the frame's keyframe
+        if index != self._next_index:
+            if not self._can_decode_forward(index):
+                start = index if self.seek_index is None else self.seek_index.keyframe_before(index)
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+                self._next_index = start
+            while self._next_index < index:
+                if not self.capture.grab():
+                    self._next_index = -1
+                    return None
+                self._next_index += 1
+
+        ret, frame = self.capture.read()
+        if not ret:
+            # The reported frame count can overestimate the video length
+            self._next_index = -1
+            return None
+        self._next_index = index + 1
+
+        frame = cv2.resize(frame, self.frame_size)
+        self._cache[index] = frame
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return frame
+
+    def _can_decode_forward(self, index):
+        """
+        Returns whether `index` can be reached by decoding forward from
+        the capture's position without passing a keyframe.
+        """
+
+        if self._next_index < 0 or index < self._next_index:
+            return False
+        if self.seek_index is None:
+            return index - self._next_index <= self.forward_decode_limit
+        return self.seek_index.keyframe_before(index) <= self._next_index
+
+    def _load_seek_index(self):
+        """
+        Loads or builds the seek index for the video. Runs in a
+        background thread, so any failure, e.g. the video being moved,
+        leaves `self.seek_index` as None and falls back to slower
+        seeking with a warning instead of ending the thread.
+        """
+
+        try:
+            self.seek_index = SeekIndex.load_or_build(self.video_path)
+        except Exception as e:
+            self.seek_index = None
+            print(f"Warning: could not index the video's keyframes ({e}), seeking may be slower.")
+
+    def _next_missing(self):
+        """
+        Returns the first frame of the read-ahead window that is not
+        cached, or None if the window is full. Must be called with
+        `self._lock` held.
+        """
+
+        if self._direction > 0:
+            start = self._last_index + 1
+        else:
+            start = self._last_index - self.read_ahead
+        start = max(0, start)
+        stop = min(self.frame_count, start + self.read_ahead)
+
+        # Taking the lowest missing frame means reading backwards seeks
+        # once and then decodes the window forwards
+        for index in range(start, stop):
+            if index not in self._cache:
+                return index
+        return None
+
+    def _read_ahead_loop(self):
+        """
+        Decodes frames of the read-ahead window one at a time,
+        releasing the lock between frames so requests from the GUI
+        are not kept waiting.
+        """
+
+        while True:
+            with self._lock:
+                index = self._next_missing()
+                while index is None and not self._closed:
+                    self._lock.wait()
+                    index = self._next_missing()
+                if self._closed:
+                    return
+                if self._decode(index) is None:
+                    self.frame_count = min(self.frame_count, index)
+
+            # Give the GUI thread a chance to take the lock
+            time.sleep(0)
+
+
+class PlaybackWorker:
+    """
+    A class used to play a video in the annotation GUI with a
+    producer/consumer pipeline. A worker thread decodes, colour converts
+    and resizes frames into a bounded queue, while the Tk loop only
+    swaps ready images in. Frames are scheduled against a wall clock
+    deadline and dropped when playback falls behind, so the displayed
+    speed matches the requested rate.
+
+    Methods
+    -------
+    __init__(self, frame_source, start_index, rate, queue_size=8, frame_filter=None)
+        Starts the worker thread at `start_index`
+    set_rate(self, rate)
+        Changes the playback rate from the last shown frame
+    next_frame(self)
+        Returns the latest ready frame that is due for display
+    delay_ms(self)
+        Returns the time until the next frame is due
+    stop(self)
+        Stops the worker thread
+    """
+
+    # Marks the end of the video in the queue
+    _END = object()
+
+    def __init__(self, frame_source, start_index, rate, queue_size=8, frame_filter=None):
+        """
+        Starts the worker thread at `start_index`.
+
+        Parameters
+        ----------
+        frame_source : FrameSource
+            The source the frames are decoded from
+        start_index : int
+            The first frame to play
+        rate : float
+            The number of frames to display per second, i.e. the video
+            FPS multiplied by the playback speed
+        queue_size : int
+            The maximum number of ready frames held in the queue
+        frame_filter : callable or None
+            Called as `frame_filter(index, frame)` on the worker thread
+            and returns the BGR frame to display, e.g. with masks drawn
+        """
+
+        self.frame_source = frame_source
+        self.frame_filter = frame_filter
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.finished = False
+        self.shown_index = start_index - 1
+
+        # Frame ready to be shown once its deadline has passed
+        self._pending = None
+        self._stopped = threading.Event()
+
+        self._anchor(start_index, rate)
+        self._due_index = start_index
+
+        self._thread = threading.Thread(target=self._produce, args=(start_index,), daemon=True)
+        self._thread.start()
+
+    def set_rate(self, rate):
+        """
+        Changes the playback rate, keeping the last shown frame as the
+        reference point so playback does not jump.
+
+        Parameters
+        ----------
+        rate : float
+            The number of frames to display per second
+        """
+
+        self._anchor(self.shown_index + 1, rate)
+
+    def next_frame(self):
+        """
+        Returns the latest ready frame whose deadline has passed,
+        dropping any older frames that were not shown in time.
+
+        Returns
+        -------
+        tuple of (int, PIL.Image.Image) or None
+            The frame index and the RGB image to display, or None if
+            no new frame is due yet
+        """
+
+        due = self._anchor_index + int((time.perf_counter() - self._anchor_time) * self.rate)
+        self._due_index = due
+
+        frame = None
+        while True:
+            if self._pending is None:
+                try:
+                    self._pending = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if self._pending is self._END:
+                self.finished = frame is None
+                break
+            if self._pending[0] > due:
+                break
+            frame, self._pending = self._pending, None
+
+        if frame is not None:
+            self.shown_index = frame[0]
+        return frame
+
+    def delay_ms(self):
+        """
+        Returns the number of milliseconds until the frame after the
+        last shown frame is due.
+
+        Returns
+        -------
+        int
+            The delay to pass to `root.after`, at least 1
+        """
+
+        deadline = self._anchor_time + (self.shown_index + 1 - self._anchor_index) / self.rate
+        return max(1, int((deadline - time.perf_counter()) * 1000))
+
+    def stop(self):
+        """
+        Stops the worker thread and discards any queued frames.
+        """
+
+        self._stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+
+    def _anchor(self, index, rate):
+        """
+        Sets the frame index that is due at the current time and the
+        rate frames become due afterwards.
+        """
+
+        self.rate = rate
+        self._anchor_index = index
+        self._anchor_time = time.perf_counter()
+
+    def _produce(self, index):
+        """
+        Decodes frames into the queue, skipping ahead to the frame that
+        is currently due when the display has fallen behind.
+        """
+
+        while not self._stopped.is_set() and index < self.frame_source.frame_count:
+            index = max(index, self._due_index)
+            frame = self.frame_source.get_frame(index)
+            if frame is None:
+                break
+            if self.frame_filter is not None:
+                frame = self.frame_filter(index, frame)
+            image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            if not self._put((index, image)):
+                return
+            index += 1
+        self._put(self._END)
+
+    def _put(self, item):
+        """
+        Blocks until `item` is queued or the worker is stopped.
+        """
+
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class MaskOverlay:
+    """
+    A class used to preview SAM2 masks in the annotation GUI. It opens
+    a `masks_dict_file` written by `SAM2FishSegmenter.run_propagation`
+    and alpha blends the masks and object IDs onto displayed frames on
+    the CPU. Masks are only decoded and resized when their frame is
+    shown, and the decoded frames are kept in a small LRU cache.
+
+    Methods
+    -------
+    __init__(self, masks_file, frame_size, alpha=0.6, cache_size=32)
+        Loads the masks file
+    draw(self, frame, sam2_frame)
+        Returns `frame` with the masks of `sam2_frame` drawn on it
+    """
+
+    def __init__(self, masks_file, frame_size, alpha=0.6, cache_size=32):
+        """
+        Loads the masks file.
+
+        Parameters
+        ----------
+        masks_file : str
+            A mask file written by `mask_utils.MaskWriter`, or a pickle
+            file written by older versions, representing the generated
+            masks for each SAM2 frame
+        frame_size : list or tuple of ints
+            The size of the displayed frames, with the first element
+            representing the width and the second the height
+        alpha : float
+            Alpha value for the drawn masks
+        cache_size : int
+            The maximum number of decoded frames held in memory
+        """
+
+        self.frame_masks = MaskReader(masks_file)
+
+        self.frame_size = tuple(frame_size)
+        self.alpha = alpha
+        self.cache_size = cache_size
+
+        # Colors are indexed by object ID and converted to BGR
+        self.colors = np.array([color[::-1] for color in get_spaced_colors(100)], dtype=np.float32)
+
+        # Frames are drawn on both the GUI and the playback threads
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def draw(self, frame, sam2_frame):
+        """
+        Returns a copy of `frame` with the masks and object IDs of
+        `sam2_frame` drawn on it.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            The resized BGR frame that is displayed
+        sam2_frame : int
+            The index of the frame in the masks file
+
+        Returns
+        -------
+        numpy.ndarray
+            The BGR frame with masks drawn, or `frame` itself if there
+            are no masks for `sam2_frame`
+        """
+
+        with self._lock:
+            decoded = self._cache.get(sam2_frame)
+            if decoded is None:
+                decoded = self._decode(sam2_frame)
+                self._cache[sam2_frame] = decoded
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(sam2_frame)
+
+        labels, palette, centroids = decoded
+        if labels is None:
+            return frame
+
+        # Blend every object's color in a single pass over the frame
+        covered = labels > 0
+        frame = frame.copy()
+        blended = frame[covered] * (1 - self.alpha) + palette[labels[covered]] * self.alpha
+        frame[covered] = blended.astype(np.uint8)
+
+        for obj_id, centroid in centroids:
+            cv2.putText(frame, str(obj_id), centroid, cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+
+        return frame
+
+    def _decode(self, sam2_frame):
+        """
+        Decodes the masks of `sam2_frame` into a map of object labels
+        at the display size, their colors and their centroids.
+        """
+
+        mask_dict = self.frame_masks.get_frame(sam2_frame)
+        if not mask_dict:
+            return None, None, []
+
+        labels = np.zeros(self.frame_size[::-1], dtype=np.int16)
+        palette = [np.zeros(3, dtype=np.float32)]
+        centroids = []
+
+        for obj_id, mask in mask_dict.items():
+
+            mask = cv2.resize(mask.astype(np.uint8), self.frame_size, interpolation=cv2.INTER_NEAREST)
+            y_indices, x_indices = np.nonzero(mask)
+            if len(y_indices) == 0:
+                continue
+
+            labels[y_indices, x_indices] = len(palette)
+            palette.append(self.colors[int(obj_id) % len(self.colors)])
+            centroids.append((obj_id, (int(x_indices.mean()), int(y_indices.mean()))))
+
+        return labels, np.array(palette), centroids